@@ -0,0 +1,78 @@
+"""get_history_from_db row formatting and the /history JSON body at 10k/100k/1M rows (fake cursor)."""
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi.responses import JSONResponse
+
+from conftest import import_main
+
+main = import_main()
+
+SIZES = [10_000, 100_000, 1_000_000]
+
+
+class FakeCursor:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def execute(self, query, params=None):
+        pass
+
+    def fetchall(self):
+        return self.rows
+
+
+class FakeConnection:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def cursor(self, cursor_factory=None):
+        return FakeCursor(self.rows)
+
+
+def make_rows(count):
+    """Rows shaped like RealDictCursor output, newest first, one every 5 s"""
+    start = datetime(2025, 6, 1, 12, 0, 0)
+    return [{
+        'id': count - i,
+        'timestamp': start - timedelta(seconds=5 * i),
+        'temperature': 25.0 + (i % 100) / 10,
+        'humidity': 60.0 + (i % 300) / 10,
+        'rainfall': 0.0 if i % 7 else 1.2,
+        'nitrogen': 40.0 + i % 60,
+        'phosphorus': 30.0 + i % 40,
+        'potassium': 20.0 + i % 50,
+        'ph': 5.5 + (i % 20) / 10,
+        'monthly_rainfall': 182.4
+    } for i in range(count)]
+
+
+@pytest.fixture(params=SIZES, ids=lambda size: f'{size // 1000}k')
+def history_rows(request, monkeypatch):
+    size = request.param
+    if size > request.config.getoption('--history-max-rows'):
+        pytest.skip(f'{size} dòng > --history-max-rows')
+    rows = make_rows(size)
+
+    @contextmanager
+    def fake_connection():
+        yield FakeConnection(rows)
+    monkeypatch.setattr(main, 'get_connection', fake_connection)
+    return size
+
+
+def rounds_for(size):
+    return max(1, 1_000_000 // size // 10)
+
+
+def bench_history_rows(benchmark, history_rows):
+    result = benchmark.pedantic(main.get_history_from_db, rounds=rounds_for(history_rows), warmup_rounds=0)
+    assert len(result) == history_rows
+
+
+def bench_history_json(benchmark, history_rows):
+    # Toàn bộ đường đi của body /history: định dạng dòng + JSONResponse.render
+    result = benchmark.pedantic(lambda: JSONResponse(main.get_history_from_db()).body,
+                                rounds=rounds_for(history_rows), warmup_rounds=0)
+    assert result.startswith(b'[{')
@@ -0,0 +1,74 @@
+"""MQTTClient.on_message → mqtt_bridge → handle_sensor → broadcast to N WebSockets."""
+import asyncio
+import json
+
+import pytest
+
+from conftest import FakeWebSocket, import_main
+
+from ingest import ingest_buffer  # noqa: E402
+from mqtt_bridge import MQTT_QUEUE_SIZE, mqtt_bridge  # noqa: E402
+
+main = import_main()
+
+# Mỗi vòng đo gửi bấy nhiêu message, ít hơn MQTT_QUEUE_SIZE để không message nào bị bỏ
+MESSAGES = min(500, MQTT_QUEUE_SIZE)
+
+
+class Message:
+    topic = 'iot/sensor/data'
+
+    def __init__(self, temperature):
+        self.payload = json.dumps({'temperature': temperature, 'humidity': 78.2, 'nitrogen': 61.0,
+                                   'phosphorus': 42.0, 'potassium': 40.0, 'ph': 6.4}).encode()
+
+
+# Nhiệt độ đổi luân phiên → mỗi message sinh đúng 1 gói delta "latest" cho client giao thức 2
+MESSAGE_CYCLE = [Message(29.4), Message(29.5)]
+
+
+@pytest.fixture(scope='module')
+def bridge(loop):
+    async def start():
+        mqtt_bridge.start()
+    loop.run_until_complete(start())
+    yield mqtt_bridge
+    loop.run_until_complete(mqtt_bridge.stop())
+
+
+def processed():
+    return mqtt_bridge.counters['sensor']['processed']
+
+
+async def pump(count):
+    target = processed() + count
+    for i in range(count):
+        main.mqtt_client.on_message(None, None, MESSAGE_CYCLE[i % 2])
+    # Đo tới khi mọi client đã nhận xong (các gói latest chưa kịp gửi được gộp lại)
+    while processed() < target or any(writer.pending for writer in main.ws_manager.clients.values()):
+        await asyncio.sleep(0)
+
+
+async def connect(sockets):
+    for ws in sockets:
+        main.ws_manager.connect(ws).start()
+
+
+async def disconnect(sockets):
+    for ws in sockets:
+        await main.ws_manager.disconnect(ws)
+
+
+@pytest.mark.parametrize('clients', [0, 10, 100])
+def bench_on_message_broadcast(benchmark, loop, bridge, clients):
+    sockets = [FakeWebSocket() for _ in range(clients)]
+    loop.run_until_complete(connect(sockets))
+    benchmark.extra_info.update({'messages': MESSAGES, 'clients': clients})
+    try:
+        benchmark.pedantic(lambda: loop.run_until_complete(pump(MESSAGES)),
+                           setup=ingest_buffer._buffer.clear, rounds=10, warmup_rounds=1)
+        assert len(main.ws_manager.clients) == clients # không client nào bị ngắt
+    finally:
+        loop.run_until_complete(disconnect(sockets))
+    assert mqtt_bridge.counters['sensor']['dropped'] == 0
+    assert all(ws.frames > 0 and '"temperature":29.5' in ws.last_text for ws in sockets)
@@ -0,0 +1,103 @@
+"""AsyncMQTTTransport (add_reader/add_writer + loop_misc) against the in-process FakeBroker: acked publishes,
+subscribe round trip, and reconnect after the broker drops the connection."""
+import asyncio
+import itertools
+import json
+
+import pytest
+
+from fake_broker import FakeBroker
+from mqtt_async import AsyncMQTTTransport
+
+PUBLISHES = 200
+SUBSCRIPTIONS = [('iot/sensor/data', 1), ('iot/device/status/+', 1), ('iot/device/control/#', 1)]
+_client_ids = itertools.count()
+
+
+def transport():
+    return AsyncMQTTTransport(client_id=f"bench_{next(_client_ids)}", transport='tcp', use_tls=False)
+
+
+async def close(*clients):
+    for client in clients:
+        await client.disconnect()
+        if client._misc_task: # loop_misc chỉ dừng ở lần kiểm tra sau (1 s) → hủy luôn trước khi đóng loop
+            client._misc_task.cancel()
+
+
+@pytest.fixture(scope='module')
+def broker(loop):
+    fake = loop.run_until_complete(FakeBroker().start())
+    yield fake
+    loop.run_until_complete(fake.stop())
+
+
+@pytest.fixture
+def pair(loop, broker):
+    """(publisher, subscriber) connected to the broker; the subscriber listens on SUBSCRIPTIONS"""
+    async def open_pair():
+        publisher, subscriber = transport(), transport()
+        await publisher.connect('127.0.0.1', broker.port, timeout=5)
+        await subscriber.connect('127.0.0.1', broker.port, timeout=5)
+        await subscriber.subscribe(SUBSCRIPTIONS)
+        return publisher, subscriber
+    publisher, subscriber = loop.run_until_complete(open_pair())
+    yield publisher, subscriber
+    loop.run_until_complete(close(publisher, subscriber))
+
+
+async def publish_acked(publisher, count):
+    acks = [publisher.publish_nowait('iot/test', json.dumps({'i': i}), qos=1) for i in range(count)]
+    return await asyncio.wait_for(asyncio.gather(*acks), timeout=10)
+
+
+async def receive(subscriber, count):
+    messages = subscriber.messages()
+    return [await asyncio.wait_for(messages.__anext__(), timeout=5) for _ in range(count)]
+
+
+def bench_publish_qos1_acked(benchmark, loop, pair):
+    publisher, _ = pair
+    benchmark.extra_info['publishes'] = PUBLISHES
+    mids = benchmark.pedantic(lambda: loop.run_until_complete(publish_acked(publisher, PUBLISHES)),
+                              rounds=10, warmup_rounds=1)
+    assert len(set(mids)) == PUBLISHES # mọi PUBACK đều về đúng future
+    assert not publisher._acks
+
+
+def bench_subscribe_round_trip(benchmark, loop, pair):
+    publisher, subscriber = pair
+
+    async def round_trip():
+        await publisher.publish('iot/sensor/data', json.dumps({'temperature': 29.4}))
+        await publisher.publish('iot/device/status/pump', json.dumps({'status': True}))
+        await publisher.publish('iot/device/control/fan', json.dumps({'status': False}))
+        await publisher.publish('iot/other', b'{}') # không khớp topic nào → không được chuyển tới
+        return await receive(subscriber, 3)
+
+    received = benchmark.pedantic(lambda: loop.run_until_complete(round_trip()), rounds=20, warmup_rounds=1)
+    assert [topic for topic, _ in received] == ['iot/sensor/data', 'iot/device/status/pump', 'iot/device/control/fan']
+    assert json.loads(received[0][1]) == {'temperature': 29.4}
+    assert subscriber.dropped_messages == 0
+
+
+def bench_reconnect_after_broker_drop(benchmark, loop, broker):
+    client = transport()
+    changes = []
+    client.on_connection_change = lambda connected, rc: changes.append(connected)
+
+    async def drop_and_reconnect():
+        broker.drop_all()
+        await asyncio.wait_for(client.wait_disconnected(), timeout=5)
+        assert not client.is_connected
+        await client.connect('127.0.0.1', broker.port, timeout=5)
+        await client.subscribe([('iot/test', 1)])
+        await client.publish('iot/test', b'{}') # sau khi kết nối lại publish vẫn được PUBACK
+
+    loop.run_until_complete(client.connect('127.0.0.1', broker.port, timeout=5))
+    try:
+        benchmark.pedantic(lambda: loop.run_until_complete(drop_and_reconnect()), rounds=5)
+        assert client.is_connected
+        assert changes[0] is True and changes.count(False) == changes.count(True) - 1
+    finally:
+        loop.run_until_complete(close(client))
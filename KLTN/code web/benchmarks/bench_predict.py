@@ -0,0 +1,59 @@
+"""/predict (single) and /predict/batch end-to-end latency through the ASGI app, inline executor."""
+import pandas as pd
+import pytest
+from fastapi.testclient import TestClient
+
+from conftest import DATASET, import_main
+
+from crop_predictor import FEATURES  # noqa: E402
+from inference import InferenceExecutor  # noqa: E402
+from model_registry import ModelRegistry  # noqa: E402
+
+main = import_main()
+
+BATCH_SIZES = [100, 1000]
+
+
+@pytest.fixture(scope='module')
+def records():
+    return pd.read_csv(DATASET)[FEATURES].round(2).to_dict('records')
+
+
+@pytest.fixture(scope='module')
+def client(models_dir):
+    registry = ModelRegistry(models_dir, watch_interval=0)
+    if not registry.available:
+        pytest.skip(f'Không có model trong {models_dir} (dùng --models-dir)')
+    executor = InferenceExecutor('inline', registry=registry)
+    executor.start()
+    patch = pytest.MonkeyPatch()
+    patch.setattr(main, 'inference', executor)
+    patch.setattr(main, 'get_last_month_rainfall', lambda: 202.94) # không gọi open-meteo
+    _, predictor = registry.get()
+    yield TestClient(main.app), predictor
+    patch.undo()
+
+
+@pytest.mark.parametrize('top_k', [None, 3], ids=['label', 'top3'])
+def bench_predict_single(benchmark, client, records, top_k):
+    http, predictor = client
+    rows = iter(records * 100)
+    url = '/predict' + (f'?top_k={top_k}' if top_k else '')
+
+    def call():
+        response = http.post(url, json=next(rows))
+        assert response.status_code == 200
+    # Xóa LRU cache trước mỗi lần để đo đúng một lần gọi model
+    benchmark.pedantic(call, setup=predictor.clear_cache, rounds=200, warmup_rounds=5)
+
+
+@pytest.mark.parametrize('size', BATCH_SIZES)
+def bench_predict_batch(benchmark, client, records, size):
+    http, predictor = client
+    body = {'rows': records[:size]}
+
+    def call():
+        response = http.post('/predict/batch', json=body)
+        assert response.status_code == 200 and response.json()['count'] == size
+    benchmark.extra_info['rows'] = size
+    benchmark.pedantic(call, setup=predictor.clear_cache, rounds=10, warmup_rounds=1)
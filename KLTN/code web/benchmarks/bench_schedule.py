@@ -0,0 +1,71 @@
+"""CronSchedule.next_after / last_at_or_before field jumping, checked against a minute-by-minute scan."""
+from datetime import datetime, timedelta
+
+import pytest
+
+from schedule import CronSchedule, vn_tz  # noqa: E402
+
+START = vn_tz.localize(datetime(2025, 6, 1, 12, 0))
+EXPRESSIONS = [
+    '30 18 * * 1-5',
+    '0 8 */2 * 1',      # */n bắt đầu bằng "*" → không tính là giới hạn: ngày lẻ VÀ thứ Hai
+    '0 8 1,15 * 1',     # cả hai trường đều giới hạn → ngày 1/15 HOẶC thứ Hai
+    '0 6 * * */2',
+    '15 */6 10-20 * *',
+]
+
+
+def vixie_day_matches(expression: str, day: datetime) -> bool:
+    """Day rule of Vixie cron, written out independently of CronSchedule"""
+    schedule = CronSchedule(expression)
+    fields = expression.split()
+    dom = day.day in schedule.days
+    dow = day.weekday() in schedule.weekdays
+    if fields[2].startswith('*') or fields[4].startswith('*'):
+        return dom and dow
+    return dom or dow
+
+
+def scan_after(expression: str, after: datetime, count: int):
+    """The next `count` matches found by checking every minute"""
+    schedule = CronSchedule(expression)
+    local = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+    found = []
+    while len(found) < count:
+        if (local.month in schedule.months and local.hour in schedule.hours and local.minute in schedule.minutes
+                and vixie_day_matches(expression, local)):
+            found.append(local)
+        local += timedelta(minutes=1)
+    return found
+
+
+@pytest.mark.parametrize('expression', EXPRESSIONS)
+def bench_next_after(benchmark, expression):
+    schedule = CronSchedule(expression)
+    expected = scan_after(expression, START, 10)
+
+    def next_ten():
+        runs, current = [], START
+        for _ in range(10):
+            current = schedule.next_after(current)
+            runs.append(current)
+        return runs
+
+    runs = benchmark(next_ten)
+    assert [run.replace(tzinfo=None) for run in runs] == [run.replace(tzinfo=None) for run in expected]
+    assert schedule.last_at_or_before(runs[-1]) == runs[-1]
+    assert schedule.last_at_or_before(runs[-1] - timedelta(minutes=1)) == runs[-2]
+
+
+def bench_step_day_of_month_is_unrestricted():
+    # Vixie cron: "*/2" ở trường ngày vẫn là "*" → kết hợp AND với thứ, không phải OR
+    schedule = CronSchedule('0 8 */2 * 1')
+    runs, current = [], START
+    for _ in range(8):
+        current = schedule.next_after(current)
+        runs.append(current)
+    assert all(run.weekday() == 0 and run.day % 2 == 1 for run in runs)
+    # Cả hai trường giới hạn → HOẶC: 02/06/2025 là thứ Hai, ngày 15 là Chủ nhật
+    restricted = CronSchedule('0 8 1,15 * 1')
+    assert restricted.next_after(START).date() == datetime(2025, 6, 2).date()
+    assert restricted.next_after(vn_tz.localize(datetime(2025, 6, 14, 12, 0))).date() == datetime(2025, 6, 15).date()
@@ -0,0 +1,110 @@
+"""DeviceTimer with 1k devices: scheduling through the API, startup load, firing 1k due edges, and startup catch-up."""
+import asyncio
+import contextlib
+import io
+import time
+from datetime import datetime, timedelta
+
+import pytest
+
+from conftest import FakeMQTTClient
+
+from device_timer import DeviceTimer, vn_tz  # noqa: E402
+from timer_store import TimerStore  # noqa: E402
+
+DEVICES = 1000
+SLOTS = [
+    {'on': '06:00', 'off': '06:30', 'days': ['mon', 'wed', 'fri']},
+    {'cron_on': '0 18 * * 1-5', 'cron_off': '30 18 * * 1-5'}
+]
+
+
+@pytest.fixture
+def store_path(tmp_path):
+    return str(tmp_path / 'device_timers.json')
+
+
+def quiet():
+    # Log từng lệnh của DeviceTimer làm sai số đo
+    return contextlib.redirect_stdout(io.StringIO())
+
+
+def bench_timer_set_schedule_1k(benchmark, loop, store_path):
+    devices = [f'device-{i}' for i in range(DEVICES)]
+    timers = []
+
+    def setup():
+        timers.append(DeviceTimer(FakeMQTTClient(devices), TimerStore(store_path, compact_every=10 ** 9)))
+        return (timers[-1],), {}
+
+    async def schedule(timer):
+        for device in devices:
+            timer.set_schedule(device, SLOTS)
+        await timer.stop()
+
+    def run(timer):
+        with quiet():
+            loop.run_until_complete(schedule(timer))
+    benchmark.pedantic(run, setup=setup, rounds=3)
+    assert len(timers[-1].timers) == DEVICES
+
+
+def bench_timer_load_1k(benchmark, store_path):
+    store = TimerStore(store_path, compact_every=10 ** 9)
+    for i in range(DEVICES):
+        store.state['timers'][f'device-{i}'] = {'slots': SLOTS, 'enabled': True}
+    store.compact()
+
+    def load():
+        with quiet():
+            return DeviceTimer(FakeMQTTClient(), TimerStore(store_path, compact_every=10 ** 9))
+    timer = benchmark.pedantic(load, rounds=5)
+    assert len(timer._heap) == DEVICES * 4
+
+
+def bench_timer_fire_1k(benchmark, loop, store_path):
+    async def fire_all():
+        client = FakeMQTTClient()
+        timer = DeviceTimer(client, TimerStore(store_path, compact_every=10 ** 9))
+        now = time.time()
+        for i in range(DEVICES):
+            timer._push(now, f'device-{i}', True)
+        while client.sent < DEVICES:
+            await asyncio.sleep(0)
+        await timer.stop()
+        return client.sent
+
+    def run():
+        with quiet():
+            return loop.run_until_complete(fire_all())
+    assert benchmark.pedantic(run, rounds=5) == DEVICES
+
+
+def bench_timer_catchup_unreported(benchmark, loop, store_path):
+    # Chỉ server khởi động lại: ESP32 không báo trạng thái → mốc TẮT bị lỡ vẫn phải được gửi
+    def setup():
+        now = datetime.now(vn_tz)
+        store = TimerStore(store_path, compact_every=10 ** 9)
+        store.state['timers'].clear()
+        for device in ('pump', 'fan'):
+            store.state['timers'][device] = {'on_datetime': (now - timedelta(hours=2)).isoformat(),
+                                             'off_datetime': (now - timedelta(minutes=10)).isoformat(),
+                                             'daily': False, 'enabled': True}
+        store.compact()
+        client = FakeMQTTClient(['pump', 'fan', 'light'])
+        client.reported_devices.add('fan') # fan đã báo TẮT → đúng lịch, không gửi lại
+        with quiet():
+            timer = DeviceTimer(client, TimerStore(store_path, compact_every=10 ** 9))
+        return (timer, client), {}
+
+    async def catchup(timer):
+        changes = await timer.reconcile()
+        await timer.stop()
+        return changes
+
+    def run(timer, client):
+        with quiet():
+            return loop.run_until_complete(catchup(timer)), client
+    changes, client = benchmark.pedantic(run, setup=setup, rounds=5)
+    assert [(change['device'], change['status'], change['previous']) for change in changes] == [('pump', False, None)]
+    assert client.sent == 1 and client.device_states['pump'] is False
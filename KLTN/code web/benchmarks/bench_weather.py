@@ -0,0 +1,154 @@
+"""OpenWeather 5-day/3-hour forecast parsing, the cached get_forecast_rainfall path, and WeatherCache against a
+local fake HTTP server: single-flight, TTL expiry, stale fallback, RETRY_AFTER_FAILURE and cancellation."""
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from conftest import DATA_DIR
+from fake_weather import FakeWeatherServer
+
+import weather  # noqa: E402
+
+FORECAST_FILE = os.path.join(DATA_DIR, 'openweather_forecast.json')
+
+
+@pytest.fixture(scope='module')
+def forecast_text():
+    with open(FORECAST_FILE, encoding='utf-8') as f:
+        return f.read()
+
+
+def bench_parse_forecast(benchmark, forecast_text):
+    # json.loads + gom 40 mốc 3 giờ thành các ngày, như fetch_forecast sau khi nhận body
+    result = benchmark(lambda: weather.parse_forecast(json.loads(forecast_text)))
+    assert result['forecast_5days']
+
+
+def bench_get_forecast_rainfall_cached(benchmark, loop, forecast_text, monkeypatch):
+    async def fetch_forecast():
+        return weather.parse_forecast(json.loads(forecast_text))
+    monkeypatch.setattr(weather, 'fetch_forecast', fetch_forecast)
+    weather.weather_cache.clear()
+    result = benchmark(lambda: loop.run_until_complete(weather.get_forecast_rainfall()))
+    weather.weather_cache.clear()
+    assert result['forecast_5days']
+
+
+@pytest.fixture(scope='module')
+def server(forecast_text):
+    fake = FakeWeatherServer(json.loads(forecast_text)).start()
+    yield fake
+    fake.stop()
+
+
+@pytest.fixture
+def upstream(server, monkeypatch):
+    """weather.py pointed at the fake server, with an empty cache and short TTLs"""
+    monkeypatch.setattr(weather, 'OPENWEATHER_URL', server.url('/forecast'))
+    monkeypatch.setattr(weather, 'OPEN_METEO_URL', server.url('/v1/forecast'))
+    monkeypatch.setitem(weather.CACHE_POLICIES, 'forecast', (0.05, 60))
+    monkeypatch.setattr(weather, 'RETRY_AFTER_FAILURE', 0.05)
+    server.status, server.delay = 200, 0.0
+    server.requests.clear()
+    weather.weather_cache.clear()
+    yield server
+    weather.weather_cache.clear()
+
+
+def bench_forecast_single_flight(benchmark, loop, upstream):
+    # 50 request cùng lúc khi cache trống → đúng 1 lần gọi API
+    upstream.delay = 0.02
+
+    def reset():
+        weather.weather_cache.clear()
+        upstream.requests.clear()
+
+    async def burst():
+        return await asyncio.gather(*(weather.get_forecast_rainfall() for _ in range(50)))
+
+    results = benchmark.pedantic(lambda: loop.run_until_complete(burst()), setup=reset, rounds=5)
+    assert upstream.requests['/forecast'] == 1
+    assert results[0]['forecast_5days'] and all(result == results[0] for result in results)
+
+
+def bench_forecast_ttl_stale_and_retry(loop, upstream):
+    async def get():
+        return await weather.get_forecast_rainfall()
+
+    fresh = loop.run_until_complete(get())
+    assert loop.run_until_complete(get()) == fresh and upstream.requests['/forecast'] == 1 # còn tươi → cache
+
+    time.sleep(0.06) # hết TTL → gọi lại
+    loop.run_until_complete(get())
+    assert upstream.requests['/forecast'] == 2
+
+    time.sleep(0.06)
+    upstream.status = 500
+    stale_served = weather.weather_cache.stale_served
+    assert loop.run_until_complete(get()) == fresh # API lỗi → bản cũ thay vì dự báo rỗng
+    assert weather.weather_cache.stale_served == stale_served + 1
+    loop.run_until_complete(get())
+    assert upstream.requests['/forecast'] == 3 # trong RETRY_AFTER_FAILURE không gọi lại API đang lỗi
+
+    time.sleep(0.06)
+    upstream.status = 200
+    assert loop.run_until_complete(get()) == fresh
+    assert upstream.requests['/forecast'] == 4
+
+    weather.weather_cache.clear()
+    upstream.status = 500
+    assert loop.run_until_complete(get())['forecast_5days'] == [] # không có bản cũ → giá trị mặc định
+
+
+@pytest.mark.parametrize('stale', [False, True], ids=['empty', 'stale'])
+def bench_forecast_owner_cancelled(loop, upstream, stale):
+    # Task gọi API bị hủy: chỉ nó nhận CancelledError, các request đang chờ fallback như khi API lỗi
+    key = f"forecast:{weather.CITY}"
+
+    async def scenario():
+        if stale:
+            await weather.get_forecast_rainfall()
+            await asyncio.sleep(0.06)
+        upstream.delay = 0.5
+        owner = asyncio.create_task(weather.weather_cache.get('forecast', key, weather.fetch_forecast))
+        await asyncio.sleep(0.05)
+        waiters = [asyncio.create_task(weather.get_forecast_rainfall()) for _ in range(5)]
+        await asyncio.sleep(0.01)
+        owner.cancel()
+        results = await asyncio.gather(*waiters)
+        with pytest.raises(asyncio.CancelledError):
+            await owner
+        return results
+
+    results = loop.run_until_complete(scenario())
+    assert all(bool(result['forecast_5days']) == stale for result in results)
+    assert not weather.weather_cache._inflight # lần gọi sau sẽ thử lại API
+
+
+def bench_forecast_waiter_cancelled(loop, upstream):
+    # Một request đang chờ bị hủy không làm hỏng kết quả dùng chung của các request khác
+    async def scenario():
+        upstream.delay = 0.1
+        tasks = [asyncio.create_task(weather.get_forecast_rainfall()) for _ in range(5)]
+        await asyncio.sleep(0.02)
+        tasks[1].cancel()
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        return results
+
+    results = loop.run_until_complete(scenario())
+    assert isinstance(results[1], asyncio.CancelledError)
+    assert all(result['forecast_5days'] for i, result in enumerate(results) if i != 1)
+    assert upstream.requests['/forecast'] == 1
+
+
+def bench_monthly_rainfall_threads_single_flight(upstream):
+    # get_sync từ nhiều thread (thread paho, bot.py): 1 lần gọi API, mọi thread nhận cùng giá trị
+    upstream.delay = 0.05
+    with ThreadPoolExecutor(10) as pool:
+        results = list(pool.map(lambda _: weather.get_last_month_rainfall(), range(10)))
+    assert results == [3.5] * 10
+    assert upstream.requests['/v1/forecast'] == 1
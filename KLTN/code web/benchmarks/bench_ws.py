@@ -0,0 +1,148 @@
+"""WebSocketManager protocol 2: one delta tick fanned out to N clients, and snapshot/delta consistency
+for clients that connect while the shared state changes (fake DB and weather)."""
+import asyncio
+import json
+
+import pytest
+
+from conftest import FakeWebSocket, import_main
+
+main = import_main()
+
+
+class RecordingWebSocket(FakeWebSocket):
+    """FakeWebSocket that keeps every frame it was sent"""
+
+    def __init__(self):
+        super().__init__()
+        self.texts = []
+
+    async def send_text(self, text: str):
+        await super().send_text(text)
+        self.texts.append(json.loads(text))
+
+
+class FakeSources:
+    """History rows, latest reading and forecast served to the manager instead of PostgreSQL/OpenWeather"""
+
+    def __init__(self):
+        self.rows = [{'id': i, 'temperature': 25.0} for i in range(1, 6)]
+        self.latest = {'temperature': 29.4, 'humidity': 78.2}
+        self.forecast = {'today': {'rain': 0.0}, 'forecast_5days': [{'rain': 1.0}]}
+        self.forecast_delay = 0.0
+
+    async def build_latest_payload(self):
+        return dict(self.latest)
+
+    async def run_db(self, func, after, limit):
+        return [row for row in reversed(self.rows) if after is None or row['id'] > after][:limit]
+
+    async def get_forecast_rainfall(self):
+        if self.forecast_delay:
+            await asyncio.sleep(self.forecast_delay)
+        return dict(self.forecast)
+
+    def add_rows(self, count):
+        start = self.rows[-1]['id'] + 1
+        self.rows.extend({'id': i, 'temperature': 25.0} for i in range(start, start + count))
+
+
+@pytest.fixture
+def sources(monkeypatch):
+    fake = FakeSources()
+    for name in ('build_latest_payload', 'run_db', 'get_forecast_rainfall'):
+        monkeypatch.setattr(main, name, getattr(fake, name))
+    return fake
+
+
+async def tick(manager):
+    """One broadcast_loop iteration for protocol 2 clients"""
+    _, current = manager._split()
+    delta, base, rows = await manager.build_delta(current)
+    _, current = manager._split()
+    manager.broadcast_delta(current, delta, base, rows)
+
+
+async def connect(manager, sockets):
+    for ws in sockets:
+        await manager.send_snapshot(manager.connect(ws))
+
+
+async def drain(manager):
+    while any(writer.pending for writer in manager.clients.values()):
+        await asyncio.sleep(0)
+
+
+async def close(manager, sockets):
+    for ws in sockets:
+        await manager.disconnect(ws)
+
+
+def history_ids(ws):
+    return sorted(row['id'] for frame in ws.texts for row in frame.get('history', []))
+
+
+@pytest.mark.parametrize('clients', [10, 100])
+def bench_delta_tick(benchmark, loop, sources, clients):
+    manager = main.WebSocketManager()
+    sockets = [FakeWebSocket() for _ in range(clients)]
+    loop.run_until_complete(connect(manager, sockets))
+
+    async def one_tick():
+        sources.add_rows(1)
+        sources.latest['temperature'] += 0.1
+        await tick(manager)
+        await drain(manager)
+
+    benchmark.extra_info['clients'] = clients
+    try:
+        benchmark.pedantic(lambda: loop.run_until_complete(one_tick()), rounds=50, warmup_rounds=1)
+        assert all(writer.seq == sources.rows[-1]['id'] for writer in manager.clients.values())
+    finally:
+        loop.run_until_complete(close(manager, sockets))
+
+
+def bench_snapshot_after_forecast_change(benchmark, loop, sources):
+    # Dự báo đổi mà không có dòng lịch sử mới: client kết nối sau đó phải thấy dự báo mới
+    async def scenario():
+        manager = main.WebSocketManager()
+        first, late = RecordingWebSocket(), RecordingWebSocket()
+        sources.forecast = {'today': {'rain': 0.0}, 'forecast_5days': [{'rain': 1.0}]}
+        await connect(manager, [first])
+        await drain(manager)
+        sources.forecast = {'today': {'rain': 12.5}, 'forecast_5days': [{'rain': 3.0}]}
+        await tick(manager)
+        await connect(manager, [late])
+        await tick(manager)
+        await drain(manager)
+        await close(manager, [first, late])
+        return first, late
+
+    first, late = benchmark.pedantic(lambda: loop.run_until_complete(scenario()), rounds=10)
+    assert first.texts[-1]['today'] == {'rain': 12.5}
+    assert late.texts[0]['type'] == 'snapshot' and late.texts[0]['today'] == {'rain': 12.5}
+    assert late.texts[0]['forecast_5days'] == [{'rain': 3.0}]
+
+
+def bench_connect_during_delta(benchmark, loop, sources):
+    # Client kết nối trong lúc delta chờ API thời tiết vẫn nhận đủ mọi dòng lịch sử
+    async def scenario():
+        manager = main.WebSocketManager()
+        first, late = RecordingWebSocket(), RecordingWebSocket()
+        await connect(manager, [first])
+        sources.add_rows(3)
+        sources.forecast_delay = 0.01
+        pending = asyncio.create_task(tick(manager))
+        await asyncio.sleep(0.005) # delta đã đọc DB, đang chờ dự báo
+        sources.add_rows(1)
+        await connect(manager, [late])
+        await pending
+        sources.forecast_delay = 0.0
+        await tick(manager)
+        await drain(manager)
+        await close(manager, [first, late])
+        return first, late
+
+    first, late = benchmark.pedantic(lambda: loop.run_until_complete(scenario()), rounds=10)
+    assert history_ids(late)[-1] == history_ids(first)[-1]
+    assert set(history_ids(late)) == set(range(1, history_ids(first)[-1] + 1))
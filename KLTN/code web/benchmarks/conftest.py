@@ -0,0 +1,87 @@
+"""Shared fixtures for the offline benchmark suite (pytest-benchmark).
+
+Không cần broker, PostgreSQL hay mạng: DB, WebSocket, MQTT client và API thời tiết đều được thay bằng bản giả.
+    cd benchmarks && python -m pytest                       # lưu JSON vào benchmarks/.benchmarks
+    python -m pytest --benchmark-compare                    # so với lần chạy trước
+    python -m pytest --benchmark-compare=0001 --benchmark-compare-fail=median:15%
+"""
+import asyncio
+import os
+import sys
+
+import pytest
+from starlette.websockets import WebSocketState
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+DATASET = os.path.join(BASE_DIR, '..', 'MACHINE-LEARNING', 'Dataset.csv')
+
+
+def import_main():
+    """Import main from the server directory (it mounts static/ relative to the working directory)"""
+    cwd = os.getcwd()
+    os.chdir(BASE_DIR)
+    try:
+        import main
+    finally:
+        os.chdir(cwd)
+    return main
+
+
+def pytest_addoption(parser):
+    parser.addoption('--models-dir', default=None,
+                     help='directory with crop_model.npz or the .pkl files (default: models/)')
+    parser.addoption('--history-max-rows', type=int, default=1_000_000,
+                     help='skip history benchmarks above this many rows (1M rows needs ~2 GB RAM)')
+
+
+class FakeWebSocket:
+    """Accepts every frame immediately and only counts it"""
+
+    def __init__(self):
+        self.application_state = WebSocketState.CONNECTED
+        self.client = None
+        self.frames = 0
+        self.bytes = 0
+        self.last_text = None
+
+    async def send_text(self, text: str):
+        self.frames += 1
+        self.bytes += len(text)
+        self.last_text = text
+
+    async def close(self, code: int = 1000, reason: str = None):
+        self.application_state = WebSocketState.DISCONNECTED
+
+
+class FakeMQTTClient:
+    """Records device commands instead of publishing them"""
+
+    def __init__(self, devices=()):
+        self.is_connected = True
+        self.device_states = {device: False for device in devices}
+        self.reported_devices = set()
+        self.sent = 0
+
+    def control_device(self, device, status):
+        self.device_states[device] = status
+        self.reported_devices.add(device)
+        self.sent += 1
+        return True
+
+
+@pytest.fixture(scope='module')
+def loop():
+    """One event loop per module, for benchmarks that drive asyncio code from sync rounds"""
+    event_loop = asyncio.new_event_loop()
+    yield event_loop
+    event_loop.run_until_complete(event_loop.shutdown_asyncgens())
+    event_loop.close()
+
+
+@pytest.fixture(scope='session')
+def models_dir(request):
+    from crop_predictor import MODEL_DIR
+    return request.config.getoption('--models-dir') or MODEL_DIR
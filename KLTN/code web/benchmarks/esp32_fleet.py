@@ -0,0 +1,288 @@
+"""Load test: N simulated ESP32 nodes publishing iot/sensor/data, with end-to-end latency seen on /ws.
+
+Mỗi node giả lập làm như firmware ESP32/ESP32.ino: gửi JSON cảm biến (temperature, humidity, nitrogen,
+phosphorus, potassium, ph) mỗi --interval giây, trả lời iot/device/control/# bằng iot/device/status/#,
+iot/device/status_request/# và iot/test. Một client WebSocket nối vào /ws đo thời gian từ lúc publish tới lúc
+server phát lại gói "latest" tương ứng. Dùng broker trong .env (MQTT_BROKER...) hoặc --broker; dữ liệu giả
+được ghi vào PostgreSQL như dữ liệu thật, nên chỉ chạy với DB thử nghiệm.
+    python benchmarks/esp32_fleet.py --nodes 50 --interval 1 --duration 60
+    python benchmarks/esp32_fleet.py --nodes 10 --ramp-step 10 --ramp-every 30 --max-nodes 200 --interval 0.5
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from collections import deque
+
+import aiohttp
+import numpy as np
+from dotenv import load_dotenv
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+load_dotenv() # mqtt_async đọc MQTT_SOCKET_TRANSPORT/MQTT_USE_TLS lúc import
+
+from mqtt_async import MQTT_SOCKET_TRANSPORT, MQTT_USE_TLS, AsyncMQTTTransport  # noqa: E402
+
+SENSOR_TOPIC = 'iot/sensor/data'
+DEVICES = ('light', 'roof', 'pump', 'fan')
+SUBSCRIPTIONS = [('iot/device/control/#', 0), ('iot/device/status_request/#', 0), ('iot/test', 0)]
+# Khoảng giá trị của cảm biến thật (NPK 7 in 1 + DHT), làm tròn 2 chữ số như bản tin firmware
+READING_RANGES = {
+    'temperature': (18.0, 38.0),
+    'humidity': (35.0, 95.0),
+    'nitrogen': (0.0, 140.0),
+    'phosphorus': (5.0, 145.0),
+    'potassium': (5.0, 205.0),
+    'ph': (4.0, 9.0)
+}
+
+
+def reading_key(reading: dict):
+    # Server phát lại nguyên payload trong {"latest": ...} → 6 giá trị đủ để ghép với lần publish
+    try:
+        return tuple(round(float(reading[name]), 2) for name in READING_RANGES)
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class Stats:
+    """Counters and latency samples shared by every node and the WebSocket observer"""
+
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        self.pending = {}            # reading_key -> perf_counter lúc publish
+        self.window = []             # latency (ms) từ lần báo cáo trước
+        self.latencies = deque(maxlen=100_000)
+        self.counters = dict.fromkeys(
+            ('published', 'publish_errors', 'received', 'matched', 'lost', 'control', 'echoes', 'late_ticks'), 0)
+
+    def sent(self, key):
+        self.pending[key] = time.perf_counter()
+        self.counters['published'] += 1
+
+    def seen(self, key):
+        started = self.pending.pop(key, None)
+        if started is None:
+            return
+        latency = (time.perf_counter() - started) * 1000
+        self.counters['matched'] += 1
+        self.window.append(latency)
+        self.latencies.append(latency)
+
+    def expire(self):
+        deadline = time.perf_counter() - self.timeout
+        expired = [key for key, started in self.pending.items() if started < deadline]
+        for key in expired:
+            del self.pending[key]
+        self.counters['lost'] += len(expired)
+
+    def take_window(self):
+        window, self.window = self.window, []
+        return window
+
+
+class VirtualNode:
+    """One simulated ESP32: sensor publisher plus the firmware's MQTT callback"""
+
+    def __init__(self, index: int, args, stats: Stats):
+        self.index = index
+        self.args = args
+        self.stats = stats
+        self.device_id = f"ESP32Sim-{index}"
+        self.device_states = dict.fromkeys(DEVICES, False)
+        self.random = random.Random(f"{args.seed}-{index}")
+        self.transport = AsyncMQTTTransport(
+            client_id=f"ESP32Sim_{args.run_id}_{index}",
+            transport=args.transport,
+            use_tls=args.tls,
+            tls_insecure=True,
+            username=args.username,
+            password=args.password
+        )
+
+    async def connect(self):
+        await self.transport.connect(self.args.broker, self.args.port, timeout=self.args.connect_timeout)
+        await self.transport.subscribe(SUBSCRIPTIONS)
+        self.publish_all_statuses()
+
+    def publish(self, topic, payload: dict):
+        try:
+            self.transport.publish_nowait(topic, json.dumps(payload), qos=self.args.qos)
+        except ConnectionError:
+            self.stats.counters['publish_errors'] += 1
+
+    def publish_all_statuses(self): # publishAllDeviceStatuses() của firmware
+        for device, status in self.device_states.items():
+            self.publish(f"iot/device/status/{device}", {'status': status})
+            self.stats.counters['echoes'] += 1
+
+    def read_sensors(self) -> dict:
+        return {name: round(self.random.uniform(low, high), 2) for name, (low, high) in READING_RANGES.items()}
+
+    async def publish_loop(self):
+        # Lệch pha ngẫu nhiên để N node không publish cùng một lúc
+        await asyncio.sleep(self.random.uniform(0, self.args.interval))
+        next_at = time.perf_counter()
+        while True:
+            reading = self.read_sensors()
+            self.stats.sent(reading_key(reading))
+            self.publish(SENSOR_TOPIC, reading)
+            next_at += self.args.interval
+            delay = next_at - time.perf_counter()
+            if delay < 0:
+                # Không theo kịp nhịp: bỏ các mốc đã lỡ thay vì bắn dồn
+                self.stats.counters['late_ticks'] += 1
+                next_at = time.perf_counter()
+                delay = 0
+            await asyncio.sleep(delay)
+
+    async def handle_messages(self): # mqttCallback() của firmware
+        async for topic, raw in self.transport.messages():
+            try:
+                payload = json.loads(raw)
+            except ValueError:
+                continue # "JSON Fail"
+            device = topic.rsplit('/', 1)[-1]
+            if topic == 'iot/test':
+                self.publish('iot/test_response', {'type': 'connection_response', 'clientId': payload.get('clientId'),
+                                                   'deviceId': self.device_id, 'status': 'connected'})
+            elif topic.startswith('iot/device/status_request/'):
+                self.publish(f"iot/device/status_response/{device}", {'status': self.device_states.get(device, False)})
+            elif topic.startswith('iot/device/control/'):
+                self.stats.counters['control'] += 1
+                if device in self.device_states:
+                    self.device_states[device] = bool(payload.get('status'))
+                self.publish_all_statuses()
+
+    async def run(self):
+        await asyncio.gather(self.publish_loop(), self.handle_messages())
+
+    async def close(self):
+        try:
+            await self.transport.disconnect()
+        except Exception:
+            pass
+
+
+async def observe_websocket(session, ws_url, stats: Stats):
+    """Count every frame from /ws and match "latest" payloads to their publish time"""
+    while True:
+        try:
+            async with session.ws_connect(ws_url, heartbeat=30) as ws:
+                async for msg in ws:
+                    if msg.type != aiohttp.WSMsgType.TEXT:
+                        continue
+                    stats.counters['received'] += 1
+                    data = json.loads(msg.data)
+                    latest = data.get('latest') if isinstance(data, dict) else None
+                    if isinstance(latest, dict):
+                        stats.seen(reading_key(latest))
+        except aiohttp.ClientError as e:
+            print(f"⚠️ WebSocket {ws_url}: {e}, thử lại sau 1s")
+        await asyncio.sleep(1)
+
+
+def percentiles(samples) -> str:
+    if not len(samples):
+        return 'latency: -'
+    values = np.fromiter(samples, dtype=float)
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return f"latency (ms): p50={p50:.1f} p95={p95:.1f} p99={p99:.1f} max={values.max():.1f}"
+
+
+async def start_nodes(indexes, args, stats, nodes, tasks):
+    semaphore = asyncio.Semaphore(args.connect_concurrency)
+
+    async def start(index):
+        node = VirtualNode(index, args, stats)
+        async with semaphore:
+            try:
+                await node.connect()
+            except (ConnectionError, asyncio.TimeoutError) as e:
+                print(f"❌ Node {index} không kết nối được: {e}")
+                return
+        nodes.append(node)
+        tasks.append(asyncio.create_task(node.run()))
+    await asyncio.gather(*(start(index) for index in indexes))
+
+
+async def run(args):
+    stats = Stats(args.timeout)
+    nodes, tasks = [], []
+    async with aiohttp.ClientSession() as session:
+        observer = asyncio.create_task(observe_websocket(session, args.ws_url, stats))
+        await start_nodes(range(args.nodes), args, stats, nodes, tasks)
+        print(f"✅ {len(nodes)} node đã kết nối {args.broker}:{args.port}, mỗi node gửi 1 bản tin/{args.interval}s")
+
+        started = last_report = last_ramp = time.perf_counter()
+        next_index = args.nodes
+        stop_at = started + args.duration
+        last = dict(stats.counters)
+        try:
+            while time.perf_counter() < stop_at:
+                await asyncio.sleep(args.report_every)
+                now = time.perf_counter()
+                stats.expire()
+                elapsed, last_report = now - last_report, now
+                counters = dict(stats.counters)
+                rate = {key: (counters[key] - last[key]) / elapsed for key in ('published', 'matched', 'received')}
+                last = counters
+                print(f"[{now - started:6.0f}s] {len(nodes):4d} node  gửi {rate['published']:7.1f}/s  "
+                      f"khớp qua /ws {rate['matched']:7.1f}/s  frame /ws {rate['received']:7.1f}/s  "
+                      f"{percentiles(stats.take_window())}  mất {counters['lost']}  trễ nhịp {counters['late_ticks']}")
+                if args.ramp_step and now - last_ramp >= args.ramp_every and len(nodes) < args.max_nodes:
+                    last_ramp = now
+                    count = min(args.ramp_step, args.max_nodes - len(nodes))
+                    await start_nodes(range(next_index, next_index + count), args, stats, nodes, tasks)
+                    next_index += count
+                    print(f"⬆️ Tăng lên {len(nodes)} node")
+        finally:
+            for task in (*tasks, observer):
+                task.cancel()
+            await asyncio.gather(*tasks, observer, return_exceptions=True)
+            await asyncio.gather(*(node.close() for node in nodes))
+
+    stats.counters['lost'] += len(stats.pending) # chưa tới /ws khi dừng
+    total = time.perf_counter() - started
+    counters = stats.counters
+    print(f"\nTổng {total:.0f}s, tối đa {len(nodes)} node: gửi {counters['published']} "
+          f"({counters['published'] / total:.1f}/s), lỗi publish {counters['publish_errors']}, "
+          f"khớp qua /ws {counters['matched']} ({counters['matched'] / total:.1f}/s), mất {counters['lost']}")
+    print(f"Lệnh điều khiển nhận {counters['control']}, bản tin trạng thái đã trả {counters['echoes']}")
+    print(percentiles(stats.latencies))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--nodes', type=int, default=10)
+    parser.add_argument('--interval', type=float, default=5.0,
+                        help='seconds between sensor messages per node (UPDATE_INTERVAL of the firmware = 5)')
+    parser.add_argument('--duration', type=float, default=60.0, help='seconds')
+    parser.add_argument('--ramp-step', type=int, default=0, help='nodes added every --ramp-every seconds (0 = fixed)')
+    parser.add_argument('--ramp-every', type=float, default=30.0)
+    parser.add_argument('--max-nodes', type=int, default=500)
+    parser.add_argument('--broker', default=os.getenv('MQTT_BROKER', 'localhost'))
+    parser.add_argument('--port', type=int, default=int(os.getenv('MQTT_PORT', 8884)))
+    parser.add_argument('--username', default=os.getenv('MQTT_USERNAME'))
+    parser.add_argument('--password', default=os.getenv('MQTT_PASSWORD'))
+    parser.add_argument('--transport', default=MQTT_SOCKET_TRANSPORT, choices=['websockets', 'tcp'])
+    parser.add_argument('--tls', action=argparse.BooleanOptionalAction, default=MQTT_USE_TLS)
+    parser.add_argument('--qos', type=int, default=0, choices=[0, 1], help='PubSubClient on the ESP32 publishes QoS 0')
+    # Giao thức 1: mỗi bản tin được phát lại đủ 6 giá trị (giao thức 2 chỉ gửi các trường đã đổi)
+    parser.add_argument('--ws-url', default='ws://localhost:8000/ws?protocol=1')
+    parser.add_argument('--timeout', type=float, default=30.0,
+                        help='a message not seen on /ws after this many seconds counts as lost')
+    parser.add_argument('--report-every', type=float, default=5.0)
+    parser.add_argument('--connect-concurrency', type=int, default=20)
+    parser.add_argument('--connect-timeout', type=float, default=30.0)
+    parser.add_argument('--seed', default='fleet')
+    args = parser.parse_args()
+    args.run_id = f"{int(time.time())}{random.randint(100, 999)}"
+    asyncio.run(run(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""Minimal in-process MQTT 3.1.1 broker over plain TCP, for testing AsyncMQTTTransport without a real broker.
+
+Chỉ hỗ trợ đủ cho transport: CONNECT/CONNACK, PUBLISH QoS 0/1 (PUBACK), SUBSCRIBE/SUBACK với + và #,
+PINGREQ/PINGRESP, DISCONNECT. Message được chuyển tới subscriber ở QoS 0, không giữ retained/session.
+"""
+import asyncio
+import struct
+
+CONNECT, CONNACK, PUBLISH, PUBACK, SUBSCRIBE, SUBACK = 1, 2, 3, 4, 8, 9
+PINGREQ, PINGRESP, DISCONNECT = 12, 13, 14
+
+
+def topic_matches(pattern: str, topic: str) -> bool:
+    """MQTT topic filter match (+ = one level, # = the rest)"""
+    levels = topic.split('/')
+    for i, part in enumerate(pattern.split('/')):
+        if part == '#':
+            return True
+        if i >= len(levels) or part not in ('+', levels[i]):
+            return False
+    return len(pattern.split('/')) == len(levels)
+
+
+def _packet(kind: int, flags: int, body: bytes) -> bytes:
+    length, encoded = len(body), bytearray()
+    while True:
+        length, digit = divmod(length, 128)
+        encoded.append(digit | (0x80 if length else 0))
+        if not length:
+            break
+    return bytes([kind << 4 | flags]) + bytes(encoded) + body
+
+
+def _string(data: bytes, offset: int):
+    size = struct.unpack_from('!H', data, offset)[0]
+    return data[offset + 2: offset + 2 + size].decode(), offset + 2 + size
+
+
+class FakeBroker:
+    """Accepts any client on 127.0.0.1 and routes PUBLISH packets to matching subscribers"""
+
+    def __init__(self):
+        self.server = None
+        self.port = None
+        self.sessions = {}          # writer -> [topic filter]
+        self.published = []         # (topic, payload) mọi PUBLISH nhận được
+        self.connects = 0
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._serve, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        self.drop_all()
+        self.server.close()
+        await self.server.wait_closed()
+
+    def drop_all(self):
+        """Close every client connection without DISCONNECT, like a broker restart"""
+        for writer in list(self.sessions):
+            writer.close()
+        self.sessions.clear()
+
+    async def _read_packet(self, reader):
+        header = await reader.readexactly(1)
+        length, multiplier = 0, 1
+        while True:
+            digit = (await reader.readexactly(1))[0]
+            length += (digit & 0x7F) * multiplier
+            multiplier *= 128
+            if not digit & 0x80:
+                break
+        return header[0] >> 4, header[0] & 0x0F, await reader.readexactly(length)
+
+    async def _serve(self, reader, writer):
+        self.sessions[writer] = []
+        try:
+            while True:
+                kind, flags, body = await self._read_packet(reader)
+                if kind == CONNECT:
+                    self.connects += 1
+                    writer.write(_packet(CONNACK, 0, b'\x00\x00'))
+                elif kind == PUBLISH:
+                    self._publish(writer, flags, body)
+                elif kind == SUBSCRIBE:
+                    mid, offset, granted = body[:2], 2, bytearray()
+                    while offset < len(body):
+                        pattern, offset = _string(body, offset)
+                        granted.append(body[offset])
+                        offset += 1
+                        self.sessions.setdefault(writer, []).append(pattern)
+                    writer.write(_packet(SUBACK, 0, mid + bytes(granted)))
+                elif kind == PINGREQ:
+                    writer.write(_packet(PINGRESP, 0, b''))
+                elif kind == DISCONNECT:
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.sessions.pop(writer, None)
+            writer.close()
+
+    def _publish(self, sender, flags, body):
+        qos = (flags >> 1) & 0x03
+        topic, offset = _string(body, 0)
+        if qos:
+            sender.write(_packet(PUBACK, 0, body[offset: offset + 2]))
+            offset += 2
+        payload = body[offset:]
+        self.published.append((topic, payload))
+        packet = _packet(PUBLISH, 0, struct.pack('!H', len(topic.encode())) + topic.encode() + payload)
+        for writer, patterns in list(self.sessions.items()):
+            if any(topic_matches(pattern, topic) for pattern in patterns):
+                writer.write(packet)
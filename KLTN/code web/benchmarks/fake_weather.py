@@ -0,0 +1,76 @@
+"""Local fake OpenWeather / open-meteo HTTP server for testing weather.py through real HTTP requests.
+
+Chạy aiohttp trong thread riêng với event loop riêng, nên cả fetch async (aiohttp) lẫn fetch blocking
+(requests, get_sync) đều gọi được. Trỏ weather.OPENWEATHER_URL / weather.OPEN_METEO_URL vào `url(...)`.
+"""
+import asyncio
+import threading
+from collections import Counter
+
+from aiohttp import web
+
+
+class FakeWeatherServer:
+    """Serves /forecast (OpenWeather) and /v1/forecast (open-meteo) with a settable status and delay"""
+
+    def __init__(self, forecast: dict, precipitation=(1.5, 2.0)):
+        self.forecast = forecast
+        self.precipitation = list(precipitation)
+        self.status = 200
+        self.delay = 0.0
+        self.requests = Counter()   # path -> số request đã nhận
+        self.port = None
+        self._loop = asyncio.new_event_loop()
+        self._thread = None
+        self._runner = None
+
+    def url(self, path: str) -> str:
+        return f"http://127.0.0.1:{self.port}{path}"
+
+    def start(self):
+        started = threading.Event()
+        self._thread = threading.Thread(target=self._serve, args=(started,), daemon=True)
+        self._thread.start()
+        started.wait(5)
+        return self
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop).result(5)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(5)
+        self._loop.close()
+
+    async def _shutdown(self):
+        await self._runner.cleanup()
+        # Request còn đang "trễ" (delay) khi client đã bỏ đi → hủy để loop đóng sạch
+        pending = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+    def _serve(self, started):
+        asyncio.set_event_loop(self._loop)
+        app = web.Application()
+        app.router.add_get('/forecast', self._openweather)
+        app.router.add_get('/v1/forecast', self._open_meteo)
+        self._runner = web.AppRunner(app)
+        self._loop.run_until_complete(self._runner.setup())
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        self._loop.run_until_complete(site.start())
+        self.port = site._server.sockets[0].getsockname()[1]
+        started.set()
+        self._loop.run_forever()
+
+    async def _respond(self, request, body):
+        self.requests[request.path] += 1
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        if self.status != 200:
+            return web.Response(status=self.status, text='upstream error')
+        return web.json_response(body)
+
+    async def _openweather(self, request):
+        return await self._respond(request, self.forecast)
+
+    async def _open_meteo(self, request):
+        return await self._respond(request, {'daily': {'precipitation_sum': self.precipitation}})
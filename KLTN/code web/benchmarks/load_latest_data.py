@@ -0,0 +1,70 @@
+"""Load test: p99 latency of /latest-data while /history is being hammered.
+
+Chạy server trước (uvicorn main:app), sau đó:
+    python benchmarks/load_latest_data.py --base-url http://localhost:8000 --duration 30
+"""
+import argparse
+import asyncio
+import time
+
+import aiohttp
+import numpy as np
+
+
+async def hammer_history(session, base_url, stop_at, counters):
+    while time.perf_counter() < stop_at:
+        try:
+            async with session.get(f"{base_url}/history") as response:
+                await response.read()
+                counters['history_ok' if response.status == 200 else 'history_err'] += 1
+        except aiohttp.ClientError:
+            counters['history_err'] += 1
+
+
+async def probe_latest(session, base_url, stop_at, interval, latencies, counters):
+    while time.perf_counter() < stop_at:
+        started = time.perf_counter()
+        try:
+            async with session.get(f"{base_url}/latest-data") as response:
+                await response.read()
+                counters['latest_ok' if response.status == 200 else 'latest_err'] += 1
+        except aiohttp.ClientError:
+            counters['latest_err'] += 1
+        latencies.append((time.perf_counter() - started) * 1000)
+        await asyncio.sleep(interval)
+
+
+async def run(args):
+    counters = {'history_ok': 0, 'history_err': 0, 'latest_ok': 0, 'latest_err': 0}
+    latencies = []
+    connector = aiohttp.TCPConnector(limit=args.history_concurrency + 4)
+    timeout = aiohttp.ClientTimeout(total=args.request_timeout)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        stop_at = time.perf_counter() + args.duration
+        workers = [hammer_history(session, args.base_url, stop_at, counters)
+                   for _ in range(args.history_concurrency)]
+        workers.append(probe_latest(session, args.base_url, stop_at, args.probe_interval, latencies, counters))
+        await asyncio.gather(*workers)
+
+    print(f"/history: {counters['history_ok']} ok, {counters['history_err']} lỗi "
+          f"({args.history_concurrency} luồng song song, {args.duration}s)")
+    print(f"/latest-data: {counters['latest_ok']} ok, {counters['latest_err']} lỗi")
+    if latencies:
+        samples = np.array(latencies)
+        print(f"/latest-data latency (ms): p50={np.percentile(samples, 50):.1f} "
+              f"p95={np.percentile(samples, 95):.1f} p99={np.percentile(samples, 99):.1f} "
+              f"max={samples.max():.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--base-url', default='http://localhost:8000')
+    parser.add_argument('--duration', type=float, default=30.0, help='seconds')
+    parser.add_argument('--history-concurrency', type=int, default=20)
+    parser.add_argument('--probe-interval', type=float, default=0.05, help='seconds between /latest-data probes')
+    parser.add_argument('--request-timeout', type=float, default=30.0)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""Benchmark: cold start (import + load + first prediction) and RSS, .pkl models vs. compiled NumPy model.
+
+Mỗi lần đo chạy trong một process Python mới; cần models/*.pkl và models/crop_model.npz (export_model.py):
+    python benchmarks/model_startup.py --runs 5
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = r'''
+import json, os, resource, sys, time
+started = time.perf_counter()
+sys.path.insert(0, {base!r})
+from crop_predictor import COMPILED_MODEL_FILE, MODEL_FILES, load_predictor
+files, compiled = MODEL_FILES, COMPILED_MODEL_FILE
+if {models_dir!r}:
+    files = {{k: os.path.join({models_dir!r}, os.path.basename(v)) for k, v in MODEL_FILES.items()}}
+    compiled = os.path.join({models_dir!r}, os.path.basename(COMPILED_MODEL_FILE))
+predictor = load_predictor(files, compiled, {model_format!r})
+loaded = time.perf_counter()
+label = predictor.predict({{'N': 90, 'P': 42, 'K': 43, 'temperature': 20.88, 'humidity': 82.0, 'ph': 6.5, 'rainfall': 202.94}})
+done = time.perf_counter()
+print(json.dumps({{
+    'load_s': loaded - started,
+    'first_predict_ms': (done - loaded) * 1000,
+    'rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    'label': label,
+    'heavy_modules': sorted(m for m in ('pandas', 'sklearn', 'lightgbm', 'joblib', 'scipy') if m in sys.modules)
+}}))
+'''
+
+
+def measure(model_format, models_dir):
+    code = CHILD.format(base=BASE_DIR, models_dir=models_dir or '', model_format=model_format)
+    output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--models-dir', default=None, help='directory with the .pkl files and crop_model.npz')
+    args = parser.parse_args()
+
+    for model_format in ('pickle', 'compiled'):
+        runs = [measure(model_format, args.models_dir) for _ in range(args.runs)]
+        print(f"{model_format:<9} import+load {statistics.median(r['load_s'] for r in runs):.2f}s  "
+              f"dự đoán đầu {statistics.median(r['first_predict_ms'] for r in runs):.1f}ms  "
+              f"RSS {statistics.median(r['rss_mb'] for r in runs):.0f}MB  "
+              f"→ {runs[0]['label']}  (module nặng: {', '.join(runs[0]['heavy_modules']) or 'không'})")
+
+
+if __name__ == '__main__':
+    main()
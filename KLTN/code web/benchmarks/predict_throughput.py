@@ -0,0 +1,77 @@
+"""Benchmark: crop prediction throughput, one-row DataFrame path vs. CropPredictor single/batch/cached.
+
+Dùng các dòng của Dataset.csv làm đầu vào; cần models/*.pkl (hoặc --models-dir), thêm crop_model.npz nếu đã export:
+    python benchmarks/predict_throughput.py --rows 2000
+"""
+import argparse
+import os
+import sys
+import time
+
+import pandas as pd
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+from compiled_model import CompiledCropPredictor  # noqa: E402
+from crop_predictor import COMPILED_MODEL_FILE, FEATURES, MODEL_FILES, CropPredictor, load_pickled_models  # noqa: E402
+
+DATASET = os.path.join(BASE_DIR, '..', 'MACHINE-LEARNING', 'Dataset.csv')
+
+
+def timed(label, rows, func):
+    started = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - started
+    print(f"{label:<38} {elapsed * 1000:9.1f} ms  {rows / elapsed:11.0f} dòng/s")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=2000)
+    parser.add_argument('--models-dir', default=None, help='directory with the three .pkl files')
+    parser.add_argument('--dataset', default=DATASET)
+    args = parser.parse_args()
+
+    files, compiled_file = MODEL_FILES, COMPILED_MODEL_FILE
+    if args.models_dir:
+        files = {name: os.path.join(args.models_dir, os.path.basename(path)) for name, path in MODEL_FILES.items()}
+        compiled_file = os.path.join(args.models_dir, os.path.basename(COMPILED_MODEL_FILE))
+    loaded = load_pickled_models(files)
+    if loaded is None:
+        sys.exit("Không tải được model")
+    model, scaler, label_encoder = loaded['model'], loaded['scaler'], loaded['label_encoder']
+
+    frame = pd.read_csv(args.dataset)[FEATURES].round(2)
+    frame = pd.concat([frame] * (args.rows // len(frame) + 1), ignore_index=True).iloc[:args.rows]
+    records = frame.to_dict('records')
+    rows = frame.to_numpy()
+    n = len(records)
+    print(f"{n} dòng, {frame.drop_duplicates().shape[0]} dòng khác nhau\n")
+
+    def legacy():
+        # Cách cũ của /predict và !predict: DataFrame 1 dòng + scaler.transform + model.predict mỗi request
+        return [label_encoder.inverse_transform(model.predict(scaler.transform(pd.DataFrame([record]))))[0]
+                for record in records]
+
+    uncached = CropPredictor(model, scaler, label_encoder, cache_size=0)
+    cached = CropPredictor(model, scaler, label_encoder)
+
+    expected = timed("DataFrame 1 dòng / lần (cũ)", n, legacy)
+    single = timed("CropPredictor.predict, không cache", n, lambda: [uncached.predict(r) for r in records])
+    batch = timed("CropPredictor.predict_array, 1 batch", n, lambda: uncached.predict_array(rows))
+    timed("predict, cache nguội", n, lambda: [cached.predict(r) for r in records])
+    warm = timed("predict, cache nóng", n, lambda: [cached.predict(r) for r in records])
+
+    assert list(expected) == single == batch == warm, "Kết quả dự đoán khác nhau"
+    if os.path.exists(compiled_file):
+        compiled = CompiledCropPredictor.load(compiled_file, cache_size=0)
+        compiled_single = timed("CompiledCropPredictor.predict", n, lambda: [compiled.predict(r) for r in records])
+        compiled_batch = timed("CompiledCropPredictor, 1 batch", n, lambda: compiled.predict_array(rows))
+        assert single == compiled_single == compiled_batch, "Model biên dịch cho kết quả khác"
+    print(f"\nKết quả giống hệt nhau; cache: {cached.stats()}")
+
+
+if __name__ == '__main__':
+    main()
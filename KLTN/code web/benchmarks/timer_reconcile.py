@@ -0,0 +1,116 @@
+"""Benchmark: startup catch-up reconciliation over thousands of timer schedules.
+
+Không cần broker/DB; tạo store tạm với nhiều thiết bị (slot theo ngày, cron, sự kiện, hẹn giờ một lần):
+    python benchmarks/timer_reconcile.py --devices 2000 --slots 3 --events 2
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from device_timer import DeviceTimer, vn_tz  # noqa: E402
+from timer_store import TimerStore  # noqa: E402
+
+
+class FakeMQTTClient:
+    """Chỉ ghi nhận lệnh, không gửi đi đâu"""
+
+    def __init__(self, devices):
+        self.is_connected = True
+        self.device_states = {device: False for device in devices}
+        self.reported_devices = set(devices) # như thể mọi ESP32 đã báo trạng thái TẮT
+        self.sent = 0
+
+    def control_device(self, device, status):
+        self.device_states[device] = status
+        self.sent += 1
+        return True
+
+
+def build_store(path, args, now):
+    rng = random.Random(args.seed)
+    store = TimerStore(path, compact_every=10 ** 9)
+    days = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+    for i in range(args.devices):
+        device = f"device-{i}"
+        kind = i % 4
+        if kind == 3:
+            # Hẹn giờ một lần, một nửa đã hết hạn trong lúc server tắt
+            on_dt = now + timedelta(minutes=rng.randint(-600, 600))
+            off_dt = on_dt + timedelta(minutes=rng.randint(5, 120))
+            store.state['timers'][device] = {'on_datetime': on_dt.isoformat(), 'off_datetime': off_dt.isoformat(),
+                                             'daily': False, 'enabled': True}
+        else:
+            slots = []
+            for _ in range(args.slots):
+                if kind == 2:
+                    slots.append({'cron_on': f"{rng.randint(0, 59)} {rng.randint(0, 23)} * * 1-5",
+                                  'cron_off': f"{rng.randint(0, 59)} {rng.randint(0, 23)} * * 1-5"})
+                else:
+                    slots.append({'on': f"{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}",
+                                  'off': f"{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}",
+                                  'days': rng.sample(days, rng.randint(1, 7)) if kind == 1 else []})
+            store.state['timers'][device] = {'slots': slots, 'enabled': True}
+        if args.events:
+            store.state['events'][device] = [
+                {'time': f"{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}", 'status': bool(j % 2)}
+                for j in range(args.events)
+            ]
+    store.compact()
+
+
+async def run(args):
+    now = datetime.now(vn_tz)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'device_timers.json')
+        build_store(path, args, now)
+        devices = [f"device-{i}" for i in range(args.devices)]
+        schedules = args.devices * (args.slots * 2 + args.events)
+
+        client = FakeMQTTClient(devices)
+        log = io.StringIO() # log từng lệnh của DeviceTimer làm sai số đo
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(log):
+            timer = DeviceTimer(client, TimerStore(path))
+        load_ms = (time.perf_counter() - started) * 1000
+
+        timings = []
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            plan = timer.desired_states(now)
+            timings.append((time.perf_counter() - started) * 1000)
+
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(log):
+            changes = await timer.reconcile()
+            reconcile_ms = (time.perf_counter() - started) * 1000
+            await timer.stop()
+
+    best = min(timings)
+    print(f"{args.devices} thiết bị, ~{schedules} lịch bật/tắt")
+    print(f"load_timers (đọc file + lên lịch + tính kế hoạch bù): {load_ms:.1f} ms")
+    print(f"desired_states: best {best:.1f} ms, trung bình {sum(timings) / len(timings):.1f} ms "
+          f"({best * 1000 / max(schedules, 1):.1f} µs/lịch), {len(plan)} thiết bị trong grace")
+    print(f"reconcile: {len(changes)} lệnh bù, {client.sent} publish, {reconcile_ms:.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--devices', type=int, default=2000)
+    parser.add_argument('--slots', type=int, default=3, help='slots per device (each = ON + OFF schedule)')
+    parser.add_argument('--events', type=int, default=2, help='daily events per device')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=1)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
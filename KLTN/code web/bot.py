@@ -14,11 +14,11 @@ import paho.mqtt.client as mqtt # để publish/subscribe MQTT
 import ssl
 import requests # để gọi OpenRouter API & Open-Meteo
 import numpy as np
-import pandas as pd
-import joblib # để load model ML
-from sklearn.exceptions import InconsistentVersionWarning # để load model ML
-import warnings
-warnings.filterwarnings("ignore", category=InconsistentVersionWarning)
+from crop_predictor import PREDICT_TOP_K # số cây xếp hạng mặc định của !predict (dùng chung với main.py)
+from model_registry import model_registry # model dự đoán cây trồng, tải khi dùng lần đầu (dùng chung với main.py)
+from crop_requirements import crop_requirements # ngưỡng lý tưởng của từng loại cây (dùng chung với main.py)
+from weather import get_last_month_rainfall # lượng mưa tháng trước (có cache, dùng chung với main.py)
+from mqtt_async import AsyncMQTTTransport, MQTT_TRANSPORT, MQTT_SOCKET_TRANSPORT, MQTT_USE_TLS # MQTT chạy trên event loop của bot
 # Cấu hình logging
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -87,202 +87,6 @@ CROP_TRANSLATIONS = {
     'apple': 'Táo', 'orange': 'Cam', 'papaya': 'Đu đủ', 'coconut': 'Dừa', 'cotton': 'Bông',
     'jute': 'Đay', 'coffee': 'Cà phê'
 }
-# Phần ML & tham số cây trồng
-MODEL_FILES = {
-    'model': 'models/lgbm_crop_model.pkl',
-    'scaler': 'models/scaler.pkl',
-    'label_encoder': 'models/label_encoder.pkl'
-}
-try:
-    model = joblib.load(MODEL_FILES['model'])
-    scaler = joblib.load(MODEL_FILES['scaler'])
-    label_encoder = joblib.load(MODEL_FILES['label_encoder'])
-    print("✅ Đã tải models thành công")
-except Exception as e:
-    print(f"❌ Lỗi khi tải models: {e}")
-    model = None
-    scaler = None
-    label_encoder = None
-# chứa ngưỡng lý tưởng cho từng loại cây
-CROP_PARAMETERS = {
-    'rice': {
-        'temperature': {'min': 20, 'max': 27},
-        'humidity': {'min': 80, 'max': 85},
-        'nitrogen': {'min': 60, 'max': 99},
-        'phosphorus': {'min': 35, 'max': 60},
-        'potassium': {'min': 35, 'max': 45},
-        'ph': {'min': 5.0, 'max': 7.8}
-    },
-    'maize': {
-        'temperature': {'min': 18, 'max': 26},
-        'humidity': {'min': 55, 'max': 74},
-        'nitrogen': {'min': 60, 'max': 100},
-        'phosphorus': {'min': 35, 'max': 60},
-        'potassium': {'min': 15, 'max': 25},
-        'ph': {'min': 5.5, 'max': 7.0}
-    },
-    'chickpea': {
-        'temperature': {'min': 17, 'max': 21},
-        'humidity': {'min': 14, 'max': 20},
-        'nitrogen': {'min': 20, 'max': 60},
-        'phosphorus': {'min': 55, 'max': 80},
-        'potassium': {'min': 75, 'max': 85},
-        'ph': {'min': 6.0, 'max': 8.9}
-    },
-    'kidneybeans': {
-        'temperature': {'min': 15, 'max': 24},
-        'humidity': {'min': 18, 'max': 25},
-        'nitrogen': {'min': 0, 'max': 40},
-        'phosphorus': {'min': 55, 'max': 80},
-        'potassium': {'min': 15, 'max': 25},
-        'ph': {'min': 5.5, 'max': 6.0}
-    },
-    'pigeonpeas': {
-        'temperature': {'min': 18, 'max': 39},
-        'humidity': {'min': 14, 'max': 35},
-        'nitrogen': {'min': 0, 'max': 40},
-        'phosphorus': {'min': 55, 'max': 80},
-        'potassium': {'min': 15, 'max': 25},
-        'ph': {'min': 4.0, 'max': 8.8}
-    },
-    'mothbeans': {
-        'temperature': {'min': 24, 'max': 32},
-        'humidity': {'min': 25, 'max': 35},
-        'nitrogen': {'min': 0, 'max': 40},
-        'phosphorus': {'min': 35, 'max': 60},
-        'potassium': {'min': 15, 'max': 25},
-        'ph': {'min': 3.5, 'max': 9.0}
-    },
-    'mungbean': {
-        'temperature': {'min': 27, 'max': 30},
-        'humidity': {'min': 80, 'max': 90},
-        'nitrogen': {'min': 0, 'max': 40},
-        'phosphorus': {'min': 35, 'max': 60},
-        'potassium': {'min': 15, 'max': 25},
-        'ph': {'min': 6.2, 'max': 7.6}
-    },
-    'blackgram': {
-        'temperature': {'min': 26, 'max': 32},
-        'humidity': {'min': 60, 'max': 70},
-        'nitrogen': {'min': 0, 'max': 40},
-        'phosphorus': {'min': 55, 'max': 80},
-        'potassium': {'min': 15, 'max': 25},
-        'ph': {'min': 4.9, 'max': 7.6}
-    },
-    'lentil': {
-        'temperature': {'min': 18, 'max': 27},
-        'humidity': {'min': 60, 'max': 70},
-        'nitrogen': {'min': 0, 'max': 40},
-        'phosphorus': {'min': 55, 'max': 80},
-        'potassium': {'min': 15, 'max': 25},
-        'ph': {'min': 5.8, 'max': 7.8}
-    },
-    'pomegranate': {
-        'temperature': {'min': 18, 'max': 24},
-        'humidity': {'min': 85, 'max': 95},
-        'nitrogen': {'min': 0, 'max': 40},
-        'phosphorus': {'min': 5, 'max': 30},
-        'potassium': {'min': 35, 'max': 45},
-        'ph': {'min': 5.4, 'max': 7.8}
-    },
-    'banana': {
-        'temperature': {'min': 25, 'max': 30},
-        'humidity': {'min': 75, 'max': 85},
-        'nitrogen': {'min': 80, 'max': 120},
-        'phosphorus': {'min': 5, 'max': 30},
-        'potassium': {'min': 45, 'max': 55},
-        'ph': {'min': 5.0, 'max': 7.0}
-    },
-    'mango': {
-        'temperature': {'min': 27, 'max': 35},
-        'humidity': {'min': 45, 'max': 55},
-        'nitrogen': {'min': 0, 'max': 40},
-        'phosphorus': {'min': 15, 'max': 40},
-        'potassium': {'min': 25, 'max': 35},
-        'ph': {'min': 4.3, 'max': 7.6}
-    },
-    'grapes': {
-        'temperature': {'min': 8, 'max': 32},
-        'humidity': {'min': 80, 'max': 85},
-        'nitrogen': {'min': 0, 'max': 40},
-        'phosphorus': {'min': 120, 'max': 145},
-        'potassium': {'min': 195, 'max': 205},
-        'ph': {'min': 5.5, 'max': 7.0}
-    },
-    'watermelon': {
-        'temperature': {'min': 24, 'max': 27},
-        'humidity': {'min': 80, 'max': 90},
-        'nitrogen': {'min': 80, 'max': 120},
-        'phosphorus': {'min': 5, 'max': 30},
-        'potassium': {'min': 5, 'max': 15},
-        'ph': {'min': 6.0, 'max': 6.8}
-    },
-    'muskmelon': {
-        'temperature': {'min': 27, 'max': 29},
-        'humidity': {'min': 90, 'max': 95},
-        'nitrogen': {'min': 80, 'max': 120},
-        'phosphorus': {'min': 5, 'max': 30},
-        'potassium': {'min': 5, 'max': 15},
-        'ph': {'min': 6.0, 'max': 6.8}
-    },
-    'apple': {
-        'temperature': {'min': 21, 'max': 24},
-        'humidity': {'min': 85, 'max': 95},
-        'nitrogen': {'min': 0, 'max': 40},
-        'phosphorus': {'min': 120, 'max': 145},
-        'potassium': {'min': 195, 'max': 205},
-        'ph': {'min': 5.5, 'max': 7.0}
-    },
-    'orange': {
-        'temperature': {'min': 10, 'max': 34},
-        'humidity': {'min': 85, 'max': 95},
-        'nitrogen': {'min': 0, 'max': 40},
-        'phosphorus': {'min': 5, 'max': 30},
-        'potassium': {'min': 5, 'max': 15},
-        'ph': {'min': 4.0, 'max': 9.0}
-    },
-    'papaya': {
-        'temperature': {'min': 23, 'max': 44},
-        'humidity': {'min': 85, 'max': 95},
-        'nitrogen': {'min': 40, 'max': 80},
-        'phosphorus': {'min': 5, 'max': 60},
-        'potassium': {'min': 45, 'max': 55},
-        'ph': {'min': 4.3, 'max': 7.6}
-    },
-    'coconut': {
-        'temperature': {'min': 25, 'max': 30},
-        'humidity': {'min': 90, 'max': 100},
-        'nitrogen': {'min': 0, 'max': 40},
-        'phosphorus': {'min': 5, 'max': 30},
-        'potassium': {'min': 25, 'max': 35},
-        'ph': {'min': 5.5, 'max': 6.5}
-    },
-    'cotton': {
-        'temperature': {'min': 22, 'max': 26},
-        'humidity': {'min': 75, 'max': 85},
-        'nitrogen': {'min': 100, 'max': 140},
-        'phosphorus': {'min': 35, 'max': 60},
-        'potassium': {'min': 15, 'max': 25},
-        'ph': {'min': 5.8, 'max': 8.0}
-    },
-    'jute': {
-        'temperature': {'min': 23, 'max': 27},
-        'humidity': {'min': 70, 'max': 90},
-        'nitrogen': {'min': 60, 'max': 100},
-        'phosphorus': {'min': 35, 'max': 60},
-        'potassium': {'min': 35, 'max': 45},
-        'ph': {'min': 6.0, 'max': 7.5}
-    },
-    'coffee': {
-        'temperature': {'min': 23, 'max': 28},
-        'humidity': {'min': 50, 'max': 70},
-        'nitrogen': {'min': 80, 'max': 120},
-        'phosphorus': {'min': 15, 'max': 40},
-        'potassium': {'min': 25, 'max': 35},
-        'ph': {'min': 6.0, 'max': 7.5}
-    }
-}
-
 VN_TZ = timezone(timedelta(hours=7))
 # Kết nối PostgreSQL & config cảnh báo
 def load_config():
@@ -344,6 +148,15 @@ config = load_config()
 temperature_alert_settings = config['temperature_alert']
 # Kết nối MQTT & điều khiển thiết bị
 def setup_mqtt_client():
+    if MQTT_TRANSPORT == "asyncio":
+        # Chỉ tạo transport, kết nối trong on_ready khi event loop của bot đã chạy
+        return AsyncMQTTTransport(
+            client_id="",
+            transport=MQTT_SOCKET_TRANSPORT,
+            use_tls=MQTT_USE_TLS,
+            username=MQTT_USERNAME,
+            password=MQTT_PASSWORD
+        )
     client = mqtt.Client(protocol=mqtt.MQTTv311, transport="websockets")
     client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
     client.tls_set(tls_version=ssl.PROTOCOL_TLSv1_2)
@@ -378,6 +191,34 @@ def setup_mqtt_client():
     return client
 
 mqtt_client = setup_mqtt_client()
+mqtt_task = None
+
+async def run_async_mqtt():
+    """Keep the asyncio MQTT transport connected and apply device status messages"""
+    async def consume():
+        async for topic, raw in mqtt_client.messages():
+            try:
+                payload = json.loads(raw.decode())
+                device = topic.split('/')[-1]
+                if device in device_states:
+                    device_states[device] = payload.get('status', False)
+            except Exception as e:
+                print(f"❌ Lỗi xử lý tin nhắn MQTT: {e}")
+
+    consumer = asyncio.create_task(consume())
+    try:
+        while True:
+            try:
+                await mqtt_client.connect(MQTT_BROKER, MQTT_PORT)
+                await mqtt_client.subscribe([("iot/device/status/#", 1)])
+                print("✅ Kết nối MQTT thành công")
+                await mqtt_client.wait_disconnected()
+                print("❌ Mất kết nối MQTT, đang kết nối lại...")
+            except Exception as e:
+                print(f"❌ Lỗi kết nối MQTT: {e}")
+                await asyncio.sleep(10)
+    finally:
+        consumer.cancel()
 
 def control_device(device: str, status: bool) -> bool:
     try:
@@ -387,6 +228,12 @@ def control_device(device: str, status: bool) -> bool:
             "timestamp": datetime.now(VN_TZ).isoformat()
         }
         print(f"Publishing to {topic}: {payload}")
+        if isinstance(mqtt_client, AsyncMQTTTransport):
+            if not mqtt_client.is_connected:
+                return False
+            mqtt_client.publish_nowait(topic, json.dumps(payload), qos=1) # PUBACK xử lý trên event loop
+            device_states[device] = status
+            return True
         result = mqtt_client.publish(topic, json.dumps(payload), qos=1)
         print(f"Publish result: {result.rc}")
         if result.rc == mqtt.MQTT_ERR_SUCCESS:
@@ -444,9 +291,9 @@ def get_ideal_parameters(crop_name_vi: str) -> str:
         if vi.lower() == crop_name_vi.lower():
             crop_name_en = en
             break
-    if not crop_name_en or crop_name_en not in CROP_PARAMETERS:
+    params = crop_requirements.ranges(crop_name_en) if crop_name_en else None
+    if not params:
         return ""
-    params = CROP_PARAMETERS[crop_name_en]
     param_text = "\nThông số lý tưởng cho {}:\n".format(crop_name_vi)
     param_text += "- Nhiệt độ: {}-{}°C\n".format(params['temperature']['min'], params['temperature']['max'])
     param_text += "- Độ ẩm: {}-{}%\n".format(params['humidity']['min'], params['humidity']['max'])
@@ -618,29 +465,6 @@ SENSOR_TRANSLATIONS = {
     "ph": "pH",
 }
 
-def get_last_month_rainfall():
-    latitude = 10.8411
-    longitude = 106.8090
-    today = datetime.now(VN_TZ)
-    first_day_last_month = (today.replace(day=1) - timedelta(days=1)).replace(day=1)
-    last_day_last_month = today.replace(day=1) - timedelta(days=1)
-    start_date = first_day_last_month.strftime("%Y-%m-%d")
-    end_date = last_day_last_month.strftime("%Y-%m-%d")
-    url = f"https://api.open-meteo.com/v1/forecast?latitude={latitude}&longitude={longitude}&start_date={start_date}&end_date={end_date}&daily=precipitation_sum&timezone=Asia/Ho_Chi_Minh"
-    try:
-        response = requests.get(url)
-        if response.status_code == 200:
-            data = response.json()
-            rainfall_data = data["daily"]["precipitation_sum"]
-            total_rainfall = sum(x for x in rainfall_data if x is not None)
-            logging.info(f"🌧️ Tổng lượng mưa tháng trước: {total_rainfall:.2f}mm")
-            return round(total_rainfall, 2)
-        else:
-            logging.error(f"❌ Lỗi API lấy lượng mưa tháng trước: {response.status_code}")
-            return 0
-    except Exception as e:
-        logging.error(f"❌ Lỗi khi lấy lượng mưa tháng trước: {e}")
-        return 0
 # Gửi dữ liệu cảm biến định kỳ qua Discord
 discord_subscribed_users = {}
 discord_subscription_jobs = {}
@@ -803,6 +627,10 @@ async def start_subscription_job(user_id: int, channel_id: int):
 @bot.event
 async def on_ready():
     print(f"🤖 Bot {bot.user.name} đã sẵn sàng!")
+    global mqtt_task
+    if isinstance(mqtt_client, AsyncMQTTTransport) and (mqtt_task is None or mqtt_task.done()):
+        mqtt_task = asyncio.create_task(run_async_mqtt())
+    await model_registry.start() # quét models/ ngoài event loop rồi theo dõi phiên bản mới
     load_discord_subscribers()
     for user_id, info in list(discord_subscribed_users.items()):
         if info.get('interval'):
@@ -1290,9 +1118,10 @@ async def cancel(ctx):
             await ctx.send("❌ Có lỗi xảy ra khi hủy hẹn giờ. Vui lòng thử lại.\n------------------------------------------------")
 
 @bot.command()
-async def predict(ctx):
+async def predict(ctx, top_k: int = PREDICT_TOP_K):
+    # !predict 3 → thêm 3 cây có xác suất cao nhất (cùng một lần gọi model); không truyền → PREDICT_TOP_K
     try:
-        if not all([model, scaler, label_encoder]):
+        if not model_registry.available:
             await ctx.send("❌ Chức năng dự đoán không khả dụng do lỗi tải models")
             return
 
@@ -1301,10 +1130,10 @@ async def predict(ctx):
             await ctx.send("❌ Không thể lấy dữ liệu cảm biến. Vui lòng thử lại sau.")
             return
 
-        monthly_rainfall = get_last_month_rainfall()
+        monthly_rainfall = await asyncio.to_thread(get_last_month_rainfall)
         logging.info(f"Lượng mưa tháng trước: {monthly_rainfall}mm")
 
-        input_data = pd.DataFrame([{
+        input_data = {
             'N': round(float(sensor_data['nitrogen']), 2),
             'P': round(float(sensor_data['phosphorus']), 2),
             'K': round(float(sensor_data['potassium']), 2),
@@ -1312,13 +1141,18 @@ async def predict(ctx):
             'humidity': round(float(sensor_data['humidity']), 2),
             'ph': round(float(sensor_data['ph']), 2),
             'rainfall': monthly_rainfall
-        }])
+        }
 
-        scaled_data = scaler.transform(input_data)
-        prediction = model.predict(scaled_data)
-        crop_name = label_encoder.inverse_transform(prediction)[0].lower()
+        model_version, crop_predictor = await asyncio.to_thread(model_registry.get)
+        ranked = None
+        if top_k > 1:
+            ranked = crop_predictor.predict_top_k([input_data], top_k)[0]
+            crop_name = ranked[0]['crop'].lower()
+        else:
+            crop_name = crop_predictor.predict(input_data).lower()
+        logging.info(f"Dự đoán bằng model phiên bản {model_version.name}")
         crop_name_vi = CROP_TRANSLATIONS.get(crop_name, crop_name)
-        crop_params = CROP_PARAMETERS.get(crop_name)
+        crop_params = crop_requirements.ranges(crop_name)
 
         if not crop_params:
             await ctx.send("❌ Không tìm thấy thông số cho cây trồng này.")
@@ -1328,25 +1162,14 @@ async def predict(ctx):
 
         warnings = []
         suggestions = []
-        param_map = {
-            'N': 'nitrogen',
-            'P': 'phosphorus',
-            'K': 'potassium',
-            'temperature': 'temperature',
-            'humidity': 'humidity',
-            'ph': 'ph'
-        }
-
-        for param, value in input_data.iloc[0].items():
-            mapped_param = param_map.get(param)
-            if mapped_param in crop_params:
-                ideal_range = crop_params[mapped_param]
-                if value < ideal_range['min']:
-                    warnings.append(f"⚠️ {SENSOR_TRANSLATIONS[mapped_param]} ({value}) thấp hơn mức tối thiểu ({ideal_range['min']})")
-                    suggestions.append(f"🔼 Cần tăng {SENSOR_TRANSLATIONS[mapped_param]}")
-                elif value > ideal_range['max']:
-                    warnings.append(f"⚠️ {SENSOR_TRANSLATIONS[mapped_param]} ({value}) cao hơn mức tối đa ({ideal_range['max']})")
-                    suggestions.append(f"🔻 Cần giảm {SENSOR_TRANSLATIONS[mapped_param]}")
+        for warning in crop_requirements.warnings(input_data, crop_name):
+            name = SENSOR_TRANSLATIONS[warning['param']]
+            if warning['direction'] == 'low':
+                warnings.append(f"⚠️ {name} ({warning['value']}) thấp hơn mức tối thiểu ({warning['min']})")
+                suggestions.append(f"🔼 Cần tăng {name}")
+            else:
+                warnings.append(f"⚠️ {name} ({warning['value']}) cao hơn mức tối đa ({warning['max']})")
+                suggestions.append(f"🔻 Cần giảm {name}")
 
         ideal_values = [
             f"{crop_params['temperature']['min']}-{crop_params['temperature']['max']}",
@@ -1364,14 +1187,26 @@ async def predict(ctx):
 
         table = (
             "THÔNG SỐ   LÝ TƯỞNG" + " " * (max_width - len("Lý tưởng")) + "   HIỆN TẠI\n"
-            f"Nhiệt độ | {pad_value(ideal_values[0], max_width)}  | {input_data['temperature'].iloc[0]}°C\n"
-            f"Độ ẩm    | {pad_value(ideal_values[1], max_width)}  | {input_data['humidity'].iloc[0]}%\n"
-            f"Nitơ     | {pad_value(ideal_values[2], max_width)}  | {input_data['N'].iloc[0]}mg/kg\n"
-            f"Phốt pho | {pad_value(ideal_values[3], max_width)}  | {input_data['P'].iloc[0]}mg/kg\n"
-            f"Kali     | {pad_value(ideal_values[4], max_width)}  | {input_data['K'].iloc[0]}mg/kg\n"
-            f"pH       | {pad_value(ideal_values[5], max_width)}  | {input_data['ph'].iloc[0]}\n"
+            f"Nhiệt độ | {pad_value(ideal_values[0], max_width)}  | {input_data['temperature']}°C\n"
+            f"Độ ẩm    | {pad_value(ideal_values[1], max_width)}  | {input_data['humidity']}%\n"
+            f"Nitơ     | {pad_value(ideal_values[2], max_width)}  | {input_data['N']}mg/kg\n"
+            f"Phốt pho | {pad_value(ideal_values[3], max_width)}  | {input_data['P']}mg/kg\n"
+            f"Kali     | {pad_value(ideal_values[4], max_width)}  | {input_data['K']}mg/kg\n"
+            f"pH       | {pad_value(ideal_values[5], max_width)}  | {input_data['ph']}\n"
         )
         message += f"```\n{table}\n```"
+        suitable = crop_requirements.top_k([input_data])[0]
+        message += "🌿 Hợp ngưỡng lý tưởng nhất: " + ", ".join(
+            f"{CROP_TRANSLATIONS.get(fit['crop'], fit['crop'])} ({fit['score']:.0%})" for fit in suitable) + "\n"
+        if ranked:
+            message += f"📊 Top {len(ranked)} theo mô hình:\n"
+            fits = crop_requirements.describe(input_data, [item['crop'] for item in ranked])
+            for rank, (item, fit) in enumerate(zip(ranked, fits), 1):
+                name = CROP_TRANSLATIONS.get(item['crop'].lower(), item['crop'])
+                out_of_range = ", ".join(
+                    f"{SENSOR_TRANSLATIONS[w['param']]} {'thấp' if w['direction'] == 'low' else 'cao'}"
+                    for w in fit['warnings']) if fit else ""
+                message += f"{rank}. {name}: {item['probability']:.1%}" + (f" ({out_of_range})" if out_of_range else "") + "\n"
 
         if warnings:
             message += "⚠️ Cảnh báo:\n"
@@ -0,0 +1,164 @@
+import math
+from typing import List
+
+import numpy as np
+
+from crop_predictor import CachedPredictor
+
+COMPILED_FORMAT_VERSION = 1
+# Số dòng đánh giá cùng lúc; (dòng × số cây) phần tử mỗi bước nên giữ vừa phải
+EVAL_CHUNK = 256
+
+
+def fold_threshold(threshold: float, mean: float, scale: float) -> float:
+    """Largest raw x with (x - mean) / scale <= threshold.
+
+    The scaled value is monotonic in x, so `x <= result` holds exactly when
+    the scaled comparison does, including rounding at the boundary.
+    """
+    def scaled(x):
+        return (x - mean) / scale
+
+    raw = threshold * scale + mean
+    while scaled(raw) > threshold:
+        raw = math.nextafter(raw, -math.inf)
+    while scaled(math.nextafter(raw, math.inf)) <= threshold:
+        raw = math.nextafter(raw, math.inf)
+    return raw
+
+
+def export_model(model, scaler, label_encoder, path: str) -> dict:
+    """Write a LightGBM classifier with the scaler folded into its thresholds as NumPy arrays (.npz)"""
+    dump = model.booster_.dump_model()
+    features = list(getattr(scaler, 'feature_names_in_', dump['feature_names']))
+    mean = scaler.mean_ if getattr(scaler, 'with_mean', True) else np.zeros(len(features))
+    scale = scaler.scale_ if getattr(scaler, 'with_std', True) else np.ones(len(features))
+    feature, threshold, left, value, roots = [], [], [], [], []
+    max_depth = 0
+
+    def new_slot():
+        feature.append(0)
+        threshold.append(math.inf)
+        left.append(len(left))
+        value.append(0.0)
+        return len(feature) - 1
+
+    for tree in dump['tree_info']:
+        roots.append(new_slot())
+        pending = [(tree['tree_structure'], roots[-1], 0)]
+        while pending:
+            node, index, depth = pending.pop()
+            if 'split_feature' not in node:
+                # Lá: ngưỡng +inf và con trái là chính nó → đứng yên ở các bước duyệt sau
+                value[index] = node['leaf_value']
+                max_depth = max(max_depth, depth)
+                continue
+            if node['decision_type'] != '<=' or node['missing_type'] != 'None':
+                raise ValueError(f"Không hỗ trợ nút {node['decision_type']} / missing {node['missing_type']}")
+            f = node['split_feature']
+            feature[index] = f
+            threshold[index] = fold_threshold(float(node['threshold']), float(mean[f]), float(scale[f]))
+            # Hai con nằm liền nhau: con phải = con trái + 1
+            left[index] = new_slot()
+            new_slot()
+            pending.append((node['left_child'], left[index], depth + 1))
+            pending.append((node['right_child'], left[index] + 1, depth + 1))
+    # model.predict trả về chỉ số lớp của y đã mã hóa → đổi thẳng sang tên cây trồng
+    classes = label_encoder.inverse_transform(np.asarray(model.classes_)).astype(str)
+    arrays = {
+        'version': np.array(COMPILED_FORMAT_VERSION),
+        'features': np.array(features, dtype=str),
+        'classes': classes,
+        'num_class': np.array(dump['num_tree_per_iteration']),
+        'max_depth': np.array(max_depth),
+        'roots': np.array(roots, dtype=np.int32),
+        'feature': np.array(feature, dtype=np.int32),
+        'threshold': np.array(threshold, dtype=np.float64),
+        'left': np.array(left, dtype=np.int32),
+        'value': np.array(value, dtype=np.float64),
+        # missing_type None: LightGBM coi NaN là 0 sau khi chuẩn hóa, tức là giá trị trung bình
+        'nan_value': np.asarray(mean, dtype=np.float64)
+    }
+    with open(path, 'wb') as f:
+        np.savez(f, **arrays)
+    return {'trees': len(roots), 'nodes': len(feature), 'max_depth': max_depth, 'classes': len(classes)}
+
+
+class CompiledModel:
+    """Tree ensemble evaluated with NumPy gathers, one depth level per step for all trees at once.
+
+    Nodes of every tree share flat arrays; the right child of a split is
+    left + 1, and leaves point at themselves with an +inf threshold.
+    """
+
+    def __init__(self, arrays):
+        if int(arrays['version']) != COMPILED_FORMAT_VERSION:
+            raise ValueError(f"Phiên bản model biên dịch không hỗ trợ: {int(arrays['version'])}")
+        self.features: List[str] = [str(name) for name in arrays['features']]
+        self.classes = arrays['classes']
+        self.num_class = int(arrays['num_class'])
+        self.max_depth = int(arrays['max_depth'])
+        self.roots = arrays['roots']
+        self.feature = arrays['feature']
+        self.threshold = arrays['threshold']
+        self.left = arrays['left']
+        self.value = arrays['value']
+        self.nan_value = arrays['nan_value']
+        self.iterations = len(self.roots) // self.num_class
+
+    @classmethod
+    def load(cls, path: str) -> 'CompiledModel':
+        with np.load(path, allow_pickle=False) as data:
+            return cls({name: data[name] for name in data.files})
+
+    def raw_scores(self, rows: np.ndarray) -> np.ndarray:
+        """Sum of leaf values per class, shape (n, num_class)"""
+        rows = np.asarray(rows, dtype=np.float64)
+        if np.isnan(rows).any():
+            rows = np.where(np.isnan(rows), self.nan_value, rows)
+        scores = np.zeros((len(rows), self.num_class))
+        for start in range(0, len(rows), EVAL_CHUNK):
+            chunk = rows[start:start + EVAL_CHUNK]
+            nodes = np.broadcast_to(self.roots, (len(chunk), len(self.roots))).copy()
+            for _ in range(self.max_depth):
+                values = np.take_along_axis(chunk, self.feature[nodes], axis=1)
+                step = self.left[nodes] + (values > self.threshold[nodes])
+                if np.array_equal(step, nodes):
+                    break # mọi cây đã tới lá
+                nodes = step
+            leaves = self.value[nodes].reshape(len(chunk), self.iterations, self.num_class)
+            # Cộng lần lượt từng vòng boosting như LightGBM để kết quả trùng đến từng bit
+            out = scores[start:start + EVAL_CHUNK]
+            for iteration in range(self.iterations):
+                out += leaves[:, iteration]
+        return scores
+
+    def predict_proba(self, rows: np.ndarray) -> np.ndarray:
+        scores = self.raw_scores(rows)
+        scores -= scores.max(axis=1, keepdims=True)
+        np.exp(scores, out=scores)
+        scores /= scores.sum(axis=1, keepdims=True)
+        return scores
+
+    def predict(self, rows: np.ndarray) -> np.ndarray:
+        """Crop labels (argmax of the raw scores, same as LGBMClassifier.predict)"""
+        return self.classes[np.argmax(self.raw_scores(rows), axis=1)]
+
+
+class CompiledCropPredictor(CachedPredictor):
+    """CachedPredictor backed by a CompiledModel; needs only NumPy at runtime"""
+
+    def __init__(self, compiled: CompiledModel, **kwargs):
+        super().__init__(compiled.features, **kwargs)
+        self.compiled = compiled
+        self.classes = compiled.classes
+
+    @classmethod
+    def load(cls, path: str, **kwargs) -> 'CompiledCropPredictor':
+        return cls(CompiledModel.load(path), **kwargs)
+
+    def _predict_uncached(self, rows: np.ndarray) -> np.ndarray:
+        return self.compiled.predict(rows)
+
+    def _predict_proba(self, rows: np.ndarray) -> np.ndarray:
+        return self.compiled.predict_proba(rows)
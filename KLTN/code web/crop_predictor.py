@@ -0,0 +1,196 @@
+import os
+import threading
+import warnings
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import numpy as np
+
+# Luôn nằm cạnh module, không phụ thuộc thư mục chạy uvicorn/bot
+MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'models')
+MODEL_FILES = {
+    'model': os.path.join(MODEL_DIR, 'lgbm_crop_model.pkl'),
+    'scaler': os.path.join(MODEL_DIR, 'scaler.pkl'),
+    'label_encoder': os.path.join(MODEL_DIR, 'label_encoder.pkl')
+}
+# Model đã biên dịch sang mảng NumPy (export_model.py), không cần sklearn/lightgbm/pandas khi chạy
+COMPILED_MODEL_FILE = os.path.join(MODEL_DIR, 'crop_model.npz')
+# "auto" = dùng bản biên dịch nếu có, "compiled" = bắt buộc bản biên dịch, "pickle" = luôn dùng .pkl
+MODEL_FORMAT = os.getenv("MODEL_FORMAT", "auto").lower()
+# Thứ tự cột lúc huấn luyện (ML.ipynb)
+FEATURES = ['N', 'P', 'K', 'temperature', 'humidity', 'ph', 'rainfall']
+# Số kết quả nhớ đệm; đầu vào được làm tròn PREDICT_CACHE_DECIMALS chữ số trước khi tra cache
+PREDICT_CACHE_SIZE = int(os.getenv("PREDICT_CACHE_SIZE", 4096))
+PREDICT_CACHE_DECIMALS = int(os.getenv("PREDICT_CACHE_DECIMALS", 2))
+# Số dòng tối đa cho một request /predict/batch
+PREDICT_MAX_BATCH = int(os.getenv("PREDICT_MAX_BATCH", 1000))
+# Số cây xếp hạng mặc định của /predict và !predict khi không truyền top_k; 1 = chỉ trả cây được dự đoán
+PREDICT_TOP_K = int(os.getenv("PREDICT_TOP_K", 1))
+
+
+class CachedPredictor:
+    """Batch label prediction over (n, 7) NumPy rows with an LRU cache.
+
+    Only rows missing from the cache, keyed on inputs rounded to `decimals`,
+    reach _predict_uncached() in one call. Subclasses provide the model.
+    """
+
+    def __init__(self, features: List[str], cache_size: int = PREDICT_CACHE_SIZE,
+                 decimals: int = PREDICT_CACHE_DECIMALS):
+        self.features = list(features)
+        self.cache_size = cache_size
+        self.decimals = decimals
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _predict_uncached(self, rows: np.ndarray) -> np.ndarray:
+        raise NotImplementedError
+
+    def _predict_proba(self, rows: np.ndarray) -> np.ndarray:
+        """(n, classes) probabilities, columns in the order of self.classes"""
+        raise NotImplementedError
+
+    def to_array(self, records: List[Dict]) -> np.ndarray:
+        """Build the (n, 7) float64 input array from dicts keyed by FEATURES"""
+        return np.array([[float(record[name]) for name in self.features] for record in records], dtype=np.float64)
+
+    def predict_array(self, rows: np.ndarray) -> List[str]:
+        """Predict crop labels for every row; one model call for all cache misses"""
+        rows = np.round(np.asarray(rows, dtype=np.float64).reshape(-1, len(self.features)), self.decimals)
+        if self.cache_size <= 0:
+            return list(self._predict_uncached(rows))
+        keys = [tuple(row) for row in rows.tolist()]
+        results: List[Optional[str]] = [None] * len(keys)
+        missing = {}
+        with self._lock:
+            for i, key in enumerate(keys):
+                label = self._cache.get(key)
+                if label is None:
+                    missing.setdefault(key, []).append(i)
+                else:
+                    self._cache.move_to_end(key)
+                    results[i] = label
+            self.hits += len(keys) - sum(map(len, missing.values()))
+            self.misses += len(missing)
+        if missing:
+            # Các dòng trùng nhau trong cùng batch chỉ dự đoán một lần
+            labels = self._predict_uncached(np.array(list(missing), dtype=np.float64))
+            with self._lock:
+                for (key, indexes), label in zip(missing.items(), labels):
+                    label = str(label)
+                    for i in indexes:
+                        results[i] = label
+                    self._cache[key] = label
+                    self._cache.move_to_end(key)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return results
+
+    def predict_records(self, records: List[Dict]) -> List[str]:
+        return self.predict_array(self.to_array(records))
+
+    def predict(self, record: Dict) -> str:
+        """Predict the crop label (English, as in the dataset) for one input dict"""
+        return self.predict_records([record])[0]
+
+    def predict_top_k(self, records: List[Dict], k: int = PREDICT_TOP_K) -> List[List[Dict]]:
+        """The k most probable crops per record, [{'crop', 'probability'}] best first, from one predict_proba call"""
+        # Làm tròn như predict_array để nhãn đứng đầu luôn khớp với predict()
+        rows = np.round(self.to_array(records), self.decimals)
+        proba = self._predict_proba(rows)
+        k = max(1, min(k, proba.shape[1]))
+        order = np.argsort(-proba, axis=1, kind='stable')[:, :k]
+        return [
+            [{'crop': str(self.classes[i]), 'probability': float(p[i])} for i in ranked]
+            for p, ranked in zip(proba, order)
+        ]
+
+    def clear_cache(self):
+        with self._lock:
+            self._cache.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._cache),
+                'maxsize': self.cache_size,
+                'decimals': self.decimals,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / total, 4) if total else 0.0
+            }
+
+
+class CropPredictor(CachedPredictor):
+    """LightGBM classifier + StandardScaler + LabelEncoder loaded from the .pkl files.
+
+    Scaling is done with the scaler's mean_/scale_ directly (same arithmetic
+    as StandardScaler.transform, without a DataFrame per call).
+    """
+
+    def __init__(self, model, scaler, label_encoder, **kwargs):
+        super().__init__(getattr(scaler, 'feature_names_in_', FEATURES), **kwargs)
+        self.model = model
+        self.scaler = scaler
+        self.label_encoder = label_encoder
+        self._mean = scaler.mean_ if getattr(scaler, 'with_mean', True) else None
+        self._scale = scaler.scale_ if getattr(scaler, 'with_std', True) else None
+        # Tên cây theo thứ tự cột của predict_proba
+        self.classes = label_encoder.inverse_transform(np.asarray(model.classes_)).astype(str)
+
+    def _scaled(self, rows: np.ndarray) -> np.ndarray:
+        scaled = rows.copy()
+        if self._mean is not None:
+            scaled -= self._mean
+        if self._scale is not None:
+            scaled /= self._scale
+        return scaled
+
+    def _predict_uncached(self, rows: np.ndarray) -> np.ndarray:
+        return self.label_encoder.inverse_transform(self.model.predict(self._scaled(rows)))
+
+    def _predict_proba(self, rows: np.ndarray) -> np.ndarray:
+        return self.model.predict_proba(self._scaled(rows))
+
+
+def load_pickled_models(files: Dict[str, str] = MODEL_FILES) -> Optional[Dict]:
+    """joblib.load the model, scaler and label encoder; None if a file is missing or broken"""
+    # Chỉ import sklearn/joblib khi thật sự cần đọc file .pkl
+    import joblib
+    from sklearn.exceptions import InconsistentVersionWarning
+    warnings.filterwarnings("ignore", category=InconsistentVersionWarning)
+    try:
+        models = {}
+        for name, file in files.items():
+            if not os.path.exists(file):
+                print(f"⚠️ File model {file} không tồn tại")
+                return None
+            models[name] = joblib.load(file)
+            print(f"✅ Đã tải {file} thành công")
+        return models
+    except Exception as e:
+        print(f"❌ Lỗi khi tải model: {str(e)}")
+        return None
+
+
+def load_predictor(files: Dict[str, str] = MODEL_FILES, compiled_file: str = COMPILED_MODEL_FILE,
+                   model_format: str = MODEL_FORMAT, **kwargs) -> Optional[CachedPredictor]:
+    """Load the compiled model if available (per MODEL_FORMAT), else the .pkl files; None on failure"""
+    if model_format != 'pickle' and os.path.exists(compiled_file):
+        from compiled_model import CompiledCropPredictor
+        try:
+            predictor = CompiledCropPredictor.load(compiled_file, **kwargs)
+            print(f"✅ Đã tải model biên dịch {compiled_file}")
+            return predictor
+        except Exception as e:
+            print(f"❌ Lỗi khi tải model biên dịch: {str(e)}")
+    if model_format == 'compiled':
+        print(f"⚠️ Không tải được model biên dịch {compiled_file} (chạy export_model.py)")
+        return None
+    models = load_pickled_models(files)
+    if models is None:
+        return None
+    return CropPredictor(models['model'], models['scaler'], models['label_encoder'], **kwargs)
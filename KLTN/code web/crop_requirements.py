@@ -0,0 +1,279 @@
+from typing import Dict, List, NamedTuple, Optional, Sequence
+
+import numpy as np
+
+# Thứ tự cột của bảng yêu cầu; khóa tương ứng trong dữ liệu đầu vào của /predict và !predict
+PARAMETERS = ['temperature', 'humidity', 'nitrogen', 'phosphorus', 'potassium', 'ph']
+INPUT_KEYS = {
+    'temperature': 'temperature',
+    'humidity': 'humidity',
+    'nitrogen': 'N',
+    'phosphorus': 'P',
+    'potassium': 'K',
+    'ph': 'ph'
+}
+# Số cây phù hợp trả về mặc định
+TOP_K = 3
+
+# Ngưỡng lý tưởng cho từng loại cây (dùng chung cho main.py và bot.py)
+CROP_REQUIREMENTS = {
+    'rice': {
+        'temperature': {'min': 20, 'max': 27},
+        'humidity': {'min': 80, 'max': 85},
+        'nitrogen': {'min': 60, 'max': 99},
+        'phosphorus': {'min': 35, 'max': 60},
+        'potassium': {'min': 35, 'max': 45},
+        'ph': {'min': 5.0, 'max': 7.8}
+    },
+    'maize': {
+        'temperature': {'min': 18, 'max': 26},
+        'humidity': {'min': 55, 'max': 74},
+        'nitrogen': {'min': 60, 'max': 100},
+        'phosphorus': {'min': 35, 'max': 60},
+        'potassium': {'min': 15, 'max': 25},
+        'ph': {'min': 5.5, 'max': 7.0}
+    },
+    'chickpea': {
+        'temperature': {'min': 17, 'max': 21},
+        'humidity': {'min': 14, 'max': 20},
+        'nitrogen': {'min': 20, 'max': 60},
+        'phosphorus': {'min': 55, 'max': 80},
+        'potassium': {'min': 75, 'max': 85},
+        'ph': {'min': 6.0, 'max': 8.9}
+    },
+    'kidneybeans': {
+        'temperature': {'min': 15, 'max': 24},
+        'humidity': {'min': 18, 'max': 25},
+        'nitrogen': {'min': 0, 'max': 40},
+        'phosphorus': {'min': 55, 'max': 80},
+        'potassium': {'min': 15, 'max': 25},
+        'ph': {'min': 5.5, 'max': 6.0}
+    },
+    'pigeonpeas': {
+        'temperature': {'min': 18, 'max': 39},
+        'humidity': {'min': 14, 'max': 35},
+        'nitrogen': {'min': 0, 'max': 40},
+        'phosphorus': {'min': 55, 'max': 80},
+        'potassium': {'min': 15, 'max': 25},
+        'ph': {'min': 4.0, 'max': 8.8}
+    },
+    'mothbeans': {
+        'temperature': {'min': 24, 'max': 32},
+        'humidity': {'min': 25, 'max': 35},
+        'nitrogen': {'min': 0, 'max': 40},
+        'phosphorus': {'min': 35, 'max': 60},
+        'potassium': {'min': 15, 'max': 25},
+        'ph': {'min': 3.5, 'max': 9.0}
+    },
+    'mungbean': {
+        'temperature': {'min': 27, 'max': 30},
+        'humidity': {'min': 80, 'max': 90},
+        'nitrogen': {'min': 0, 'max': 40},
+        'phosphorus': {'min': 35, 'max': 60},
+        'potassium': {'min': 15, 'max': 25},
+        'ph': {'min': 6.2, 'max': 7.6}
+    },
+    'blackgram': {
+        'temperature': {'min': 26, 'max': 32},
+        'humidity': {'min': 60, 'max': 70},
+        'nitrogen': {'min': 0, 'max': 40},
+        'phosphorus': {'min': 55, 'max': 80},
+        'potassium': {'min': 15, 'max': 25},
+        'ph': {'min': 4.9, 'max': 7.6}
+    },
+    'lentil': {
+        'temperature': {'min': 18, 'max': 27},
+        'humidity': {'min': 60, 'max': 70},
+        'nitrogen': {'min': 0, 'max': 40},
+        'phosphorus': {'min': 55, 'max': 80},
+        'potassium': {'min': 15, 'max': 25},
+        'ph': {'min': 5.8, 'max': 7.8}
+    },
+    'pomegranate': {
+        'temperature': {'min': 18, 'max': 24},
+        'humidity': {'min': 85, 'max': 95},
+        'nitrogen': {'min': 0, 'max': 40},
+        'phosphorus': {'min': 5, 'max': 30},
+        'potassium': {'min': 35, 'max': 45},
+        'ph': {'min': 5.4, 'max': 7.8}
+    },
+    'banana': {
+        'temperature': {'min': 25, 'max': 30},
+        'humidity': {'min': 75, 'max': 85},
+        'nitrogen': {'min': 80, 'max': 120},
+        'phosphorus': {'min': 5, 'max': 30},
+        'potassium': {'min': 45, 'max': 55},
+        'ph': {'min': 5.0, 'max': 7.0}
+    },
+    'mango': {
+        'temperature': {'min': 27, 'max': 35},
+        'humidity': {'min': 45, 'max': 55},
+        'nitrogen': {'min': 0, 'max': 40},
+        'phosphorus': {'min': 15, 'max': 40},
+        'potassium': {'min': 25, 'max': 35},
+        'ph': {'min': 4.3, 'max': 7.6}
+    },
+    'grapes': {
+        'temperature': {'min': 8, 'max': 32},
+        'humidity': {'min': 80, 'max': 85},
+        'nitrogen': {'min': 0, 'max': 40},
+        'phosphorus': {'min': 120, 'max': 145},
+        'potassium': {'min': 195, 'max': 205},
+        'ph': {'min': 5.5, 'max': 7.0}
+    },
+    'watermelon': {
+        'temperature': {'min': 24, 'max': 27},
+        'humidity': {'min': 80, 'max': 90},
+        'nitrogen': {'min': 80, 'max': 120},
+        'phosphorus': {'min': 5, 'max': 30},
+        'potassium': {'min': 5, 'max': 15},
+        'ph': {'min': 6.0, 'max': 6.8}
+    },
+    'muskmelon': {
+        'temperature': {'min': 27, 'max': 29},
+        'humidity': {'min': 90, 'max': 95},
+        'nitrogen': {'min': 80, 'max': 120},
+        'phosphorus': {'min': 5, 'max': 30},
+        'potassium': {'min': 5, 'max': 15},
+        'ph': {'min': 6.0, 'max': 6.8}
+    },
+    'apple': {
+        'temperature': {'min': 21, 'max': 24},
+        'humidity': {'min': 85, 'max': 95},
+        'nitrogen': {'min': 0, 'max': 40},
+        'phosphorus': {'min': 120, 'max': 145},
+        'potassium': {'min': 195, 'max': 205},
+        'ph': {'min': 5.5, 'max': 7.0}
+    },
+    'orange': {
+        'temperature': {'min': 10, 'max': 34},
+        'humidity': {'min': 85, 'max': 95},
+        'nitrogen': {'min': 0, 'max': 40},
+        'phosphorus': {'min': 5, 'max': 30},
+        'potassium': {'min': 5, 'max': 15},
+        'ph': {'min': 4.0, 'max': 9.0}
+    },
+    'papaya': {
+        'temperature': {'min': 23, 'max': 44},
+        'humidity': {'min': 85, 'max': 95},
+        'nitrogen': {'min': 40, 'max': 80},
+        'phosphorus': {'min': 5, 'max': 60},
+        'potassium': {'min': 45, 'max': 55},
+        'ph': {'min': 4.3, 'max': 7.6}
+    },
+    'coconut': {
+        'temperature': {'min': 25, 'max': 30},
+        'humidity': {'min': 90, 'max': 100},
+        'nitrogen': {'min': 0, 'max': 40},
+        'phosphorus': {'min': 5, 'max': 30},
+        'potassium': {'min': 25, 'max': 35},
+        'ph': {'min': 5.5, 'max': 6.5}
+    },
+    'cotton': {
+        'temperature': {'min': 22, 'max': 26},
+        'humidity': {'min': 75, 'max': 85},
+        'nitrogen': {'min': 100, 'max': 140},
+        'phosphorus': {'min': 35, 'max': 60},
+        'potassium': {'min': 15, 'max': 25},
+        'ph': {'min': 5.8, 'max': 8.0}
+    },
+    'jute': {
+        'temperature': {'min': 23, 'max': 27},
+        'humidity': {'min': 70, 'max': 90},
+        'nitrogen': {'min': 60, 'max': 100},
+        'phosphorus': {'min': 35, 'max': 60},
+        'potassium': {'min': 35, 'max': 45},
+        'ph': {'min': 6.0, 'max': 7.5}
+    },
+    'coffee': {
+        'temperature': {'min': 23, 'max': 28},
+        'humidity': {'min': 50, 'max': 70},
+        'nitrogen': {'min': 80, 'max': 120},
+        'phosphorus': {'min': 15, 'max': 40},
+        'potassium': {'min': 25, 'max': 35},
+        'ph': {'min': 6.0, 'max': 7.5}
+    }
+}
+
+
+class CropFit(NamedTuple):
+    deviation: np.ndarray   # (n, cây, 6): lệch khỏi khoảng lý tưởng, âm = dưới min, dương = trên max, 0 = đạt
+    score: np.ndarray       # (n, cây): độ phù hợp 0..1, trung bình điểm của 6 thông số
+
+
+class CropRequirements:
+    """Ideal ranges of every crop as (crops, 6) min/max arrays, built once.
+
+    evaluate() compares n readings with all crops in a few broadcast
+    operations. A parameter inside its range scores 1, falling linearly to 0
+    at one range width outside it; the fit score is the mean over the six
+    parameters.
+    """
+
+    def __init__(self, requirements: Dict[str, Dict] = CROP_REQUIREMENTS, parameters: Sequence[str] = PARAMETERS):
+        self.requirements = requirements
+        self.parameters = list(parameters)
+        self.crops = list(requirements)
+        self.index = {crop: i for i, crop in enumerate(self.crops)}
+        self.low = np.array([[requirements[crop][p]['min'] for p in self.parameters] for crop in self.crops], dtype=np.float64)
+        self.high = np.array([[requirements[crop][p]['max'] for p in self.parameters] for crop in self.crops], dtype=np.float64)
+        self.width = np.maximum(self.high - self.low, 1e-9)
+
+    def ranges(self, crop: str) -> Optional[Dict]:
+        """{'temperature': {'min': .., 'max': ..}, ...} for one crop, or None if unknown"""
+        return self.requirements.get(crop.lower())
+
+    def to_array(self, readings: List[Dict]) -> np.ndarray:
+        """(n, 6) array from dicts keyed like /predict input (N, P, K, temperature, humidity, ph)"""
+        return np.array([[float(reading[INPUT_KEYS[p]]) for p in self.parameters] for reading in readings],
+                        dtype=np.float64)
+
+    def evaluate(self, rows: np.ndarray) -> CropFit:
+        """Deviation and fit score of every reading against every crop"""
+        rows = np.asarray(rows, dtype=np.float64).reshape(-1, 1, len(self.parameters))
+        deviation = rows - np.clip(rows, self.low, self.high)
+        score = np.clip(1.0 - np.abs(deviation) / self.width, 0.0, 1.0).mean(axis=2)
+        return CropFit(deviation, score)
+
+    def warnings(self, reading: Dict, crop: str) -> List[Dict]:
+        """Parameters of one reading outside the crop's range: [{'param', 'value', 'min', 'max', 'direction'}]"""
+        i = self.index.get(crop.lower())
+        if i is None:
+            return []
+        values = self.to_array([reading])[0]
+        return self._warnings(reading, i, values - np.clip(values, self.low[i], self.high[i]))
+
+    def _warnings(self, reading: Dict, i: int, deviation: np.ndarray) -> List[Dict]:
+        ranges = self.requirements[self.crops[i]]
+        return [{
+            'param': self.parameters[j],
+            'value': reading[INPUT_KEYS[self.parameters[j]]],
+            'min': ranges[self.parameters[j]]['min'],
+            'max': ranges[self.parameters[j]]['max'],
+            'direction': 'low' if deviation[j] < 0 else 'high'
+        } for j in np.flatnonzero(deviation)]
+
+    def _fit(self, reading: Dict, i: int, fit: CropFit, n: int) -> Dict:
+        return {
+            'crop': self.crops[i],
+            'score': round(float(fit.score[n, i]), 4),
+            'in_range': int(np.count_nonzero(fit.deviation[n, i] == 0)),
+            'warnings': self._warnings(reading, i, fit.deviation[n, i])
+        }
+
+    def describe(self, reading: Dict, crops: Sequence[str]) -> List[Dict]:
+        """{'crop', 'score', 'in_range', 'warnings'} of one reading for each given crop (None if not in the table)"""
+        fit = self.evaluate(self.to_array([reading]))
+        return [self._fit(reading, self.index[crop.lower()], fit, 0) if crop.lower() in self.index else None
+                for crop in crops]
+
+    def top_k(self, readings: List[Dict], k: int = TOP_K) -> List[List[Dict]]:
+        """The k best-fitting crops for each reading: [{'crop', 'score', 'in_range', 'warnings'}]"""
+        fit = self.evaluate(self.to_array(readings))
+        k = max(1, min(k, len(self.crops)))
+        # Sắp xếp ổn định: cùng điểm thì giữ thứ tự trong bảng
+        order = np.argsort(-fit.score, axis=1, kind='stable')[:, :k]
+        return [[self._fit(reading, i, fit, n) for i in order[n]] for n, reading in enumerate(readings)]
+
+
+crop_requirements = CropRequirements()
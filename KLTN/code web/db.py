@@ -0,0 +1,127 @@
+import asyncio
+import functools
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import pool
+from dotenv import load_dotenv
+
+from metrics import DB_EXECUTOR_WAIT_SECONDS, DB_POOL_WAIT_SECONDS, DB_QUERY_ERRORS, DB_QUERY_SECONDS
+
+load_dotenv()
+
+# Số kết nối tối thiểu / tối đa giữ trong pool (chia sẻ cho mọi truy vấn của main.py)
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", 1))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", 10))
+# Số thread chạy truy vấn cho các endpoint async, luôn nhỏ hơn DB_POOL_MAX
+# để luồng MQTT vẫn còn kết nối khi executor chạy hết công suất
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", max(1, DB_POOL_MAX - 2)))
+
+_pool = None
+_pool_lock = threading.Lock()
+_executor = None
+
+
+def get_db_config():
+    """Read PostgreSQL connection settings from the environment"""
+    return {
+        'dbname': os.getenv("POSTGRES_DB", "sensor_data"),
+        'user': os.getenv("POSTGRES_USER", "postgres"),
+        'password': os.getenv("POSTGRES_PASSWORD", "postgres"),
+        'host': os.getenv("POSTGRES_HOST", "localhost"),
+        'port': os.getenv("POSTGRES_PORT", "5432")
+    }
+
+
+def init_pool(minconn: int = DB_POOL_MIN, maxconn: int = DB_POOL_MAX):
+    """Create the shared connection pool (idempotent)"""
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.closed:
+            _pool = pool.ThreadedConnectionPool(minconn, maxconn, **get_db_config())
+            print(f"✅ Đã tạo PostgreSQL connection pool ({minconn}-{maxconn} kết nối)")
+    return _pool
+
+
+def close_pool():
+    """Close every pooled connection"""
+    global _pool
+    with _pool_lock:
+        if _pool is not None and not _pool.closed:
+            _pool.closeall()
+            print("✅ Đã đóng PostgreSQL connection pool")
+        _pool = None
+
+
+@contextmanager
+def get_connection():
+    """Borrow a pooled connection; commit on success, rollback on error"""
+    db_pool = _pool if _pool is not None and not _pool.closed else init_pool()
+    started = time.perf_counter()
+    conn = db_pool.getconn()
+    DB_POOL_WAIT_SECONDS.observe(time.perf_counter() - started)
+    broken = False
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        if not conn.closed:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                broken = True
+        raise
+    finally:
+        # Kết nối hỏng (server restart, mạng rớt) thì bỏ luôn, không trả về pool
+        db_pool.putconn(conn, close=broken or bool(conn.closed))
+
+
+def timed_query(func):
+    """Record the helper's duration and failures in db_query_seconds / db_query_errors_total (label = function name)"""
+    seconds = DB_QUERY_SECONDS.labels(func.__name__)
+    errors = DB_QUERY_ERRORS.labels(func.__name__)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            errors.inc()
+            raise
+        finally:
+            seconds.observe(time.perf_counter() - started)
+    return wrapper
+
+
+def get_executor():
+    """Return the bounded thread pool used to offload blocking queries"""
+    global _executor
+    with _pool_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="db")
+    return _executor
+
+
+def shutdown_executor():
+    """Stop the DB executor, waiting for running queries to finish"""
+    global _executor
+    with _pool_lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=True)
+
+
+async def run_db(func, *args, **kwargs):
+    """Run a blocking DB helper off the event loop and return its result"""
+    loop = asyncio.get_running_loop()
+    submitted = time.perf_counter()
+
+    def run():
+        DB_EXECUTOR_WAIT_SECONDS.observe(time.perf_counter() - submitted)
+        return func(*args, **kwargs)
+    return await loop.run_in_executor(get_executor(), run)
@@ -1,11 +1,17 @@
 import asyncio
-import json
+import heapq
+import itertools
 import os
+import time
 from datetime import datetime, timedelta
-from typing import Dict, Optional
+from typing import Dict, List, Optional, Tuple
 import pytz
 import traceback
 
+from metrics import TIMER_COMMANDS, TIMER_FIRE_LAG_SECONDS
+from timer_store import TimerStore
+from schedule import CronSchedule, parse_hhmm, parse_slot
+
 from dotenv import load_dotenv
 load_dotenv()
 MQTT_BROKER = os.getenv("MQTT_BROKER")
@@ -15,38 +21,66 @@ MQTT_PASSWORD = os.getenv("MQTT_PASSWORD")
 
 vn_tz = pytz.timezone('Asia/Ho_Chi_Minh')
 
+# Hẹn giờ một lần đã trễ quá khoảng này (giây) thì bỏ qua, giống cửa sổ 1 phút trước đây
+ONE_SHOT_GRACE = 60
+# Thức dậy ít nhất mỗi giờ để tự điều chỉnh nếu đồng hồ hệ thống bị chỉnh
+MAX_SLEEP = 3600
+# Bù lại các mốc bật/tắt bị lỡ khi server tắt: chỉ xét mốc xảy ra trong bấy nhiêu giây trước khi khởi động.
+# 0 = tắt tính năng, số âm = không giới hạn (luôn đưa thiết bị về trạng thái theo lịch)
+TIMER_CATCHUP_GRACE = float(os.getenv("TIMER_CATCHUP_GRACE", 6 * 3600))
+# Chờ ESP32 báo trạng thái (iot/device/status) trước khi so sánh
+TIMER_CATCHUP_DELAY = float(os.getenv("TIMER_CATCHUP_DELAY", 3))
+
 class DeviceTimer:
-    def __init__(self, mqtt_client):
+    """Single scheduler task over a heap of (fire_at, seq, key, device, status, generation, recur).
+
+    key is the device for its on/off window, or (device, time, status) for a
+    daily event added through add_timer. recur is the CronSchedule of a
+    recurring entry (None for one-shot). Rescheduling or clearing a key bumps
+    its generation, so old heap entries are skipped lazily when they surface
+    (O(log n) insert, O(1) cancel).
+    """
+
+    def __init__(self, mqtt_client, store: Optional[TimerStore] = None):
+        self.store = store or TimerStore()
         self.timers: Dict[str, Dict] = {}
-        self.tasks: Dict[str, asyncio.Task] = {}
+        self.events: Dict[str, List[Dict]] = {}   # sự kiện hằng ngày {time: "HH:MM", status} của mỗi thiết bị
         self.mqtt_client = mqtt_client
+        self._heap = []
+        self._seq = itertools.count()
+        self._generation: Dict = {}
+        self._live: Dict = {}             # số entry còn hiệu lực của mỗi key trong heap
+        self._stale = 0                   # số entry đã hủy nhưng chưa lấy ra khỏi heap
+        self._wakeup = None
+        self._scheduler = None
+        self._firing = set()
+        self._catchup_plan: Dict[str, Tuple[datetime, bool]] = {}
+        self._catchup_task = None
         self.load_timers()
 
     def load_timers(self):
-        """Load timers from file"""
+        """Load timers from the snapshot + journal and schedule them"""
         try:
-            with open('device_timers.json', 'r') as f:
-                self.timers = json.load(f)
-       # --- PHẦN THÊM MỚI QUAN TRỌNG ---
-            # Sau khi load dữ liệu, phải chạy lại Task cho từng thiết bị
-            print(f"📂 Đã load {len(self.timers)} hẹn giờ từ file.")
-            for device, timer_data in self.timers.items():
+            state = self.store.load()
+            self.timers = state['timers']
+            self.events = state['events']
+            print(f"📂 Đã load {len(self.timers)} hẹn giờ, {sum(map(len, self.events.values()))} sự kiện từ file.")
+            # Tính trước khi lên lịch vì hẹn giờ một lần đã hết hạn sẽ bị xóa ngay sau đây
+            self._catchup_plan = self.desired_states()
+            for device, timer_data in list(self.timers.items()):
                 if timer_data.get('enabled', True):
-                    print(f"🔄 Đang khôi phục hẹn giờ cho: {device}")
                     self.start_timer_task(device)
-            # --------------------------------
-            
-        except FileNotFoundError:
-            self.timers = {}
-            print("⚠️ Không tìm thấy file device_timers.json, tạo mới.")
+            for device, events in self.events.items():
+                for event in events:
+                    self._schedule_event(device, event['time'], event['status'])
         except Exception as e:
             print(f"❌ Lỗi khi load timer: {e}")
-            self.timers = {}
+            self.timers = self.store.state['timers'] = {}
+            self.events = self.store.state['events'] = {}
 
     def save_timers(self):
-        """Save timers to file"""
-        with open('device_timers.json', 'w') as f:
-            json.dump(self.timers, f)
+        """Write every timer to the snapshot file (atomic)"""
+        self.store.compact()
 
     def set_timer(self, device: str, on_datetime: str, off_datetime: str, daily: bool = False) -> bool:
         """Set timer for a device"""
@@ -57,75 +91,253 @@ class DeviceTimer:
                 'daily': daily,
                 'enabled': True
             }
-            self.timers[device] = timer
-            self.save_timers()
+            self.store.put('timers', device, timer) # chỉ ghi thêm 1 dòng journal
             self.start_timer_task(device)
             return True
         except Exception as e:
             print(f"Error setting timer: {str(e)}")
             return False
 
+    def set_schedule(self, device: str, slots: List[Dict]) -> bool:
+        """Replace a device's timer with recurring slots (HH:MM + weekdays or cron); raises ValueError"""
+        if not slots:
+            raise ValueError("Cần ít nhất một slot")
+        now = datetime.now(vn_tz)
+        normalized = []
+        for slot in slots:
+            on, off, clean = parse_slot(slot)
+            on.next_after(now) # Báo lỗi ngay nếu biểu thức không bao giờ xảy ra (VD: 31/2)
+            if off:
+                off.next_after(now)
+            normalized.append(clean)
+        self.store.put('timers', device, {'slots': normalized, 'enabled': True})
+        self.start_timer_task(device)
+        return True
+
+    def _window_schedules(self, device: str):
+        """Yield (status, CronSchedule or one-shot datetime) for the device's timer entry"""
+        timer = self.timers.get(device)
+        if not timer or not timer.get('enabled', True):
+            return
+        if 'slots' in timer:
+            for slot in timer['slots']:
+                on, off, _ = parse_slot(slot)
+                yield True, on
+                if off:
+                    yield False, off
+            return
+        on_dt = datetime.fromisoformat(timer['on_datetime']).astimezone(vn_tz)
+        off_dt = datetime.fromisoformat(timer['off_datetime']).astimezone(vn_tz)
+        if timer.get('daily'):
+            yield True, CronSchedule.at(on_dt.time())
+            yield False, CronSchedule.at(off_dt.time())
+        else:
+            yield True, on_dt
+            yield False, off_dt
+
     def start_timer_task(self, device: str):
-        """Start timer task for a device"""
-        if device in self.tasks:
-            self.tasks[device].cancel()
+        """(Re)schedule the ON/OFF events of a device on the shared scheduler"""
+        self._cancel(device)
+        now = time.time()
+        now_dt = datetime.fromtimestamp(now, vn_tz)
+        one_shot = pushed = False
+        for status, when in self._window_schedules(device):
+            if isinstance(when, CronSchedule):
+                self._push(when.next_after(now_dt).timestamp(), device, status, when)
+                pushed = True
+            else:
+                one_shot = True
+                if when.timestamp() >= now - ONE_SHOT_GRACE:
+                    self._push(when.timestamp(), device, status)
+                    pushed = True
+        if one_shot and not pushed:
+            print(f"[TIMER] Hẹn giờ một lần của {device} đã qua, xóa")
+            self.clear_timer(device)
+
+    def preview(self, device: str, count: int = 10, after: Optional[datetime] = None) -> List[Dict]:
+        """Next `count` firings of a device (timer window/slots and daily events), in order"""
+        after = after or datetime.now(vn_tz)
+
+        def runs_of(recur, status, source):
+            for dt in recur.iter_after(after):
+                yield dt, status, source
+
+        sources = []
+        for status, when in self._window_schedules(device):
+            if isinstance(when, CronSchedule):
+                sources.append(runs_of(when, status, 'timer'))
+            elif when > after:
+                sources.append(iter([(when, status, 'timer')]))
+        for event in self.events.get(device, []):
+            recur = CronSchedule.at(parse_hhmm(event['time']))
+            sources.append(runs_of(recur, event['status'], 'event'))
+        runs = []
+        for dt, status, source in itertools.islice(heapq.merge(*sources, key=lambda run: run[0]), count):
+            runs.append({'time': dt.isoformat(), 'status': status, 'source': source})
+        return runs
+
+    def last_edge(self, device: str, now: datetime) -> Optional[Tuple[datetime, bool]]:
+        """Most recent (time, status) ON/OFF edge of a device at or before `now`, or None"""
+        sources = list(self._window_schedules(device))
+        for event in self.events.get(device, []):
+            sources.append((event['status'], CronSchedule.at(parse_hhmm(event['time']))))
+        latest = None
+        for status, when in sources:
+            if isinstance(when, CronSchedule):
+                at = when.last_at_or_before(now)
+            else:
+                at = when if when <= now else None
+            # Hai mốc trùng thời điểm thì ưu tiên TẮT
+            if at is not None and (latest is None or (at, not status) > (latest[0], not latest[1])):
+                latest = (at, status)
+        return latest
+
+    def desired_states(self, now: Optional[datetime] = None,
+                       grace: float = TIMER_CATCHUP_GRACE) -> Dict[str, Tuple[datetime, bool]]:
+        """Scheduled state of every device at `now`: {device: (edge_time, status)}.
+
+        Devices whose last edge is older than `grace` seconds are left out
+        (grace < 0 = no limit, grace == 0 = catch-up disabled).
+        """
+        if grace == 0:
+            return {}
+        now = now or datetime.now(vn_tz)
+        plan = {}
+        for device in set(self.timers) | set(self.events):
+            edge = self.last_edge(device, now)
+            if edge is None or (grace > 0 and (now - edge[0]).total_seconds() > grace):
+                continue
+            plan[device] = edge
+        return plan
+
+    def start_catchup(self, delay: float = TIMER_CATCHUP_DELAY):
+        """Run reconcile() in the background once MQTT status messages had time to arrive"""
+        async def run():
+            await asyncio.sleep(delay)
+            await self.reconcile()
+        self._catchup_task = asyncio.create_task(run())
+        return self._catchup_task
+
+    async def reconcile(self, plan: Optional[Dict[str, Tuple[datetime, bool]]] = None) -> List[Dict]:
+        """Publish the scheduled state of devices whose known state differs; returns the changes.
+
+        Uses the plan computed at load time by default, so edges missed while
+        the server was down (including expired one-shot timers) are replayed once.
+        A device counts as known only if it reported a status (or was commanded)
+        since the MQTT client started; otherwise its scheduled state is always sent.
+        """
+        if plan is None:
+            plan, self._catchup_plan = self._catchup_plan, {}
+        states = getattr(self.mqtt_client, 'device_states', {})
+        # device_states mặc định là False cho mọi thiết bị: chỉ tin các thiết bị đã thực sự báo trạng thái
+        reported = getattr(self.mqtt_client, 'reported_devices', set())
+        changes = []
+        for device, (edge, status) in sorted(plan.items()):
+            previous = states.get(device) if device in reported else None
+            if previous == status:
+                continue
+            changes.append({'device': device, 'status': status, 'edge': edge.isoformat(),
+                            'previous': previous})
+        for change in changes:
+            print(f"[TIMER] Bù mốc bị lỡ lúc {change['edge']}: {'Bật' if change['status'] else 'Tắt'} {change['device']}")
+            TIMER_FIRE_LAG_SECONDS.labels('catchup').observe(time.time() - plan[change['device']][0].timestamp())
+            change['sent'] = await self._control_device(change['device'], change['status'])
+            TIMER_COMMANDS.labels('catchup', 'sent' if change['sent'] else 'failed').inc()
+        print(f"[TIMER] Đối soát khi khởi động: {len(plan)} thiết bị theo lịch, {len(changes)} lệnh bù")
+        return changes
+
+    def _push(self, fire_at: float, device: str, status: bool, recur=None, key=None):
+        key = device if key is None else key
+        generation = self._generation.setdefault(key, 0)
+        heapq.heappush(self._heap, (fire_at, next(self._seq), key, device, status, generation, recur))
+        self._live[key] = self._live.get(key, 0) + 1
+        self._ensure_scheduler()
+        if self._wakeup is not None:
+            self._wakeup.set()
 
-        self.tasks[device] = asyncio.create_task(self._timer_loop(device))
+    def _cancel(self, key):
+        """Invalidate every pending entry of a key without touching the heap"""
+        self._generation[key] = self._generation.get(key, 0) + 1
+        self._stale += self._live.pop(key, 0)
+        # Dọn heap khi entry đã hủy chiếm quá nửa
+        if self._stale > 64 and self._stale * 2 > len(self._heap):
+            self._heap = [entry for entry in self._heap if self._is_live(entry)]
+            heapq.heapify(self._heap)
+            self._stale = 0
 
-    async def _timer_loop(self, device: str):
-        """Timer loop for a device"""
+    def _is_live(self, entry) -> bool:
+        return entry[5] == self._generation.get(entry[2])
+
+    def _ensure_scheduler(self):
+        if self._scheduler is not None and not self._scheduler.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return # Chưa có event loop (lúc import); scheduler sẽ chạy khi có timer trong lifespan
+        self._wakeup = asyncio.Event()
+        self._scheduler = loop.create_task(self._run_scheduler())
+
+    async def _run_scheduler(self):
+        """Sleep until the earliest deadline, fire every due event exactly once"""
         while True:
             try:
-                timer = self.timers.get(device)
-                if not timer or not timer['enabled']:
-                    print(f"[TIMER] No active timer found for {device}")
-                    break
-
-                now = datetime.now(vn_tz)
-                on_dt = datetime.fromisoformat(timer['on_datetime']).astimezone(vn_tz)
-                off_dt = datetime.fromisoformat(timer['off_datetime']).astimezone(vn_tz)
-
-                print(f"[TIMER] Detailed check for {device}:")
-                print(f"  Current time: {now}")
-                print(f"  On time: {on_dt}")
-                print(f"  Off time: {off_dt}")
-                print(f"  Daily mode: {timer['daily']}")
-
-                if timer['daily']:
-                    current_time = now.time()
-                    on_time = on_dt.time()
-                    off_time = off_dt.time()
-                    
-                    print(f"  Current time (HH:MM): {current_time.hour}:{current_time.minute}")
-                    print(f"  On time (HH:MM): {on_time.hour}:{on_time.minute}")
-                    print(f"  Off time (HH:MM): {off_time.hour}:{off_time.minute}")
-                    
-                    if current_time.hour == on_time.hour and current_time.minute == on_time.minute:
-                        print(f"  [ACTION] Turning ON {device} (daily schedule)")
-                        await self._control_device(device, True)
-                    if current_time.hour == off_time.hour and current_time.minute == off_time.minute:
-                        print(f"  [ACTION] Turning OFF {device} (daily schedule)")
-                        await self._control_device(device, False)
-                else:
-                    print(f"  Time until ON: {(on_dt - now).total_seconds()} seconds")
-                    print(f"  Time until OFF: {(off_dt - now).total_seconds()} seconds")
-                    
-                    if now >= on_dt and now <= on_dt + timedelta(minutes=1):
-                        print(f"  [ACTION] Turning ON {device} (one-time schedule)")
-                        await self._control_device(device, True)
-                    if now >= off_dt and now <= off_dt + timedelta(minutes=1):
-                        print(f"  [ACTION] Turning OFF {device} (one-time schedule)")
-                        await self._control_device(device, False)
-                        print(f"  [ACTION] Clearing timer for {device}")
-                        self.clear_timer(device)
-                        break
-
-                print(f"[TIMER] Next check in 5 seconds...")
-                await asyncio.sleep(5)
+                self._wakeup.clear()
+                now = time.time()
+                while self._heap and (self._heap[0][0] <= now or not self._is_live(self._heap[0])):
+                    entry = heapq.heappop(self._heap)
+                    if not self._is_live(entry):
+                        self._stale -= 1
+                        continue
+                    self._fire(entry, now)
+                # Hẹn call_later đánh thức thay vì wait_for (wait_for có thể nuốt lệnh cancel)
+                handle = None
+                if self._heap:
+                    delay = min(self._heap[0][0] - time.time(), MAX_SLEEP)
+                    handle = asyncio.get_running_loop().call_later(max(delay, 0), self._wakeup.set)
+                try:
+                    await self._wakeup.wait()
+                finally:
+                    if handle:
+                        handle.cancel()
+            except asyncio.CancelledError:
+                raise
             except Exception as e:
-                print(f"[TIMER] Error in timer loop: {str(e)}")
+                print(f"[TIMER] Error in scheduler: {str(e)}")
                 print(f"[TIMER] Stack trace: {traceback.format_exc()}")
-                await asyncio.sleep(5)
+                await asyncio.sleep(1)
+
+    def _fire(self, entry, now: float):
+        fire_at, _, key, device, status, _, recur = entry
+        self._live[key] -= 1
+        kind = 'recurring' if recur is not None else 'one_shot'
+        # Trễ thật so với lịch: thời gian ngủ quá hạn + event loop bận
+        TIMER_FIRE_LAG_SECONDS.labels(kind).observe(max(time.time() - fire_at, 0))
+        print(f"[TIMER] {'Bật' if status else 'Tắt'} {device} ({recur.expression if recur else 'một lần'})")
+        task = asyncio.create_task(self._control_device(device, status))
+        self._firing.add(task)
+        task.add_done_callback(self._firing.discard)
+        task.add_done_callback(lambda done: TIMER_COMMANDS.labels(
+            kind, 'sent' if not done.cancelled() and done.result() else 'failed').inc())
+        if recur is not None:
+            # Lần kế tiếp luôn sau thời điểm vừa chạy → mỗi mốc chỉ bắn đúng một lần
+            after = datetime.fromtimestamp(max(fire_at, now), vn_tz)
+            self._push(recur.next_after(after).timestamp(), device, status, recur, key)
+        elif not status and key == device:
+            print(f"[TIMER] Hoàn tất hẹn giờ một lần của {device}")
+            self.clear_timer(device)
+
+    async def stop(self):
+        """Stop the scheduler task"""
+        if self._catchup_task and not self._catchup_task.done():
+            self._catchup_task.cancel()
+        if self._scheduler:
+            self._scheduler.cancel()
+            try:
+                await self._scheduler
+            except asyncio.CancelledError:
+                pass
+            self._scheduler = None
 
     async def _control_device(self, device_id: str, status: bool):
         """Điều khiển thiết bị thông qua MQTT"""
@@ -156,14 +368,63 @@ class DeviceTimer:
 
     def clear_timer(self, device: str):
         """Clear timer for a device"""
-        if device in self.tasks:
-            self.tasks[device].cancel()
-            del self.tasks[device]
-        
-        if device in self.timers:
-            del self.timers[device]
-            self.save_timers()
+        self._cancel(device)
+        self.store.delete('timers', device)
 
     def get_timer(self, device: str) -> Optional[Dict]:
         """Get timer for a device"""
-        return self.timers.get(device)
\ No newline at end of file
+        return self.timers.get(device)
+
+    # --- Sự kiện hằng ngày nhiều mốc: {time: "HH:MM", status} ---
+    @staticmethod
+    def _parse_event_time(value: str) -> str:
+        return datetime.strptime(value.strip(), "%H:%M").strftime("%H:%M")
+
+    def _schedule_event(self, device: str, at: str, status: bool):
+        recur = CronSchedule.at(parse_hhmm(at))
+        key = (device, at, status)
+        self._cancel(key)
+        self._push(recur.next_after(datetime.now(vn_tz)).timestamp(), device, status, recur, key)
+
+    def _save_events(self, device: str, events: List[Dict]):
+        if events:
+            self.store.put('events', device, sorted(events, key=lambda ev: (ev['time'], ev['status'])))
+        else:
+            self.store.delete('events', device)
+
+    async def add_timer(self, device: str, time: str, status: bool) -> bool:
+        """Add a daily event; False if the same (time, status) already exists"""
+        at = self._parse_event_time(time)
+        events = list(self.events.get(device, []))
+        if any(ev['time'] == at and ev['status'] == status for ev in events):
+            return False
+        events.append({'time': at, 'status': status})
+        self._save_events(device, events)
+        self._schedule_event(device, at, status)
+        return True
+
+    async def remove_timer(self, device: str, time: str, status: bool) -> bool:
+        """Remove one daily event; False if it does not exist"""
+        at = self._parse_event_time(time)
+        events = self.events.get(device, [])
+        remaining = [ev for ev in events if not (ev['time'] == at and ev['status'] == status)]
+        if len(remaining) == len(events):
+            return False
+        self._save_events(device, remaining)
+        self._cancel((device, at, status))
+        return True
+
+    async def update_timer(self, device: str, old_time: str, new_time: str, status: bool) -> bool:
+        """Move one daily event to a new time; False if the old one does not exist"""
+        old_at = self._parse_event_time(old_time)
+        new_at = self._parse_event_time(new_time)
+        events = self.events.get(device, [])
+        if not any(ev['time'] == old_at and ev['status'] == status for ev in events):
+            return False
+        remaining = [ev for ev in events
+                     if not (ev['time'] in (old_at, new_at) and ev['status'] == status)]
+        remaining.append({'time': new_at, 'status': status})
+        self._save_events(device, remaining)
+        self._cancel((device, old_at, status))
+        self._schedule_event(device, new_at, status)
+        return True
\ No newline at end of file
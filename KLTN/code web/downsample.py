@@ -0,0 +1,43 @@
+import numpy as np
+
+
+def lttb(x, y, n_out: int):
+    """Largest-Triangle-Three-Buckets: return indices of n_out points that keep the shape of (x, y)"""
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n = len(x)
+    if n_out >= n:
+        return np.arange(n)
+    if n_out < 3:
+        return np.linspace(0, n - 1, max(n_out, 0)).astype(int)
+
+    # Điểm đầu/cuối luôn giữ lại; n - 2 điểm giữa chia đều vào n_out - 2 bucket
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    selected = np.empty(n_out, dtype=int)
+    selected[0] = 0
+    selected[-1] = n - 1
+    prev = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        # Điểm "neo" của bucket kế tiếp = trung bình bucket đó (hoặc điểm cuối)
+        next_lo, next_hi = hi, edges[i + 2] if i + 2 < len(edges) else n
+        avg_x = x[next_lo:next_hi].mean()
+        avg_y = y[next_lo:next_hi].mean()
+        # Chọn điểm tạo tam giác lớn nhất với điểm đã chọn trước đó và điểm neo
+        area = np.abs(
+            (x[prev] - avg_x) * (y[lo:hi] - y[prev])
+            - (x[prev] - x[lo:hi]) * (avg_y - y[prev])
+        )
+        prev = lo + int(np.argmax(area))
+        selected[i + 1] = prev
+    return selected
+
+
+def downsample_series(timestamps, values, n_out: int):
+    """Drop NaN samples then LTTB-downsample one series; returns (timestamps, values)"""
+    timestamps = np.asarray(timestamps, dtype=float)
+    values = np.asarray(values, dtype=float)
+    mask = ~np.isnan(values)
+    timestamps, values = timestamps[mask], values[mask]
+    idx = lttb(timestamps, values, n_out)
+    return timestamps[idx], values[idx]
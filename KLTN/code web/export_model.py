@@ -0,0 +1,64 @@
+"""Export the LightGBM crop model + scaler + label encoder to a NumPy artifact (models/crop_model.npz).
+
+Cần sklearn/lightgbm/pandas lúc export; server và bot sau đó chỉ cần NumPy để dự đoán.
+Kiểm tra trên Dataset.csv rằng kết quả giống hệt model gốc, sai khác thì xóa file và báo lỗi:
+    python export_model.py
+"""
+import argparse
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+from compiled_model import CompiledModel, export_model
+from crop_predictor import COMPILED_MODEL_FILE, MODEL_FILES, load_pickled_models
+
+DATASET = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'MACHINE-LEARNING', 'Dataset.csv')
+
+
+def verify(models, compiled: CompiledModel, frame: pd.DataFrame) -> bool:
+    """Compare labels (and probabilities) of the original pipeline and the compiled model"""
+    ok = True
+    for name, inputs in (('gốc', frame), ('làm tròn 2 chữ số', frame.round(2))):
+        scaled = models['scaler'].transform(inputs)
+        expected = models['label_encoder'].inverse_transform(models['model'].predict(scaled))
+        expected_proba = models['model'].predict_proba(scaled)
+        actual = compiled.predict(inputs.to_numpy())
+        actual_proba = compiled.predict_proba(inputs.to_numpy())
+        mismatches = int(np.sum(expected != actual))
+        proba_diff = float(np.abs(expected_proba - actual_proba).max())
+        print(f"Dataset.csv ({name}): {len(inputs)} dòng, {mismatches} khác nhãn, "
+              f"sai khác xác suất lớn nhất {proba_diff:.2e}")
+        ok = ok and mismatches == 0
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--models-dir', default=None, help='directory with the three .pkl files (default: models/)')
+    parser.add_argument('--output', default=COMPILED_MODEL_FILE)
+    parser.add_argument('--dataset', default=DATASET)
+    args = parser.parse_args()
+
+    files = MODEL_FILES
+    if args.models_dir:
+        files = {name: os.path.join(args.models_dir, os.path.basename(path)) for name, path in MODEL_FILES.items()}
+    models = load_pickled_models(files)
+    if models is None:
+        sys.exit(1)
+
+    info = export_model(models['model'], models['scaler'], models['label_encoder'], args.output)
+    print(f"✅ Đã ghi {args.output}: {info['trees']} cây, {info['nodes']} nút, "
+          f"độ sâu {info['max_depth']}, {info['classes']} lớp, {os.path.getsize(args.output) / 1024:.0f} KB")
+
+    compiled = CompiledModel.load(args.output)
+    frame = pd.read_csv(args.dataset)[compiled.features]
+    if not verify(models, compiled, frame):
+        os.remove(args.output)
+        sys.exit("❌ Model biên dịch cho kết quả khác model gốc, đã xóa file")
+    print("✅ Kết quả dự đoán giống hệt model gốc")
+
+
+if __name__ == '__main__':
+    main()
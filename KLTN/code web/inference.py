@@ -0,0 +1,248 @@
+import asyncio
+import multiprocessing
+import os
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+from metrics import INFERENCE_COMPUTE_SECONDS, INFERENCE_FAILURES, INFERENCE_IN_FLIGHT, INFERENCE_SECONDS
+from model_registry import MODEL_KEEP_VERSIONS, ModelLoadError, PredictorCache, model_registry
+
+# "process" = process pool (mặc định), "thread" = thread riêng, "inline" = chạy thẳng trên event loop như cũ
+INFERENCE_EXECUTOR = os.getenv("INFERENCE_EXECUTOR", "process").lower()
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", 1))
+# Số lời gọi đang chờ/chạy tối đa; vượt quá thì từ chối ngay (503) thay vì xếp hàng vô hạn
+INFERENCE_MAX_PENDING = int(os.getenv("INFERENCE_MAX_PENDING", 16))
+INFERENCE_TIMEOUT = float(os.getenv("INFERENCE_TIMEOUT", 10))
+
+LATENCY_WINDOW = 1000
+
+
+class InferenceSaturated(Exception):
+    """Every inference slot is taken; the caller should answer 503"""
+
+
+class InferenceTimeout(Exception):
+    """The call did not finish within INFERENCE_TIMEOUT"""
+
+
+# --- Chạy trong process worker ---
+_worker_cache = None
+
+
+def _init_worker(keep):
+    # Mỗi worker tự giữ các phiên bản model đã tải, tải lần đầu khi có request dùng tới
+    global _worker_cache
+    _worker_cache = PredictorCache(keep)
+
+
+def _run(cache, version, method, args):
+    started = time.perf_counter()
+    predictor = cache.get(version)
+    result = getattr(predictor, method)(*args)
+    return result, time.perf_counter() - started
+
+
+def _worker_call(version, method, args):
+    return _run(_worker_cache, version, method, args)
+
+
+class InferenceExecutor:
+    """Run CropPredictor methods off the event loop with bounded concurrency.
+
+    call(method, *args) forwards to the predictor of the version resolved by
+    the model registry, in a worker process (each worker loads a version on
+    its first call), a thread, or inline. At most `max_pending`
+    calls are queued or running; beyond that InferenceSaturated is raised at
+    once. A timed-out call keeps its slot until the worker actually finishes,
+    so the bound reflects real load.
+    """
+
+    def __init__(self, mode: str = INFERENCE_EXECUTOR, workers: int = INFERENCE_WORKERS,
+                 max_pending: int = INFERENCE_MAX_PENDING, timeout: float = INFERENCE_TIMEOUT,
+                 registry=model_registry):
+        if mode not in ('process', 'thread', 'inline'):
+            raise ValueError(f"INFERENCE_EXECUTOR không hợp lệ: {mode}")
+        self.mode = mode
+        self.workers = max(1, workers)
+        self.max_pending = max(1, max_pending)
+        self.timeout = timeout
+        self.registry = registry
+        self._pool = None
+        self._in_flight = 0
+        self._started_at = None
+        self._busy = 0.0
+        self._latency = deque(maxlen=LATENCY_WINDOW)
+        self._compute = deque(maxlen=LATENCY_WINDOW)
+        self._worker_loaded = OrderedDict()   # process: version.key -> tên, các phiên bản worker đã dùng gần nhất
+        self.completed = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.errors = 0
+        INFERENCE_IN_FLIGHT.set_function(lambda: self._in_flight)
+
+    def _create_pool(self):
+        if self.mode == 'process':
+            # spawn: không fork process đang có event loop và thread của paho
+            self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'),
+                                             initializer=_init_worker, initargs=(self.registry.keep,))
+        elif self.mode == 'thread':
+            self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix='inference')
+
+    def start(self):
+        """Create the pool; models are loaded on the first prediction"""
+        self._started_at = time.monotonic()
+        self._create_pool()
+        print(f"✅ Inference executor: {self.mode}, {self.workers} worker, tối đa {self.max_pending} lời gọi")
+
+    @property
+    def available(self) -> bool:
+        return (self._pool is not None or self.mode == 'inline') and self.registry.available
+
+    async def warm_up(self, version):
+        """Load a new version in every worker ahead of real requests (best effort)"""
+        try:
+            await asyncio.gather(*(self.call('stats', version=version.name) for _ in range(self.workers)))
+        except ModelLoadError as e:
+            self.registry.mark_failed(version, e) # quay lại phiên bản trước trước khi có request thật
+        except Exception as e:
+            print(f"⚠️ Không nạp trước được model {version.name}: {e}")
+
+    async def shutdown(self):
+        if self._pool is not None:
+            pool, self._pool = self._pool, None
+            await asyncio.to_thread(pool.shutdown, True, cancel_futures=True)
+
+    def _release(self, _=None):
+        self._in_flight -= 1
+
+    async def call(self, method: str, *args, version: str = None):
+        """Run predictor.<method>(*args) on one model version; returns (result, ModelVersion).
+
+        Raises InferenceSaturated / InferenceTimeout / ModelLoadError. If the
+        active version fails to load, it is marked failed and the call is
+        retried once on the version the registry falls back to.
+        """
+        resolved = self.registry.resolve(version)
+        try:
+            return await self._call(resolved, method, args), resolved
+        except ModelLoadError as e:
+            if version:
+                raise
+            self.registry.mark_failed(resolved, e)
+        resolved = self.registry.resolve()
+        return await self._call(resolved, method, args), resolved
+
+    async def _call(self, resolved, method, args):
+        if not self.available:
+            raise RuntimeError("Chức năng dự đoán chưa sẵn sàng")
+        if self._in_flight >= self.max_pending:
+            self.rejected += 1
+            INFERENCE_FAILURES.labels('saturated').inc()
+            raise InferenceSaturated(f"Đang có {self._in_flight} lời gọi dự đoán")
+        self._in_flight += 1
+        started = time.perf_counter()
+        try:
+            if self.mode == 'inline':
+                try:
+                    result, compute = _run(self.registry.cache, resolved, method, args)
+                finally:
+                    self._release()
+            else:
+                loop = asyncio.get_running_loop()
+                if self.mode == 'process':
+                    future = loop.run_in_executor(self._pool, _worker_call, resolved, method, args)
+                else:
+                    future = loop.run_in_executor(self._pool, _run, self.registry.cache, resolved, method, args)
+                future.add_done_callback(self._release)
+                try:
+                    result, compute = await asyncio.wait_for(asyncio.shield(future), self.timeout)
+                except asyncio.TimeoutError:
+                    self.timeouts += 1
+                    INFERENCE_FAILURES.labels('timeout').inc()
+                    raise InferenceTimeout(f"Dự đoán quá {self.timeout}s")
+        except BrokenProcessPool as e:
+            self.errors += 1
+            INFERENCE_FAILURES.labels('error').inc()
+            print(f"❌ Process dự đoán bị dừng, tạo lại pool: {e}")
+            self._create_pool()
+            raise
+        except ModelLoadError:
+            INFERENCE_FAILURES.labels('model').inc()
+            raise
+        except (InferenceTimeout, asyncio.CancelledError):
+            raise
+        except Exception:
+            self.errors += 1
+            INFERENCE_FAILURES.labels('error').inc()
+            raise
+        latency = time.perf_counter() - started
+        if self.mode == 'process':
+            # Worker giữ tối đa registry.keep phiên bản (LRU) → phiên bản vừa chạy chắc chắn đang nằm trong worker
+            self._worker_loaded[resolved.key] = resolved.name
+            self._worker_loaded.move_to_end(resolved.key)
+            while len(self._worker_loaded) > self.registry.keep:
+                self._worker_loaded.popitem(last=False)
+        self.completed += 1
+        self._busy += compute
+        self._compute.append(compute * 1000)
+        self._latency.append(latency * 1000)
+        INFERENCE_SECONDS.labels(method).observe(latency)
+        INFERENCE_COMPUTE_SECONDS.labels(method).observe(compute)
+        return result
+
+    async def predict_records(self, records, version: str = None):
+        """Crop labels for the records and the name of the model version that produced them"""
+        labels, resolved = await self.call('predict_records', records, version=version)
+        return labels, resolved.name
+
+    async def predict_top_k(self, records, k: int, version: str = None):
+        """The k most probable crops per record (one predict_proba call) and the model version name"""
+        ranked, resolved = await self.call('predict_top_k', records, k, version=version)
+        return ranked, resolved.name
+
+    def cache_stats(self):
+        """LRU cache stats of the active in-process predictor (None with a process pool: one cache per worker)"""
+        if self.mode == 'process' or self.registry.active is None:
+            return None
+        predictor = self.registry.cache.peek(self.registry.active)
+        return predictor.stats() if predictor is not None else None
+
+    @staticmethod
+    def _percentiles(samples):
+        if not samples:
+            return None
+        values = np.fromiter(samples, dtype=float)
+        p50, p95, p99 = np.percentile(values, [50, 95, 99])
+        return {'p50': round(p50, 2), 'p95': round(p95, 2), 'p99': round(p99, 2),
+                'max': round(values.max(), 2), 'samples': len(values)}
+
+    def stats(self) -> dict:
+        uptime = time.monotonic() - self._started_at if self._started_at else 0
+        models = self.registry.stats()
+        if self.mode == 'process':
+            # Model được tải trong các worker, không phải process này: báo các phiên bản worker đã dùng gần đây
+            models['loaded'] = list(self._worker_loaded.values())
+        return {
+            'mode': self.mode,
+            'available': self.available,
+            'workers': self.workers,
+            'in_flight': self._in_flight,
+            'max_pending': self.max_pending,
+            # Tỷ lệ thời gian worker bận tính toán kể từ khi khởi động
+            'utilization': round(self._busy / (uptime * self.workers), 4) if uptime else 0.0,
+            'completed': self.completed,
+            'rejected': self.rejected,
+            'timeouts': self.timeouts,
+            'errors': self.errors,
+            'latency_ms': self._percentiles(self._latency),
+            'compute_ms': self._percentiles(self._compute),
+            'cache': self.cache_stats(),
+            'models': models
+        }
+
+
+inference = InferenceExecutor()
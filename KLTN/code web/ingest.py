@@ -0,0 +1,172 @@
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+import pytz
+from psycopg2.extras import execute_values
+
+from db import get_connection, run_db, timed_query
+from rollups import apply_rollups, vn_wall_time
+from weather import get_rainfall_data, get_last_month_rainfall
+
+vn_tz = pytz.timezone('Asia/Ho_Chi_Minh')
+
+# Khoảng cách tối thiểu (giây) giữa 2 mẫu được lưu; 0 = lưu mọi mẫu (độ phân giải đầy đủ)
+SENSOR_PERSIST_INTERVAL = float(os.getenv("SENSOR_PERSIST_INTERVAL", 0))
+# Ghi xuống DB khi đủ INGEST_BATCH_SIZE mẫu hoặc sau INGEST_FLUSH_INTERVAL giây
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", 100))
+INGEST_FLUSH_INTERVAL = float(os.getenv("INGEST_FLUSH_INTERVAL", 10))
+# Giới hạn bộ đệm khi DB không ghi được; đầy thì bỏ mẫu cũ nhất
+INGEST_MAX_BUFFER = int(os.getenv("INGEST_MAX_BUFFER", 10000))
+
+SENSOR_FIELDS = ['temperature', 'humidity', 'nitrogen', 'phosphorus', 'potassium', 'ph']
+
+
+@timed_query
+def write_sensor_batch(samples, rainfall, monthly_rainfall):
+    """Insert (timestamp, payload) samples in one statement and update the rollups"""
+    rows = []
+    rollup_samples = []
+    for timestamp, data in samples:
+        timestamp = vn_wall_time(timestamp)
+        values = {field: data.get(field, 0) for field in SENSOR_FIELDS}
+        values['rainfall'] = rainfall
+        rows.append((timestamp, *(values[field] for field in SENSOR_FIELDS), rainfall, monthly_rainfall))
+        rollup_samples.append((timestamp, values))
+    with get_connection() as conn:
+        cur = conn.cursor()
+        execute_values(cur, '''INSERT INTO sensor_history
+                        (timestamp, temperature, humidity, nitrogen, phosphorus, potassium, ph, rainfall, monthly_rainfall)
+                        VALUES %s''', rows, page_size=max(len(rows), 1))
+        # Cùng transaction với INSERT để bảng rollup không lệch với sensor_history
+        apply_rollups(cur, rollup_samples)
+
+
+class IngestBuffer:
+    """Thread-safe sensor buffer drained in batches by one asyncio writer task.
+
+    submit() is called from the paho network thread and only appends to a
+    deque; weather lookups and the INSERT happen in the writer task.
+    """
+
+    def __init__(self, persist_interval: float = SENSOR_PERSIST_INTERVAL, batch_size: int = INGEST_BATCH_SIZE,
+                 flush_interval: float = INGEST_FLUSH_INTERVAL, max_buffer: int = INGEST_MAX_BUFFER):
+        self.persist_interval = persist_interval
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self._buffer = deque(maxlen=max_buffer)
+        self._lock = threading.Lock()
+        self._last_accepted = None
+        self._loop = None
+        self._wakeup = None
+        self._task = None
+        self.accepted = 0
+        self.skipped = 0
+        self.dropped = 0
+        self.written = 0
+        self.failed_flushes = 0
+
+    def submit(self, data: dict):
+        """Queue one sensor payload; safe to call from any thread"""
+        now = time.monotonic()
+        with self._lock:
+            if (self.persist_interval > 0 and self._last_accepted is not None
+                    and now - self._last_accepted < self.persist_interval):
+                self.skipped += 1
+                return False
+            self._last_accepted = now
+            if len(self._buffer) == self.max_buffer:
+                self.dropped += 1
+            self._buffer.append((datetime.now(vn_tz), dict(data)))
+            self.accepted += 1
+            full = len(self._buffer) >= self.batch_size
+        if full and self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+        return True
+
+    def start(self):
+        """Start the writer task on the running event loop"""
+        if self._task is None or self._task.done():
+            self._loop = asyncio.get_running_loop()
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._writer())
+
+    async def stop(self):
+        """Stop the writer task and flush whatever is still buffered"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        while self.pending and await self.flush():
+            pass
+        self._loop = None
+
+    @property
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._buffer)
+
+    def _take(self):
+        with self._lock:
+            count = min(len(self._buffer), self.batch_size)
+            return [self._buffer.popleft() for _ in range(count)]
+
+    def _requeue(self, batch):
+        # Đưa mẫu lỗi về đầu hàng đợi; nếu vượt giới hạn thì bỏ mẫu cũ nhất
+        with self._lock:
+            merged = batch + list(self._buffer)
+            overflow = max(0, len(merged) - self.max_buffer)
+            self.dropped += overflow
+            self._buffer = deque(merged[overflow:], maxlen=self.max_buffer)
+
+    async def flush(self) -> bool:
+        """Write one batch; returns False if the DB write failed"""
+        batch = self._take()
+        if not batch:
+            return True
+        try:
+            rainfall = await get_rainfall_data()
+            monthly_rainfall = await asyncio.to_thread(get_last_month_rainfall)
+            await run_db(write_sensor_batch, batch, rainfall, monthly_rainfall)
+        except Exception as e:
+            self.failed_flushes += 1
+            self._requeue(batch)
+            print(f"❌ Lỗi khi lưu {len(batch)} mẫu vào PostgreSQL: {e}")
+            return False
+        self.written += len(batch)
+        print(f"✅ Đã lưu {len(batch)} mẫu sensor vào PostgreSQL (lượng mưa: {rainfall}mm)")
+        return True
+
+    async def _writer(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            # Xả liên tục khi bộ đệm còn đủ một batch; lỗi DB thì chờ chu kỳ sau
+            while await self.flush() and self.pending >= self.batch_size:
+                pass
+
+    def stats(self) -> dict:
+        return {
+            'pending': self.pending,
+            'accepted': self.accepted,
+            'skipped': self.skipped,
+            'dropped': self.dropped,
+            'written': self.written,
+            'failed_flushes': self.failed_flushes,
+            'persist_interval': self.persist_interval,
+            'batch_size': self.batch_size,
+            'flush_interval': self.flush_interval
+        }
+
+
+ingest_buffer = IngestBuffer()
@@ -1,33 +1,39 @@
 import asyncio
+import base64
 import json
 import os
 import ssl
 import time
-import warnings
-from collections import defaultdict
 from datetime import datetime, timedelta, timezone
-import aiohttp
-import joblib
+from typing import Optional, Tuple
 import numpy as np
-import pandas as pd
 import paho.mqtt.client as mqtt
-import requests
 from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, RedirectResponse
+from fastapi.responses import JSONResponse, RedirectResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
-from sklearn.exceptions import InconsistentVersionWarning
 from dotenv import load_dotenv
 import uvicorn
-import psycopg2
 from psycopg2.extras import RealDictCursor
 import pytz
 from device_timer import DeviceTimer
+from db import init_pool, close_pool, get_connection, run_db, shutdown_executor, timed_query
+from weather import get_rainfall_data, get_last_month_rainfall, get_forecast_rainfall
+from downsample import downsample_series
+from rollups import create_rollup_tables, get_rollups, vn_wall_time, ROLLUP_TABLES
+from ingest import ingest_buffer
+from mqtt_bridge import mqtt_bridge
+from metrics import WS_BROADCAST_SECONDS, WS_CLIENTS, WS_MAX_CLIENT_LAG, WS_QUEUED_FRAMES, render as render_metrics
+from ws_writer import ClientWriter, WS_SEND_TIMEOUT
+from crop_predictor import PREDICT_MAX_BATCH, PREDICT_TOP_K
+from crop_requirements import crop_requirements, PARAMETERS, INPUT_KEYS, TOP_K
+from inference import inference, InferenceSaturated, InferenceTimeout
+from model_registry import model_registry, ModelLoadError
+from mqtt_async import AsyncMQTTTransport, MQTT_TRANSPORT, MQTT_SOCKET_TRANSPORT, MQTT_USE_TLS
 from contextlib import asynccontextmanager
 import random
 
-warnings.filterwarnings("ignore", category=InconsistentVersionWarning)
 
 @asynccontextmanager
 
@@ -54,23 +60,43 @@ warnings.filterwarnings("ignore", category=InconsistentVersionWarning)
 
 async def lifespan(app: FastAPI):
     try:
+        # --- KHỞI TẠO CONNECTION POOL POSTGRESQL ---
+        try:
+            init_pool()
+            await run_db(init_db)
+        except Exception as e:
+            print(f"❌ Lỗi khi tạo PostgreSQL connection pool: {e}")
+        ingest_buffer.start() # task ghi sensor_history theo lô
+        inference.start() # model được tải ở lần dự đoán đầu tiên
+        await model_registry.start(inference.warm_up) # quét models/ rồi theo dõi để đổi sang phiên bản mới
         global mqtt_client
-        mqtt_client = MQTTClient()
+        mqtt_client = create_mqtt_client()
         await mqtt_client.connect()
         mqtt_client._reconnect_task = asyncio.create_task(mqtt_client.keep_alive())
         # --- KHỞI TẠO TIMER ---
         global device_timer
-        # Khi khởi tạo, nó sẽ gọi load_timers -> và tự động start các task nhờ đoạn code vừa sửa ở trên
+        # Khi khởi tạo, nó sẽ gọi load_timers -> và tự động start các task; chỉ tạo một lần ở đây
         device_timer = DeviceTimer(mqtt_client)
+        device_timer.start_catchup() # bù các mốc bật/tắt bị lỡ trong lúc server tắt
         print("✅ Timer Service đã khởi động")
         # ----------------------
+        ws_manager.start() # 1 task duy nhất gửi dữ liệu định kỳ cho mọi WebSocket
 
         print("✅ Khởi động thành công")
         yield
     finally:
         try:
+            await ws_manager.stop()
+            if device_timer:
+                await device_timer.stop()
             if mqtt_client:
                 await mqtt_client.disconnect()
+            await mqtt_bridge.stop()
+            await ingest_buffer.stop() # ghi nốt các mẫu còn trong bộ đệm
+            await model_registry.stop_watching()
+            await inference.shutdown()
+            shutdown_executor()
+            close_pool()
             print("✅ Đã dừng ứng dụng")
         except Exception as e:
             print(f"❌ Lỗi khi dừng ứng dụng: {str(e)}")
@@ -99,39 +125,19 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
-# Load mô hình AI dự đoán cây trồng
-MODEL_FILES = {
-    'model': 'models/lgbm_crop_model.pkl',
-    'scaler': 'models/scaler.pkl',
-    'label_encoder': 'models/label_encoder.pkl'
-}
-
-def load_ml_models():
-    """Load machine learning models and return them"""
-    try:
-        models = {}
-        for name, file in MODEL_FILES.items():
-            if not os.path.exists(file):
-                print(f"⚠️ File model {file} không tồn tại")
-                return None
-            models[name] = joblib.load(file)
-            print(f"✅ Đã tải {file} thành công")
-        return models
-    except Exception as e:
-        print(f"❌ Lỗi khi tải model: {str(e)}")
-        return None
-
-ml_models = load_ml_models()
-if ml_models:
-    model = ml_models['model']
-    scaler = ml_models['scaler']
-    label_encoder = ml_models['label_encoder']
-else:
-    model = None
-    scaler = None
-    label_encoder = None
-    print("⚠️ Không thể tải models, một số chức năng có thể không hoạt động")
+# Mô hình AI dự đoán cây trồng chạy trong process pool (inference.py), khởi động trong lifespan
+# Phiên bản model do model_registry quản lý (models/ và các thư mục con), chọn bằng ?model_version=
+
+def inference_busy_response(e: Exception):
+    """503 khi hàng đợi dự đoán đầy hoặc không tải được model, 504 khi quá thời gian"""
+    if isinstance(e, ModelLoadError):
+        return JSONResponse({'error': str(e)}, status_code=503)
+    if isinstance(e, InferenceSaturated):
+        return JSONResponse({'error': 'Máy chủ đang bận dự đoán, vui lòng thử lại sau'}, status_code=503,
+                            headers={'Retry-After': '1'})
+    return JSONResponse({'error': 'Dự đoán quá thời gian cho phép'}, status_code=504)
 # Config MQTT
 load_dotenv()
 
@@ -142,10 +148,13 @@ MQTT_PASSWORD = os.getenv("MQTT_PASSWORD")
 CONTROL_TOPIC = "iot/device/control/#" #Các topic điều khiển & nhận trạng thái từ thiết bị ESP32
 STATUS_TOPIC = "iot/device/status/#"
 TEST_TOPIC = "iot/test"
-
-API_KEY = os.getenv("API_KEY")
-CITY = os.getenv("CITY")
-URL = f'https://api.openweathermap.org/data/2.5/forecast?q={CITY}&appid={API_KEY}&units=metric&lang=en'
+MQTT_SUBSCRIPTIONS = [
+    ("iot/device/control/#", 1),
+    ("iot/device/status/#", 1),
+    ("iot/device/status_request/#", 1),
+    ("iot/sensor/data", 1),
+    ("iot/test", 1)
+]
 
 CONFIG_FILE = 'config.json'
 
@@ -156,32 +165,31 @@ CROP_TRANSLATIONS = {
     'watermelon': 'Dưa hấu', 'muskmelon': 'Dưa lưới', 'apple': 'Táo', 'orange': 'Cam', 'papaya': 'Đu đủ',
     'coconut': 'Dừa', 'cotton': 'Bông', 'jute': 'Đay', 'coffee': 'Cà phê'
 }
+# Nhãn, đơn vị và gợi ý khi thông số thấp/cao hơn ngưỡng lý tưởng (cảnh báo của /predict)
+PARAM_TEXT = {
+    'temperature': {'label': 'Nhiệt độ', 'unit': '°C', 'low': '🔼 Cần tăng nhiệt độ', 'high': '🔽 Cần giảm nhiệt độ'},
+    'humidity': {'label': 'Độ ẩm', 'unit': '%', 'low': '🔼 Cần tăng độ ẩm', 'high': '🔽 Cần giảm độ ẩm'},
+    'nitrogen': {'label': 'Nitrogen', 'unit': 'mg/kg', 'low': '🔼 Cần bổ sung phân đạm', 'high': '🔽 Cần giảm phân đạm'},
+    'phosphorus': {'label': 'Phosphorus', 'unit': 'mg/kg', 'low': '🔼 Cần bổ sung phân lân', 'high': '🔽 Cần giảm phân lân'},
+    'potassium': {'label': 'Potassium', 'unit': 'mg/kg', 'low': '🔼 Cần bổ sung phân kali', 'high': '🔽 Cần giảm phân kali'},
+    'ph': {'label': 'pH', 'unit': '', 'low': '🔼 Cần tăng độ pH', 'high': '🔽 Cần giảm độ pH'}
+}
 #Class MQTTClient – toàn bộ xử lý MQTT
 class MQTTClient:
     def __init__(self):
-        self.client = mqtt.Client(
-            client_id=f"iot_client_{int(time.time())}_{random.randint(1000, 9999)}",
-            transport="websockets" #Kết nối MQTT qua WebSocket
-        )
-        self.client.tls_set(
-            ca_certs=None,
-            certfile=None,
-            keyfile=None,
-            tls_version=ssl.PROTOCOL_TLSv1_2
-        )
-        self.client.tls_insecure_set(True)
-        self.client.on_connect = self.on_connect 
-        self.client.on_disconnect = self.on_disconnect # kích hoạt tự động reconnect
-        self.client.on_message = self.on_message
+        self.client = self._create_client()
+        # Message được chuyển sang event loop, xử lý bởi dispatcher theo nhóm topic
+        mqtt_bridge.register('control', self.handle_control)
+        mqtt_bridge.register('status', self.handle_status)
+        mqtt_bridge.register('sensor', self.handle_sensor)
         self.is_connected = False
         self.connection_lock = asyncio.Lock()
         self.max_reconnect_attempts = 10 # tối đa 10 lần thử
         self.reconnect_delay = 1 
         self.reconnect_backoff = 2 
         self.device_states = {'light': False, 'roof': False, 'pump': False, 'fan': False}
-        self.active_websockets = set()
+        self.reported_devices = set() # thiết bị đã báo trạng thái thật (status/control) → device_states đáng tin
         self.latest_data = None
-        self.last_db_update = None
         self._loop = None
         self._reconnect_task = None
         self._keep_alive_task = None
@@ -190,6 +198,24 @@ class MQTTClient:
         self._connection_attempts = 0
         self._last_connection_time = None
 
+    def _create_client(self):
+        """paho client driven by loop_start(); AsyncioMQTTClient builds its own through AsyncMQTTTransport"""
+        client = mqtt.Client(
+            client_id=f"iot_client_{int(time.time())}_{random.randint(1000, 9999)}",
+            transport="websockets" #Kết nối MQTT qua WebSocket
+        )
+        client.tls_set(
+            ca_certs=None,
+            certfile=None,
+            keyfile=None,
+            tls_version=ssl.PROTOCOL_TLSv1_2
+        )
+        client.tls_insecure_set(True)
+        client.on_connect = self.on_connect 
+        client.on_disconnect = self.on_disconnect # kích hoạt tự động reconnect
+        client.on_message = self.on_message
+        return client
+
     def on_connect(self, client, userdata, flags, rc): # Khi kết nối thành công: Gửi thông báo test lên MQTT
         if rc == 0:
             print("✅ Kết nối MQTT thành công")
@@ -200,14 +226,7 @@ class MQTTClient:
             self.is_connected = True
             self._last_connection_attempt = None
             
-            topics = [
-                ("iot/device/control/#", 1),
-                ("iot/device/status/#", 1),
-                ("iot/device/status_request/#", 1),
-                ("iot/sensor/data", 1),
-                ("iot/test", 1)
-            ]
-            self.client.subscribe(topics)
+            self.client.subscribe(MQTT_SUBSCRIPTIONS)
             
             self.client.publish("iot/test", json.dumps({
                 "type": "python_client_connected",
@@ -219,30 +238,29 @@ class MQTTClient:
             print(f"❌ Lỗi kết nối MQTT: {rc}")
             self.is_connected = False
             self._broadcast_connection_status(False)
-            if self._loop and not self._loop.is_closed():
-                self._loop.create_task(self.handle_reconnect())
+            self._run_in_loop(self.handle_reconnect())
 
 # Khi mất kết nối MQTT → kích hoạt tự động reconnect
     def on_disconnect(self, client, userdata, rc): 
         print(f"❌ Mất kết nối MQTT: {rc}")
         self.is_connected = False
         self._broadcast_connection_status(False)
-        if rc != 0 and self._loop and not self._loop.is_closed():
-            self._loop.create_task(self.handle_reconnect())
+        if rc != 0:
+            self._run_in_loop(self.handle_reconnect())
+
+    def _run_in_loop(self, coro):
+        # Callback của paho chạy trên thread riêng → phải chuyển coroutine sang event loop an toàn
+        if self._loop and not self._loop.is_closed():
+            return asyncio.run_coroutine_threadsafe(coro, self._loop)
+        coro.close()
+        return None
 
     def _broadcast_connection_status(self, connected):
-        closed_ws = set()
-        for ws in self.active_websockets:
-            try:
-                if self._loop and not self._loop.is_closed():
-                    self._loop.create_task(ws.send_json({
-                        "type": "mqtt_status",
-                        "connected": connected,
-                        "timestamp": int(time.time())
-                    }))
-            except Exception:
-                closed_ws.add(ws)
-        self.active_websockets -= closed_ws
+        self._run_in_loop(ws_manager.broadcast({
+            "type": "mqtt_status",
+            "connected": connected,
+            "timestamp": int(time.time())
+        }))
 
 #connect()
 #Thực hiện:
@@ -254,6 +272,7 @@ class MQTTClient:
         try:
             if self._loop is None:
                 self._loop = asyncio.get_event_loop()
+            mqtt_bridge.start()
 
             if self._reconnect_task:
                 self._reconnect_task.cancel()
@@ -348,67 +367,42 @@ class MQTTClient:
             print(f"❌ Lỗi điều khiển thiết bị {device}: {str(e)}")
             return False
 
-    def on_message(self, client, userdata, msg): # Nhận dữ liệu từ MQTT và xử lý:
-        try:
-            topic = msg.topic
-            payload = json.loads(msg.payload.decode())
-            print(f"MQTT nhận từ {topic}: {payload}")
-            # Nhận lệnh điều khiển
-            if topic.startswith("iot/device/control/"):
-                device = topic.split("/")[-1]
-                if device in self.device_states:
-                    status = payload.get("status")
-                    if status is not None:
-                        print(f"📥 Nhận từ {topic}: {payload}")
-                        self.device_states[device] = status
-                       
-                        closed_ws = set()
-                        for ws in self.active_websockets:
-                            try:
-                                if ws.application_state.name == "CONNECTED" and self._loop and not self._loop.is_closed():
-                                    self._loop.create_task(ws.send_json({
-                                        "type": "device_status",
-                                        "device": device,
-                                        "status": status,
-                                        "timestamp": int(time.time())
-                                    }))
-                                else:
-                                    closed_ws.add(ws)
-                            except Exception:
-                                closed_ws.add(ws)
-                        self.active_websockets -= closed_ws
-                        print(f"🔄 Đã cập nhật và broadcast {device}: {status}")
-
-            elif topic.startswith("iot/device/status/"):
-                device = topic.split("/")[-1]
-                if device in self.device_states:
-                    status = payload.get("status")
-                    if status is not None:
-                        print(f"📥 Nhận từ {topic}: {payload}")
-                        self.device_states[device] = status
-            # Nhận dữ liệu sensor
-            elif topic == "iot/sensor/data":
-                self.latest_data = payload # Lưu vào latest_data
-                                            # Gửi realtime cho WebSocket
-                                            # Mỗi 5 phút → ghi vào PostgreSQL
-                closed_ws = set()
-                for ws in self.active_websockets:
-                    try:
-                        if ws.application_state == ws.State.CONNECTED and self._loop and not self._loop.is_closed():
-                            self._loop.create_task(ws.send_json({"latest": self.latest_data}))
-                        else:
-                            closed_ws.add(ws)
-                    except Exception:
-                        closed_ws.add(ws)
-                self.active_websockets -= closed_ws
-                
-                now = datetime.now()
-                if not self.last_db_update or (now - self.last_db_update).total_seconds() >= 300:
-                    save_to_db(payload)
-                    self.last_db_update = now
-
-        except Exception as e:
-            print(f"❌ Lỗi xử lý message: {str(e)}")
+    def on_message(self, client, userdata, msg): # Chạy trên thread của paho: chỉ chuyển message sang event loop
+        mqtt_bridge.submit(msg.topic, msg.payload)
+
+    async def handle_control(self, topic, raw): # Nhận lệnh điều khiển → cập nhật trạng thái + báo cho WebSocket
+        payload = json.loads(raw.decode())
+        device = topic.split("/")[-1]
+        if device in self.device_states:
+            status = payload.get("status")
+            if status is not None:
+                print(f"📥 Nhận từ {topic}: {payload}")
+                self.device_states[device] = status
+                self.reported_devices.add(device)
+                await ws_manager.broadcast({
+                    "type": "device_status",
+                    "device": device,
+                    "status": status,
+                    "timestamp": int(time.time())
+                })
+                print(f"🔄 Đã cập nhật và broadcast {device}: {status}")
+
+    async def handle_status(self, topic, raw): # Trạng thái thiết bị do ESP32 báo về
+        payload = json.loads(raw.decode())
+        device = topic.split("/")[-1]
+        if device in self.device_states:
+            status = payload.get("status")
+            if status is not None:
+                print(f"📥 Nhận từ {topic}: {payload}")
+                self.device_states[device] = status
+                self.reported_devices.add(device)
+
+    async def handle_sensor(self, topic, raw): # Nhận dữ liệu sensor
+        payload = json.loads(raw.decode())
+        print(f"MQTT nhận từ {topic}: {payload}")
+        self.latest_data = payload # Lưu vào latest_data
+        ingest_buffer.submit(payload) # Đưa vào bộ đệm ghi PostgreSQL theo lô
+        await ws_manager.broadcast_latest(self.latest_data) # Gửi realtime cho WebSocket
 
     def publish_all_states(self):
         for device, status in self.device_states.items():
@@ -432,272 +426,338 @@ class MQTTClient:
         except Exception as e:
             print(f"❌ Lỗi khi ngắt kết nối MQTT: {str(e)}")
 
+# MQTT_TRANSPORT=asyncio: cùng giao diện MQTTClient (control_device, device_states, latest_data)
+# nhưng paho chạy trên event loop qua AsyncMQTTTransport, không có thread loop_start
+class AsyncioMQTTClient(MQTTClient):
+    def __init__(self):
+        super().__init__()
+        self.transport.on_connection_change = self._on_connection_change
+        self._pump_task = None
+
+    def _create_client(self):
+        # Chỉ tạo client của transport (callback do AsyncMQTTTransport gắn), không dựng thêm client paho/TLS thừa
+        self.transport = AsyncMQTTTransport(
+            client_id=f"iot_client_{int(time.time())}_{random.randint(1000, 9999)}",
+            transport=MQTT_SOCKET_TRANSPORT,
+            use_tls=MQTT_USE_TLS,
+            tls_insecure=True,
+            username=MQTT_USERNAME,
+            password=MQTT_PASSWORD
+        )
+        return self.transport.client
+
+    def _on_connection_change(self, connected, rc):
+        if connected == self.is_connected:
+            return
+        print("✅ Kết nối MQTT thành công" if connected else f"❌ Mất kết nối MQTT: {rc}")
+        self.is_connected = connected
+        self._broadcast_connection_status(connected)
+
+    async def connect(self):
+        self._loop = asyncio.get_running_loop()
+        mqtt_bridge.start()
+        try:
+            await self.transport.connect(MQTT_BROKER, MQTT_PORT, timeout=self._connection_timeout)
+            await self.transport.subscribe(MQTT_SUBSCRIPTIONS)
+            await self.transport.publish(TEST_TOPIC, json.dumps({
+                "type": "python_client_connected",
+                "timestamp": int(time.time())
+            }), qos=1)
+        except Exception as e:
+            print(f"❌ Lỗi kết nối MQTT: {str(e)}")
+            self._connection_attempts += 1
+            raise
+        self._last_connection_time = time.time()
+        self._connection_attempts = 0
+        if self._pump_task is None or self._pump_task.done():
+            self._pump_task = asyncio.create_task(self._pump())
+
+    async def _pump(self): # Message đã ở trên event loop → đưa thẳng vào dispatcher theo nhóm topic
+        async for topic, payload in self.transport.messages():
+            mqtt_bridge.submit(topic, payload)
+
+    async def keep_alive(self):
+        """Reconnect when the transport reports a lost connection (no polling)"""
+        while True:
+            try:
+                await self.transport.wait_disconnected()
+                await self.handle_reconnect()
+                if not self.is_connected:
+                    await asyncio.sleep(30)
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                print(f"❌ Lỗi trong keep_alive: {str(e)}")
+                await asyncio.sleep(5)
+
+    def control_device(self, device, status):
+        if not self.is_connected:
+            print("❌ Không thể điều khiển thiết bị: MQTT chưa kết nối")
+            return False
+        try:
+            topic = f"iot/device/control/{device}"
+            payload = json.dumps({
+                "status": status,
+                "timestamp": int(time.time())
+            })
+            ack = self.transport.publish_nowait(topic, payload, qos=1)
+            ack.add_done_callback(lambda f: self._log_control_ack(device, status, f))
+            self._last_connection_time = time.time()
+            return True
+        except Exception as e:
+            print(f"❌ Lỗi điều khiển thiết bị {device}: {str(e)}")
+            return False
+
+    async def control_device_acked(self, device, status, timeout=10):
+        """Publish a control command and wait for the broker PUBACK"""
+        topic = f"iot/device/control/{device}"
+        payload = json.dumps({"status": status, "timestamp": int(time.time())})
+        await self.transport.publish(topic, payload, qos=1, timeout=timeout)
+        return True
+
+    @staticmethod
+    def _log_control_ack(device, status, future):
+        if future.cancelled():
+            return
+        if future.exception():
+            print(f"❌ Lỗi gửi lệnh điều khiển {device}: {future.exception()}")
+        else:
+            print(f"✅ Đã gửi lệnh điều khiển {device}: {'ON' if status else 'OFF'}")
+
+    async def disconnect(self):
+        try:
+            for task in (self._reconnect_task, self._keep_alive_task, self._pump_task):
+                if task:
+                    task.cancel()
+            self._reconnect_task = self._keep_alive_task = self._pump_task = None
+            await self.transport.disconnect()
+            self._on_connection_change(False, 0)
+            print("✅ Đã ngắt kết nối MQTT")
+        except Exception as e:
+            print(f"❌ Lỗi khi ngắt kết nối MQTT: {str(e)}")
+
+def create_mqtt_client():
+    return AsyncioMQTTClient() if MQTT_TRANSPORT == "asyncio" else MQTTClient()
+
 vn_tz = pytz.timezone('Asia/Ho_Chi_Minh')
 # Các object chính
 mqtt_client = MQTTClient() # MQTT client dùng giao tiếp realtime
-device_timer = DeviceTimer(mqtt_client) # device_timer dùng để tự động tắt thiết bị sau X phút
+# device_timer dùng để tự động tắt thiết bị sau X phút; chỉ tạo trong lifespan vì load_timers xóa hẹn giờ
+# một lần đã hết hạn khỏi file → tạo lúc import sẽ làm bản trong lifespan mất các mốc cần bù khi khởi động
+device_timer: Optional[DeviceTimer] = None
 # PostgreSQL Database
+@timed_query
 def init_db():
     try:
-        conn = psycopg2.connect(
-            dbname=os.getenv("POSTGRES_DB", "sensor_data"),
-            user=os.getenv("POSTGRES_USER", "postgres"),
-            password=os.getenv("POSTGRES_PASSWORD", "postgres"),
-            host=os.getenv("POSTGRES_HOST", "localhost"),
-            port=os.getenv("POSTGRES_PORT", "5432")
-        )
-        cur = conn.cursor()
-        # Tạo bảng sensor_history
-        # Tạo bảng config
-        # Thêm bản ghi mẫu nếu DB trống
-        cur.execute('''CREATE TABLE IF NOT EXISTS sensor_history (
-                        id SERIAL PRIMARY KEY,
-                        timestamp TIMESTAMP,
-                        temperature REAL,
-                        humidity REAL,
-                        nitrogen REAL,
-                        phosphorus REAL,
-                        potassium REAL,
-                        ph REAL,
-                        rainfall REAL DEFAULT 0,
-                        monthly_rainfall REAL DEFAULT 0
-                    )''')
-
-        cur.execute('SELECT COUNT(*) FROM sensor_history')
-        if cur.fetchone()[0] == 0:
-            current_time = datetime.now(vn_tz)
-            monthly_rainfall = get_last_month_rainfall()
-            cur.execute('''INSERT INTO sensor_history
-                        (timestamp, temperature, humidity, nitrogen, phosphorus, potassium, ph, rainfall, monthly_rainfall)
-                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)''',
-                     (current_time, 29.3, 26.2, 17, 87, 80, 6.0, 0, monthly_rainfall))
-
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS config (
-                key TEXT PRIMARY KEY,
-                value JSONB
-            )
-        ''')
-
-        conn.commit()
-        conn.close()
+        with get_connection() as conn:
+            cur = conn.cursor()
+            # Tạo bảng sensor_history
+            # Tạo bảng config
+            # Thêm bản ghi mẫu nếu DB trống
+            cur.execute('''CREATE TABLE IF NOT EXISTS sensor_history (
+                            id SERIAL PRIMARY KEY,
+                            timestamp TIMESTAMP,
+                            temperature REAL,
+                            humidity REAL,
+                            nitrogen REAL,
+                            phosphorus REAL,
+                            potassium REAL,
+                            ph REAL,
+                            rainfall REAL DEFAULT 0,
+                            monthly_rainfall REAL DEFAULT 0
+                        )''')
+            # Index cho truy vấn theo khoảng thời gian + phân trang keyset của /history
+            cur.execute('''CREATE INDEX IF NOT EXISTS idx_sensor_history_timestamp
+                        ON sensor_history (timestamp DESC, id DESC)''')
+
+            cur.execute('SELECT COUNT(*) FROM sensor_history')
+            if cur.fetchone()[0] == 0:
+                current_time = vn_wall_time(datetime.now(vn_tz))
+                monthly_rainfall = get_last_month_rainfall()
+                cur.execute('''INSERT INTO sensor_history
+                            (timestamp, temperature, humidity, nitrogen, phosphorus, potassium, ph, rainfall, monthly_rainfall)
+                            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)''',
+                         (current_time, 29.3, 26.2, 17, 87, 80, 6.0, 0, monthly_rainfall))
+            # Bảng tổng hợp theo giờ/ngày (tự backfill lần đầu nếu đã có dữ liệu)
+            create_rollup_tables(cur)
+
+            cur.execute('''
+                CREATE TABLE IF NOT EXISTS config (
+                    key TEXT PRIMARY KEY,
+                    value JSONB
+                )
+            ''')
         print("✅ Đã khởi tạo PostgreSQL database và thêm dữ liệu mẫu")
     except Exception as e:
         print(f"❌ Lỗi khi khởi tạo PostgreSQL: {e}")
-# Ghi sensor + lương mưa vào database
-def save_to_db(data):
-    try:
-        conn = psycopg2.connect(
-            dbname=os.getenv("POSTGRES_DB", "sensor_data"),
-            user=os.getenv("POSTGRES_USER", "postgres"),
-            password=os.getenv("POSTGRES_PASSWORD", "postgres"),
-            host=os.getenv("POSTGRES_HOST", "localhost"),
-            port=os.getenv("POSTGRES_PORT", "5432")
-        )
-        cur = conn.cursor()
-        current_time = datetime.now(vn_tz)
-        current_rainfall = asyncio.run(get_rainfall_data())
-        monthly_rainfall = get_last_month_rainfall()
-        cur.execute('''INSERT INTO sensor_history
-                    (timestamp, temperature, humidity, nitrogen, phosphorus, potassium, ph, rainfall, monthly_rainfall)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)''',
-                 (current_time,
-                  data.get('temperature', 0),
-                  data.get('humidity', 0),
-                  data.get('nitrogen', 0),
-                  data.get('phosphorus', 0),
-                  data.get('potassium', 0),
-                  data.get('ph', 0),
-                  current_rainfall,
-                  monthly_rainfall))
-        conn.commit()
-        conn.close()
-        print(f"✅ Đã lưu dữ liệu vào PostgreSQL: {data}")
-        print(f"🌧️ Lượng mưa hiện tại: {current_rainfall}mm")
-        print(f"🌧️ Tổng lượng mưa tháng trước: {monthly_rainfall}mm")
-    except Exception as e:
-        print(f"❌ Lỗi khi lưu vào PostgreSQL: {e}")
 # Lấy lịch sử cảm biến → trả JSON
-def get_history_from_db():
-    try:
-        conn = psycopg2.connect(
-            dbname=os.getenv("POSTGRES_DB", "sensor_data"),
-            user=os.getenv("POSTGRES_USER", "postgres"),
-            password=os.getenv("POSTGRES_PASSWORD", "postgres"),
-            host=os.getenv("POSTGRES_HOST", "localhost"),
-            port=os.getenv("POSTGRES_PORT", "5432")
-        )
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-        cur.execute('''SELECT timestamp, temperature, humidity, rainfall, nitrogen, phosphorus, potassium, ph, monthly_rainfall
-                    FROM sensor_history
-                    ORDER BY timestamp DESC''')
-        rows = cur.fetchall()
-        conn.close()
-
-        def ensure_vn_tz(dt):
-            if dt is None:
-                return None
-            if dt.tzinfo is None:
-                return dt.replace(tzinfo=vn_tz)
-            return dt.astimezone(vn_tz)
-        # return [{
-        #     'timestamp': ensure_vn_tz(row['timestamp']).isoformat() if row['timestamp'] else None,
-        #     'temperature': row['temperature'],
-        #     'humidity': row['humidity'],
-        #     'rainfall': row['rainfall'],
-        #     'nitrogen': row['nitrogen'],
-        #     'phosphorus': row['phosphorus'],
-        #     'potassium': row['potassium'],
-        #     'ph': row['ph'],
-        #     'monthly_rainfall': row['monthly_rainfall']
-        # } for row in rows]
-        return [{
-            'timestamp': row['timestamp'].strftime('%Y-%m-%d %H:%M:%S') if row['timestamp'] else None,
-            'temperature': row['temperature'],
-            'humidity': row['humidity'],
-            'rainfall': row['rainfall'],
-            'nitrogen': row['nitrogen'],
-            'phosphorus': row['phosphorus'],
-            'potassium': row['potassium'],
-            'ph': row['ph'],
-            'monthly_rainfall': row['monthly_rainfall']
-        } for row in rows]
-    except Exception as e:
-        print(f"Error getting history from DB: {e}")
-        return []
-# Hàm lấy dữ liệu lượng mưa
-async def get_rainfall_data():
-    try:
-        latitude = 10.8471
-        longitude = 106.7872
-        start_date = end_date = datetime.now().strftime('%Y-%m-%d')
-        # API: open-meteo.com
-        # Lấy lượng mưa hằng ngày tại vị trí cố định
-        # Chạy bất đồng bộ
-        url = (
-            f"https://api.open-meteo.com/v1/forecast?latitude={latitude}&longitude={longitude}" 
-            f"&start_date={start_date}&end_date={end_date}"
-            f"&daily=precipitation_sum&timezone=Asia/Ho_Chi_Minh"
-        )
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                if response.status != 200:
-                    print("Lỗi khi lấy dữ liệu thời tiết:", await response.text())
-                    return 0.0
-                data = await response.json()
-                rainfall_list = data.get("daily", {}).get("precipitation_sum", [])
-                total_rain_today = rainfall_list[0] if rainfall_list else 0.0
-
-                return total_rain_today
-    except Exception as e:
-        print("Lỗi khi lấy dữ liệu lượng mưa:", e)
-        return 0.0
-# Thống kê lượng mưa tháng trước
-def get_last_month_rainfall():
-    latitude = 10.8411
-    longitude = 106.8090
-    today = datetime.now()
-    first_day_last_month = (today.replace(day=1) - timedelta(days=1)).replace(day=1)
-    last_day_last_month = today.replace(day=1) - timedelta(days=1)
-    start_date = first_day_last_month.strftime("%Y-%m-%d")
-    end_date = last_day_last_month.strftime("%Y-%m-%d")
-    url = f"https://api.open-meteo.com/v1/forecast?latitude={latitude}&longitude={longitude}&start_date={start_date}&end_date={end_date}&daily=precipitation_sum&timezone=Asia/Ho_Chi_Minh"
-    try:
-        response = requests.get(url)
-        if response.status_code == 200:
-            data = response.json()
-            rainfall_data = data["daily"]["precipitation_sum"]
-            total_rainfall = sum(x for x in rainfall_data if x is not None)
-            return round(total_rainfall, 2)
-        else:
-            print(f"❌ Lỗi API lấy lượng mưa tháng trước: {response.status_code}")
-            return 0
-    except Exception as e:
-        print(f"❌ Lỗi khi lấy lượng mưa tháng trước: {e}")
-        return 0
+HISTORY_DEFAULT_LIMIT = int(os.getenv("HISTORY_DEFAULT_LIMIT", 500))
+HISTORY_MAX_LIMIT = int(os.getenv("HISTORY_MAX_LIMIT", 5000))
 
-async def get_forecast_rainfall():
-    # Gọi OpenWeather dự báo 5 ngày
+def parse_history_bound(value, is_end=False):
+    """Parse an ISO date/datetime query bound into naive Asia/Ho_Chi_Minh time"""
+    if not value:
+        return None
+    dt = datetime.fromisoformat(value.strip().replace('Z', '+00:00'))
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(vn_tz).replace(tzinfo=None) # Cột timestamp lưu giờ VN, không kèm múi giờ
+    if is_end and len(value.strip()) == 10:
+        dt += timedelta(days=1) # end=YYYY-MM-DD → lấy trọn ngày đó
+    return dt
+
+def encode_history_cursor(timestamp, row_id):
+    raw = f"{timestamp.isoformat()}|{row_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_history_cursor(cursor):
+    padded = cursor + '=' * (-len(cursor) % 4)
+    timestamp, row_id = base64.urlsafe_b64decode(padded.encode()).decode().split('|')
+    return datetime.fromisoformat(timestamp), int(row_id)
+
+@timed_query
+def get_history_page(start=None, end=None, limit=None, cursor=None):
+    """Return (rows newest first, next_cursor) for the requested window"""
+    conditions = []
+    params = []
+    if start is not None:
+        conditions.append('timestamp >= %s')
+        params.append(start)
+    if end is not None:
+        conditions.append('timestamp < %s')
+        params.append(end)
+    if cursor is not None:
+        conditions.append('(timestamp, id) < (%s, %s)') # Keyset: tiếp tục sau bản ghi cuối của trang trước
+        params.extend(cursor)
+    query = '''SELECT id, timestamp, temperature, humidity, rainfall, nitrogen, phosphorus, potassium, ph, monthly_rainfall
+               FROM sensor_history'''
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    query += ' ORDER BY timestamp DESC, id DESC'
+    if limit is not None:
+        query += ' LIMIT %s'
+        params.append(limit + 1) # Lấy dư 1 dòng để biết còn trang sau hay không
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(URL) as response:
-                if response.status != 200:
-                    print(f"OpenWeather API error: {response.status}")
-                    return {'today': {'rainfall': 0, 'temperature': 0, 'humidity': 0}, 'forecast_5days': []}
-                data = await response.json()
-                forecast_by_day = defaultdict(list)
-                # Gom dữ liệu theo ngày
-                # nhiệt độ trung bình
-                # độ ẩm trung bình
-                # tổng lượng mưa
-                # icon thời tiết
-                for entry in data['list']:
-                    dt = datetime.fromtimestamp(entry['dt'])
-                    date_str = dt.strftime('%Y-%m-%d')
-                    temp = entry['main']['temp']
-                    humidity = entry['main']['humidity']
-                    rain = entry.get('rain', {}).get('3h', 0)
-                    weather_info = entry.get('weather', [{}])[0]
-                    icon_code = weather_info.get('icon', '')
-                    description = weather_info.get('description', '')
-                    forecast_by_day[date_str].append({
-                        'time': dt.strftime('%H:%M'),
-                        'temp': temp,
-                        'humidity': humidity,
-                        'rain': rain,
-                        'icon_code': icon_code,
-                        'description': description
-                    })
-                today_str = datetime.now().strftime('%Y-%m-%d')
-                forecast_5days = []
-                today_data = {'rainfall': 0, 'temperature': 0, 'humidity': 0}
-                for idx, (date, entries) in enumerate(sorted(forecast_by_day.items())):
-                    avg_temp = sum(e['temp'] for e in entries) / len(entries)
-                    avg_humidity = sum(e['humidity'] for e in entries) / len(entries)
-                    total_rain = sum(e['rain'] for e in entries)
-                    mid_day_entry = entries[len(entries)//2] if entries else entries[0]
-                    icon_code = mid_day_entry.get('icon_code', '')
-                    description = mid_day_entry.get('description', '')
-                    icon_url = f"https://openweathermap.org/img/wn/{icon_code}@2x.png" if icon_code else ''
-                    forecast_5days.append({
-                        'date': date,
-                        'temperature': round(avg_temp, 2),
-                        'humidity': round(avg_humidity, 2),
-                        'rainfall': round(total_rain, 2),
-                        'description': description,
-                        'icon': icon_url
-                    })
-                    if date == today_str:
-                        today_data = {
-                            'rainfall': round(total_rain, 2),
-                            'temperature': round(avg_temp, 2),
-                            'humidity': round(avg_humidity, 2)
-                        }
-                    if len(forecast_5days) >= 5:
-                        break
-                
-                return {'today': today_data, 'forecast_5days': forecast_5days}
+        with get_connection() as conn:
+            cur = conn.cursor(cursor_factory=RealDictCursor)
+            cur.execute(query, params)
+            rows = cur.fetchall()
     except Exception as e:
-        print(f"Error fetching forecast data: {e}")
-        return {'today': {'rainfall': 0, 'temperature': 0, 'humidity': 0}, 'forecast_5days': []}
+        print(f"Error getting history from DB: {e}")
+        return [], None
+
+    next_cursor = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_history_cursor(rows[-1]['timestamp'], rows[-1]['id'])
+    return [format_history_row(row) for row in rows], next_cursor
+
+def format_history_row(row):
+    return {
+        'timestamp': row['timestamp'].strftime('%Y-%m-%d %H:%M:%S') if row['timestamp'] else None,
+        'temperature': row['temperature'],
+        'humidity': row['humidity'],
+        'rainfall': row['rainfall'],
+        'nitrogen': row['nitrogen'],
+        'phosphorus': row['phosphorus'],
+        'potassium': row['potassium'],
+        'ph': row['ph'],
+        'monthly_rainfall': row['monthly_rainfall']
+    }
+
+@timed_query
+def get_history_after(after_id=None, limit=HISTORY_DEFAULT_LIMIT):
+    """Return up to `limit` rows with id > after_id, newest first, each with its id (the WebSocket sequence number)"""
+    query = '''SELECT id, timestamp, temperature, humidity, rainfall, nitrogen, phosphorus, potassium, ph, monthly_rainfall
+               FROM sensor_history'''
+    params = []
+    if after_id is not None:
+        query += ' WHERE id > %s'
+        params.append(after_id)
+    query += ' ORDER BY id DESC LIMIT %s' # Khóa chính → chỉ đọc các dòng mới, không quét cả bảng
+    params.append(limit)
+    with get_connection() as conn:
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        cur.execute(query, params)
+        rows = cur.fetchall()
+    return [{'id': row['id'], **format_history_row(row)} for row in rows]
+
+def get_history_from_db(start=None, end=None, limit=None, cursor=None):
+    return get_history_page(start, end, limit, cursor)[0]
+# Gom nhóm lịch sử theo bucket thời gian cho biểu đồ (min/max/mean mỗi bucket)
+AGGREGATE_METRICS = ['temperature', 'humidity', 'nitrogen', 'phosphorus', 'potassium', 'ph', 'rainfall']
+AGGREGATE_BUCKETS = ('minute', 'hour', 'day')
+AGGREGATE_MAX_BUCKETS = int(os.getenv("AGGREGATE_MAX_BUCKETS", 2000))
+
+def _time_range_sql(start, end):
+    conditions, params = [], []
+    if start is not None:
+        conditions.append('timestamp >= %s')
+        params.append(start)
+    if end is not None:
+        conditions.append('timestamp < %s')
+        params.append(end)
+    return (' WHERE ' + ' AND '.join(conditions)) if conditions else '', params
+
+@timed_query
+def get_history_aggregate(bucket, start=None, end=None, max_buckets=AGGREGATE_MAX_BUCKETS):
+    """Return per-bucket count/min/max/mean for every metric, oldest first"""
+    where, params = _time_range_sql(start, end)
+    columns = ', '.join(f'MIN({m}), MAX({m}), AVG({m})' for m in AGGREGATE_METRICS)
+    # bucket đã được kiểm tra nằm trong AGGREGATE_BUCKETS; lấy các bucket mới nhất rồi đảo lại
+    query = f'''SELECT date_trunc(%s, timestamp) AS bucket, COUNT(*), {columns}
+                FROM sensor_history{where}
+                GROUP BY 1 ORDER BY 1 DESC LIMIT %s'''
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(query, [bucket] + params + [max_buckets])
+        rows = cur.fetchall()
+    result = []
+    for row in reversed(rows):
+        item = {'time': row[0].strftime('%Y-%m-%d %H:%M:%S'), 'count': row[1]}
+        for i, metric in enumerate(AGGREGATE_METRICS):
+            low, high, mean = row[2 + 3 * i: 5 + 3 * i]
+            item[metric] = {
+                'min': low,
+                'max': high,
+                'mean': round(float(mean), 2) if mean is not None else None
+            }
+        result.append(item)
+    return result
+
+@timed_query
+def get_history_lttb(points, start=None, end=None):
+    """Return every metric downsampled with LTTB to at most `points` samples"""
+    where, params = _time_range_sql(start, end)
+    query = f'''SELECT EXTRACT(EPOCH FROM timestamp), {', '.join(AGGREGATE_METRICS)}
+                FROM sensor_history{where}
+                ORDER BY timestamp'''
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(query, params)
+        rows = cur.fetchall()
+    if not rows:
+        return {metric: [] for metric in AGGREGATE_METRICS}
+    data = np.array(rows, dtype=float) # None → NaN, bị loại trong downsample_series
+    series = {}
+    for i, metric in enumerate(AGGREGATE_METRICS):
+        times, values = downsample_series(data[:, 0], data[:, i + 1], points)
+        series[metric] = [
+            [datetime.fromtimestamp(t, timezone.utc).strftime('%Y-%m-%d %H:%M:%S'), round(float(v), 2)]
+            for t, v in zip(times, values)
+        ]
+    return series
 # lấy cấu hình cảnh báo nhiệt độ từ database
 # Chức năng chính
  # Kết nối PostgreSQL
  # Lấy giá trị trong bảng config với key = "temperature_alert"
  # Nếu có → trả về cấu hình từ database
+@timed_query
 def load_config():
     try:
-        conn = psycopg2.connect(
-            dbname=os.getenv("POSTGRES_DB", "sensor_data"),
-            user=os.getenv("POSTGRES_USER", "postgres"),
-            password=os.getenv("POSTGRES_PASSWORD", "postgres"),
-            host=os.getenv("POSTGRES_HOST", "localhost"),
-            port=os.getenv("POSTGRES_PORT", "5432")
-        )
-        cur = conn.cursor()
-        cur.execute("SELECT value FROM config WHERE key = 'temperature_alert'")
-        row = cur.fetchone()
-        conn.close()
+        with get_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT value FROM config WHERE key = 'temperature_alert'")
+            row = cur.fetchone()
         if row and row[0]: # Nếu bản ghi tồn tại, trả về cấu hình JSON đúng như lưu trong DB.
             return {"temperature_alert": row[0]}
         # Nếu không có cấu hình, trả về cấu hình mặc định:
@@ -718,64 +778,88 @@ def load_config():
             }
         }
 # lưu cấu hình cảnh báo vào database
+@timed_query
 def save_config(config):
     try:
-        conn = psycopg2.connect(
-            dbname=os.getenv("POSTGRES_DB", "sensor_data"),
-            user=os.getenv("POSTGRES_USER", "postgres"),
-            password=os.getenv("POSTGRES_PASSWORD", "postgres"),
-            host=os.getenv("POSTGRES_HOST", "localhost"),
-            port=os.getenv("POSTGRES_PORT", "5432")
-        )
-        cur = conn.cursor()
-        cur.execute(
-            """
-            INSERT INTO config (key, value)
-            VALUES ('temperature_alert', %s)
-            ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value
-            """, [json.dumps(config['temperature_alert'])]
-        )
-        conn.commit()
-        conn.close()
+        with get_connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                """
+                INSERT INTO config (key, value)
+                VALUES ('temperature_alert', %s)
+                ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value
+                """, [json.dumps(config['temperature_alert'])]
+            )
         print("✅ Đã lưu cấu hình vào database")
     except Exception as e:
         print(f"❌ Lỗi khi lưu config vào DB: {e}")
-# gửi dữ liệu realtime qua WebSocket
-async def send_data(websocket: WebSocket, mqtt_client: MQTTClient):
-    try:
-        while True:
-            if websocket.application_state.name != "CONNECTED":
-                print("WebSocket is no longer connected, exiting send_data")
-                break
-
-            sensor_data = mqtt_client.latest_data.copy() if mqtt_client.latest_data else {}
-            if sensor_data:
-                current_rainfall = await get_rainfall_data() # Lượng mưa hôm nay
-                sensor_data['rainfall'] = current_rainfall
-                monthly_rainfall = get_last_month_rainfall() # Lượng mưa tháng
-                sensor_data['monthly_rainfall'] = monthly_rainfall
-                mqtt_client.latest_data.update({
-                    'rainfall': current_rainfall,
-                    'monthly_rainfall': monthly_rainfall
-                })
-            history_data = get_history_from_db() # Lịch sử cảm biến
-            forecast_data = await get_forecast_rainfall() # Dự báo mưa 5 ngày
-            message = {
-                'latest': sensor_data,
-                'history': history_data,
-                'today': forecast_data['today'],
-                'forecast_5days': forecast_data['forecast_5days']
-            }
-            await websocket.send_json(message) # Gửi toàn bộ gói dữ liệu về client qua WebSocket.
-            await asyncio.sleep(5)
-    except WebSocketDisconnect:
-        print("WebSocket disconnected in send_data")
-    except Exception as e:
-        print(f"Error in send_data: {e}")
-        import traceback
-        print(traceback.format_exc())
-    finally:
-        mqtt_client.active_websockets.discard(websocket)
+# Bản ghi sensor mới nhất cho /latest-data (None nếu bảng trống)
+@timed_query
+def get_latest_from_db():
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute('''SELECT temperature, humidity, nitrogen, phosphorus, potassium, ph, rainfall, monthly_rainfall 
+                    FROM sensor_history
+                    ORDER BY timestamp DESC
+                    LIMIT 1''') # Trả về giá trị mới nhất.
+        row = cur.fetchone()
+    if not row:
+        return None
+    return {
+        'temperature': round(float(row[0]), 2),
+        'humidity': float(row[1]),
+        'nitrogen': float(row[2]),
+        'phosphorus': float(row[3]),
+        'potassium': float(row[4]),
+        'ph': float(row[5]),
+        'rainfall': float(row[6]),
+        'monthly_rainfall': float(row[7])
+    }
+# Bản ghi sensor mới nhất đã làm tròn cho /quick-fill (None nếu bảng trống)
+@timed_query
+def get_quick_fill_from_db():
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute('''SELECT temperature, humidity, nitrogen, phosphorus, potassium, ph, monthly_rainfall
+                    FROM sensor_history
+                    ORDER BY timestamp DESC
+                    LIMIT 1''')
+        row = cur.fetchone()
+    if not row:
+        return None
+    return {
+        'temperature': round(float(row[0]), 2),
+        'humidity': round(float(row[1]), 2),
+        'nitrogen': round(float(row[2]), 2),
+        'phosphorus': round(float(row[3]), 2),
+        'potassium': round(float(row[4]), 2),
+        'ph': round(float(row[5]), 2),
+        'monthly_rainfall': round(float(row[6]), 2)
+    }
+# Bản ghi cảm biến mới nhất kèm lượng mưa hôm nay/tháng trước
+async def build_latest_payload():
+    sensor_data = mqtt_client.latest_data.copy() if mqtt_client.latest_data else {}
+    if sensor_data:
+        current_rainfall = await get_rainfall_data() # Lượng mưa hôm nay
+        sensor_data['rainfall'] = current_rainfall
+        monthly_rainfall = await asyncio.to_thread(get_last_month_rainfall) # Lượng mưa tháng
+        sensor_data['monthly_rainfall'] = monthly_rainfall
+        mqtt_client.latest_data.update({
+            'rainfall': current_rainfall,
+            'monthly_rainfall': monthly_rainfall
+        })
+    return sensor_data
+# Dựng gói dữ liệu dashboard đầy đủ của giao thức 1 (1 lần mỗi chu kỳ cho mọi client /ws?protocol=1)
+async def build_dashboard_payload():
+    sensor_data = await build_latest_payload()
+    history_data = await run_db(get_history_from_db) # Lịch sử cảm biến
+    forecast_data = await get_forecast_rainfall() # Dự báo mưa 5 ngày
+    return {
+        'latest': sensor_data,
+        'history': history_data,
+        'today': forecast_data['today'],
+        'forecast_5days': forecast_data['forecast_5days']
+    }
 # Redirect trang chủ → login
 @app.get("/", include_in_schema=False)
 async def root():
@@ -784,31 +868,9 @@ async def root():
 @app.get("/latest-data")
 async def get_latest_data():
     try:
-        conn = psycopg2.connect(
-            dbname=os.getenv("POSTGRES_DB", "sensor_data"),
-            user=os.getenv("POSTGRES_USER", "postgres"),
-            password=os.getenv("POSTGRES_PASSWORD", "postgres"),
-            host=os.getenv("POSTGRES_HOST", "localhost"),
-            port=os.getenv("POSTGRES_PORT", "5432")
-        )
-        cur = conn.cursor()
-        cur.execute('''SELECT temperature, humidity, nitrogen, phosphorus, potassium, ph, rainfall, monthly_rainfall 
-                    FROM sensor_history
-                    ORDER BY timestamp DESC
-                    LIMIT 1''') # Trả về giá trị mới nhất.
-        row = cur.fetchone()
-        conn.close()
-        if row:
-            return {
-                'temperature': round(float(row[0]), 2),
-                'humidity': float(row[1]),
-                'nitrogen': float(row[2]),
-                'phosphorus': float(row[3]),
-                'potassium': float(row[4]),
-                'ph': float(row[5]),
-                'rainfall': float(row[6]),
-                'monthly_rainfall': float(row[7])
-            }
+        latest = await run_db(get_latest_from_db)
+        if latest:
+            return latest
         return JSONResponse({'error': 'No data found'}, status_code=404)
     except Exception as e:
         print(f"Error in /latest-data: {str(e)}")
@@ -818,31 +880,10 @@ async def get_latest_data():
 @app.get("/quick-fill")
 async def get_quick_fill_data():
     try:
-        conn = psycopg2.connect(
-            dbname=os.getenv("POSTGRES_DB", "sensor_data"),
-            user=os.getenv("POSTGRES_USER", "postgres"),
-            password=os.getenv("POSTGRES_PASSWORD", "postgres"),
-            host=os.getenv("POSTGRES_HOST", "localhost"),
-            port=os.getenv("POSTGRES_PORT", "5432")
-        )
-        cur = conn.cursor()
-        cur.execute('''SELECT temperature, humidity, nitrogen, phosphorus, potassium, ph, monthly_rainfall
-                    FROM sensor_history
-                    ORDER BY timestamp DESC
-                    LIMIT 1''')
-        row = cur.fetchone()
-        conn.close()
-        if row:
-            return {
-                'temperature': round(float(row[0]), 2),
-                'humidity': round(float(row[1]), 2),
-                'nitrogen': round(float(row[2]), 2),
-                'phosphorus': round(float(row[3]), 2),
-                'potassium': round(float(row[4]), 2),
-                'ph': round(float(row[5]), 2),
-                'monthly_rainfall': round(float(row[6]), 2)
-            }
-        monthly_rainfall = get_last_month_rainfall()
+        quick_fill = await run_db(get_quick_fill_from_db)
+        if quick_fill:
+            return quick_fill
+        monthly_rainfall = await asyncio.to_thread(get_last_month_rainfall)
         return {
             'temperature': 0.00,
             'humidity': 0.00,
@@ -863,15 +904,16 @@ async def get_quick_fill_data():
 # Dự đoán bằng model
 # Giải mã kết quả bằng label_encoder
 # Lấy ra tên cây tiếng Việt
+# ?top_k=k (hoặc "top_k" trong body, mặc định PREDICT_TOP_K): trả thêm k cây xác suất cao nhất từ cùng một lần gọi predict_proba
 @app.post("/predict")
 async def predict(request: Request):
-    if not all([model, scaler, label_encoder]):
+    if not inference.available:
         return JSONResponse({'error': 'Chức năng khuyến nghị cây trồng không khả dụng do lỗi tải models'}, status_code=503)
     try:
         data = await request.json()
         if not data:
             return JSONResponse({'error': 'Không có dữ liệu được gửi'}, status_code=400)
-        monthly_rainfall = get_last_month_rainfall()
+        monthly_rainfall = await asyncio.to_thread(get_last_month_rainfall) # có cache, lần đầu mới gọi open-meteo
         input_data = {
             'N': float(data['N']),
             'P': float(data['P']),
@@ -881,240 +923,132 @@ async def predict(request: Request):
             'ph': float(data['ph']),
             'rainfall': monthly_rainfall
         }
-        df = pd.DataFrame([input_data])
-        scaled_data = scaler.transform(df)
-        prediction = model.predict(scaled_data)
-        crop_en = label_encoder.inverse_transform(prediction)[0]
+        top_k = data.get('top_k', request.query_params.get('top_k'))
+        try:
+            top_k = int(top_k) if top_k not in (None, '') else (PREDICT_TOP_K if PREDICT_TOP_K > 1 else None)
+        except (TypeError, ValueError):
+            return JSONResponse({'error': 'top_k phải là số nguyên'}, status_code=400)
+        version = request.query_params.get('model_version')
+        ranked = None
+        if top_k:
+            ranked, model_version = await inference.predict_top_k([input_data], top_k, version=version)
+            ranked = ranked[0]
+            crop_en = ranked[0]['crop'] # cây xác suất cao nhất, trùng với kết quả dự đoán thường
+        else:
+            crops, model_version = await inference.predict_records([input_data], version=version) # chạy ngoài event loop
+            crop_en = crops[0]
         crop_vi = CROP_TRANSLATIONS.get(crop_en.lower(), crop_en)
-        crop_params = {
-            'rice': {
-                'temperature': {'min': 20, 'max': 27},
-                'humidity': {'min': 80, 'max': 85},
-                'nitrogen': {'min': 60, 'max': 99},
-                'phosphorus': {'min': 35, 'max': 60},
-                'potassium': {'min': 35, 'max': 45},
-                'ph': {'min': 5.0, 'max': 7.8}
-            },
-            'maize': {
-                'temperature': {'min': 18, 'max': 26},
-                'humidity': {'min': 55, 'max': 74},
-                'nitrogen': {'min': 60, 'max': 100},
-                'phosphorus': {'min': 35, 'max': 60},
-                'potassium': {'min': 15, 'max': 25},
-                'ph': {'min': 5.5, 'max': 7.0}
-            },
-            'chickpea': {
-                'temperature': {'min': 17, 'max': 21},
-                'humidity': {'min': 14, 'max': 20},
-                'nitrogen': {'min': 20, 'max': 60},
-                'phosphorus': {'min': 55, 'max': 80},
-                'potassium': {'min': 75, 'max': 85},
-                'ph': {'min': 6.0, 'max': 8.9}
-            },
-            'kidneybeans': {
-                'temperature': {'min': 15, 'max': 24},
-                'humidity': {'min': 18, 'max': 25},
-                'nitrogen': {'min': 0, 'max': 40},
-                'phosphorus': {'min': 55, 'max': 80},
-                'potassium': {'min': 15, 'max': 25},
-                'ph': {'min': 5.5, 'max': 6.0}
-            },
-            'pigeonpeas': {
-                'temperature': {'min': 18, 'max': 39},
-                'humidity': {'min': 14, 'max': 35},
-                'nitrogen': {'min': 0, 'max': 40},
-                'phosphorus': {'min': 55, 'max': 80},
-                'potassium': {'min': 15, 'max': 25},
-                'ph': {'min': 4.0, 'max': 8.8}
-            },
-            'mothbeans': {
-                'temperature': {'min': 24, 'max': 32},
-                'humidity': {'min': 25, 'max': 35},
-                'nitrogen': {'min': 0, 'max': 40},
-                'phosphorus': {'min': 35, 'max': 60},
-                'potassium': {'min': 15, 'max': 25},
-                'ph': {'min': 3.5, 'max': 9.0}
-            },
-            'mungbean': {
-                'temperature': {'min': 27, 'max': 30},
-                'humidity': {'min': 80, 'max': 90},
-                'nitrogen': {'min': 0, 'max': 40},
-                'phosphorus': {'min': 35, 'max': 60},
-                'potassium': {'min': 15, 'max': 25},
-                'ph': {'min': 6.2, 'max': 7.6}
-            },
-            'blackgram': {
-                'temperature': {'min': 26, 'max': 32},
-                'humidity': {'min': 60, 'max': 70},
-                'nitrogen': {'min': 0, 'max': 40},
-                'phosphorus': {'min': 55, 'max': 80},
-                'potassium': {'min': 15, 'max': 25},
-                'ph': {'min': 4.9, 'max': 7.6}
-            },
-            'lentil': {
-                'temperature': {'min': 18, 'max': 27},
-                'humidity': {'min': 60, 'max': 70},
-                'nitrogen': {'min': 0, 'max': 40},
-                'phosphorus': {'min': 55, 'max': 80},
-                'potassium': {'min': 15, 'max': 25},
-                'ph': {'min': 5.8, 'max': 7.8}
-            },
-            'pomegranate': {
-                'temperature': {'min': 18, 'max': 24},
-                'humidity': {'min': 85, 'max': 95},
-                'nitrogen': {'min': 0, 'max': 40},
-                'phosphorus': {'min': 5, 'max': 30},
-                'potassium': {'min': 35, 'max': 45},
-                'ph': {'min': 5.4, 'max': 7.8}
-            },
-            'banana': {
-                'temperature': {'min': 25, 'max': 30},
-                'humidity': {'min': 75, 'max': 85},
-                'nitrogen': {'min': 80, 'max': 120},
-                'phosphorus': {'min': 5, 'max': 30},
-                'potassium': {'min': 45, 'max': 55},
-                'ph': {'min': 5.0, 'max': 7.0}
-            },
-            'mango': {
-                'temperature': {'min': 27, 'max': 35},
-                'humidity': {'min': 45, 'max': 55},
-                'nitrogen': {'min': 0, 'max': 40},
-                'phosphorus': {'min': 15, 'max': 40},
-                'potassium': {'min': 25, 'max': 35},
-                'ph': {'min': 4.3, 'max': 7.6}
-            },
-            'grapes': {
-                'temperature': {'min': 8, 'max': 32},
-                'humidity': {'min': 80, 'max': 85},
-                'nitrogen': {'min': 0, 'max': 40},
-                'phosphorus': {'min': 120, 'max': 145},
-                'potassium': {'min': 195, 'max': 205},
-                'ph': {'min': 5.5, 'max': 7.0}
-            },
-            'watermelon': {
-                'temperature': {'min': 24, 'max': 27},
-                'humidity': {'min': 80, 'max': 90},
-                'nitrogen': {'min': 80, 'max': 120},
-                'phosphorus': {'min': 5, 'max': 30},
-                'potassium': {'min': 5, 'max': 15},
-                'ph': {'min': 6.0, 'max': 6.8}
-            },
-            'muskmelon': {
-                'temperature': {'min': 27, 'max': 29},
-                'humidity': {'min': 90, 'max': 95},
-                'nitrogen': {'min': 80, 'max': 120},
-                'phosphorus': {'min': 5, 'max': 30},
-                'potassium': {'min': 5, 'max': 15},
-                'ph': {'min': 6.0, 'max': 6.8}
-            },
-            'apple': {
-                'temperature': {'min': 21, 'max': 24},
-                'humidity': {'min': 85, 'max': 95},
-                'nitrogen': {'min': 0, 'max': 40},
-                'phosphorus': {'min': 120, 'max': 145},
-                'potassium': {'min': 195, 'max': 205},
-                'ph': {'min': 5.5, 'max': 7.0}
-            },
-            'orange': {
-                'temperature': {'min': 10, 'max': 34},
-                'humidity': {'min': 85, 'max': 95},
-                'nitrogen': {'min': 0, 'max': 40},
-                'phosphorus': {'min': 5, 'max': 30},
-                'potassium': {'min': 5, 'max': 15},
-                'ph': {'min': 4.0, 'max': 9.0}
-            },
-            'papaya': {
-                'temperature': {'min': 23, 'max': 44},
-                'humidity': {'min': 85, 'max': 95},
-                'nitrogen': {'min': 40, 'max': 80},
-                'phosphorus': {'min': 5, 'max': 60},
-                'potassium': {'min': 45, 'max': 55},
-                'ph': {'min': 4.3, 'max': 7.6}
-            },
-            'coconut': {
-                'temperature': {'min': 25, 'max': 30},
-                'humidity': {'min': 90, 'max': 100},
-                'nitrogen': {'min': 0, 'max': 40},
-                'phosphorus': {'min': 5, 'max': 30},
-                'potassium': {'min': 25, 'max': 35},
-                'ph': {'min': 5.5, 'max': 6.5}
-            },
-            'cotton': {
-                'temperature': {'min': 22, 'max': 26},
-                'humidity': {'min': 75, 'max': 85},
-                'nitrogen': {'min': 100, 'max': 140},
-                'phosphorus': {'min': 35, 'max': 60},
-                'potassium': {'min': 15, 'max': 25},
-                'ph': {'min': 5.8, 'max': 8.0}
-            },
-            'jute': {
-                'temperature': {'min': 23, 'max': 27},
-                'humidity': {'min': 70, 'max': 90},
-                'nitrogen': {'min': 60, 'max': 100},
-                'phosphorus': {'min': 35, 'max': 60},
-                'potassium': {'min': 35, 'max': 45},
-                'ph': {'min': 6.0, 'max': 7.5}
-            },
-            'coffee': {
-                'temperature': {'min': 23, 'max': 28},
-                'humidity': {'min': 50, 'max': 70},
-                'nitrogen': {'min': 80, 'max': 120},
-                'phosphorus': {'min': 15, 'max': 40},
-                'potassium': {'min': 25, 'max': 35},
-                'ph': {'min': 6.0, 'max': 7.5}
-            }
-        }
         warnings_list = []
         suggestions = []
-        ideal_params = crop_params.get(crop_en.lower(), {}) # Kiểm tra tham số lý tưởng của từng cây
-        if ideal_params:
-            if input_data['temperature'] < ideal_params['temperature']['min']:
-                warnings_list.append(f"⚠️ Nhiệt độ ({input_data['temperature']}°C) thấp hơn mức tối thiểu ({ideal_params['temperature']['min']}°C)") # nếu thông số hiện tại thấp hơn min → cảnh báo và gợi ý
-                suggestions.append("🔼 Cần tăng nhiệt độ")                                                                                              
-            elif input_data['temperature'] > ideal_params['temperature']['max']:
-                warnings_list.append(f"⚠️ Nhiệt độ ({input_data['temperature']}°C) cao hơn mức tối đa ({ideal_params['temperature']['max']}°C)") # cảnh báo và gợi ý
-                suggestions.append("🔽 Cần giảm nhiệt độ")
-            if input_data['humidity'] < ideal_params['humidity']['min']:
-                warnings_list.append(f"⚠️ Độ ẩm ({input_data['humidity']}%) thấp hơn mức tối thiểu ({ideal_params['humidity']['min']}%)")
-                suggestions.append("🔼 Cần tăng độ ẩm")
-            elif input_data['humidity'] > ideal_params['humidity']['max']:
-                warnings_list.append(f"⚠️ Độ ẩm ({input_data['humidity']}%) cao hơn mức tối đa ({ideal_params['humidity']['max']}%)")
-                suggestions.append("🔽 Cần giảm độ ẩm")
-            if input_data['N'] < ideal_params['nitrogen']['min']:
-                warnings_list.append(f"⚠️ Nitrogen ({input_data['N']}mg/kg) thấp hơn mức tối thiểu ({ideal_params['nitrogen']['min']}mg/kg)")
-                suggestions.append("🔼 Cần bổ sung phân đạm")
-            elif input_data['N'] > ideal_params['nitrogen']['max']:
-                warnings_list.append(f"⚠️ Nitrogen ({input_data['N']}mg/kg) cao hơn mức tối đa ({ideal_params['nitrogen']['max']}mg/kg)")
-                suggestions.append("🔽 Cần giảm phân đạm")
-            if input_data['P'] < ideal_params['phosphorus']['min']:
-                warnings_list.append(f"⚠️ Phosphorus ({input_data['P']}mg/kg) thấp hơn mức tối thiểu ({ideal_params['phosphorus']['min']}mg/kg)")
-                suggestions.append("🔼 Cần bổ sung phân lân")
-            elif input_data['P'] > ideal_params['phosphorus']['max']:
-                warnings_list.append(f"⚠️ Phosphorus ({input_data['P']}mg/kg) cao hơn mức tối đa ({ideal_params['phosphorus']['max']}mg/kg)")
-                suggestions.append("🔽 Cần giảm phân lân")
-            if input_data['K'] < ideal_params['potassium']['min']:
-                warnings_list.append(f"⚠️ Potassium ({input_data['K']}mg/kg) thấp hơn mức tối thiểu ({ideal_params['potassium']['min']}mg/kg)")
-                suggestions.append("🔼 Cần bổ sung phân kali")
-            elif input_data['K'] > ideal_params['potassium']['max']:
-                warnings_list.append(f"⚠️ Potassium ({input_data['K']}mg/kg) cao hơn mức tối đa ({ideal_params['potassium']['max']}mg/kg)")
-                suggestions.append("🔽 Cần giảm phân kali")
-            if input_data['ph'] < ideal_params['ph']['min']:
-                warnings_list.append(f"⚠️ pH ({input_data['ph']}) thấp hơn mức tối thiểu ({ideal_params['ph']['min']})")
-                suggestions.append("🔼 Cần tăng độ pH")
-            elif input_data['ph'] > ideal_params['ph']['max']:
-                warnings_list.append(f"⚠️ pH ({input_data['ph']}) cao hơn mức tối đa ({ideal_params['ph']['max']})")
-                suggestions.append("🔽 Cần giảm độ pH")
+        ideal_params = crop_requirements.ranges(crop_en) or {} # Kiểm tra tham số lý tưởng của cây được khuyến nghị
+        for warning in crop_requirements.warnings(input_data, crop_en):
+            text = PARAM_TEXT[warning['param']]
+            if warning['direction'] == 'low': # nếu thông số hiện tại thấp hơn min → cảnh báo và gợi ý
+                warnings_list.append(f"⚠️ {text['label']} ({warning['value']}{text['unit']}) thấp hơn mức tối thiểu ({warning['min']}{text['unit']})")
+            else:
+                warnings_list.append(f"⚠️ {text['label']} ({warning['value']}{text['unit']}) cao hơn mức tối đa ({warning['max']}{text['unit']})")
+            suggestions.append(text[warning['direction']])
+        # Các cây hợp với điều kiện hiện tại nhất theo bảng ngưỡng (không gọi thêm model)
+        suitable_crops = [
+            {**fit, 'crop_vi': CROP_TRANSLATIONS.get(fit['crop'], fit['crop'])}
+            for fit in crop_requirements.top_k([input_data])[0]
+        ]
         response = {
             'prediction_text': f'Cây trồng được khuyến nghị: {crop_vi}', # trả về 
             'warnings': warnings_list,
             'suggestions': suggestions,
             'ideal_params': ideal_params,
-            'current_params': {**input_data, 'rainfall': monthly_rainfall}
+            'current_params': {**input_data, 'rainfall': monthly_rainfall},
+            'suitable_crops': suitable_crops,
+            'model_version': model_version
         }
+        if ranked:
+            fits = crop_requirements.describe(input_data, [item['crop'] for item in ranked])
+            response['top_crops'] = [{
+                'crop': item['crop'],
+                'crop_vi': CROP_TRANSLATIONS.get(item['crop'].lower(), item['crop']),
+                'probability': round(item['probability'], 4),
+                'ideal_params': crop_requirements.ranges(item['crop']),
+                'fit_score': fit['score'] if fit else None,
+                'warnings': fit['warnings'] if fit else []
+            } for item, fit in zip(ranked, fits)]
         return response
+    except (InferenceSaturated, InferenceTimeout, ModelLoadError) as e:
+        return inference_busy_response(e)
     except Exception as e:
         print(f"Error during prediction: {str(e)}")
         return JSONResponse({'error': f'Có lỗi xảy ra khi khuyến nghị cây trồng: {str(e)}'}, status_code=500)
+# API /predict/batch – dự đoán nhiều dòng N/P/K/temperature/humidity/ph trong một lần gọi model
+# Body: {"rows": [{...}, ...]} hoặc danh sách dòng; thiếu rainfall thì dùng lượng mưa tháng trước
+@app.post("/predict/batch")
+async def predict_batch(request: Request):
+    if not inference.available:
+        return JSONResponse({'error': 'Chức năng khuyến nghị cây trồng không khả dụng do lỗi tải models'}, status_code=503)
+    try:
+        data = await request.json()
+        rows = data.get('rows') if isinstance(data, dict) else data
+        if not rows or not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+            return JSONResponse({'error': 'Cần danh sách "rows" không rỗng'}, status_code=400)
+        if len(rows) > PREDICT_MAX_BATCH:
+            return JSONResponse({'error': f'Tối đa {PREDICT_MAX_BATCH} dòng mỗi request'}, status_code=413)
+        monthly_rainfall = None
+        if any('rainfall' not in row for row in rows):
+            monthly_rainfall = await asyncio.to_thread(get_last_month_rainfall)
+        try:
+            records = [{
+                'N': float(row['N']),
+                'P': float(row['P']),
+                'K': float(row['K']),
+                'temperature': float(row['temperature']),
+                'humidity': float(row['humidity']),
+                'ph': float(row['ph']),
+                'rainfall': float(row.get('rainfall', monthly_rainfall))
+            } for row in rows]
+        except (KeyError, TypeError, ValueError) as e:
+            return JSONResponse({'error': f'Dòng dữ liệu không hợp lệ: {e}'}, status_code=400)
+        crops, model_version = await inference.predict_records(records, version=request.query_params.get('model_version'))
+        return {
+            'count': len(crops),
+            'predictions': [
+                {'crop': crop, 'crop_vi': CROP_TRANSLATIONS.get(crop.lower(), crop), 'input': record}
+                for crop, record in zip(crops, records)
+            ],
+            'model_version': model_version,
+            'cache': inference.cache_stats()
+        }
+    except (InferenceSaturated, InferenceTimeout, ModelLoadError) as e:
+        return inference_busy_response(e)
+    except Exception as e:
+        print(f"Error during batch prediction: {str(e)}")
+        return JSONResponse({'error': f'Có lỗi xảy ra khi khuyến nghị cây trồng: {str(e)}'}, status_code=500)
+# API /crop-fit – so một hoặc nhiều bộ thông số với ngưỡng lý tưởng của tất cả cây cùng lúc (không dùng model)
+# Body: {"rows": [{N, P, K, temperature, humidity, ph}, ...]} hoặc một dòng; ?k= số cây phù hợp nhất trả về
+@app.post("/crop-fit")
+async def crop_fit(request: Request):
+    try:
+        data = await request.json()
+        rows = data.get('rows', [data]) if isinstance(data, dict) else data
+        if not rows or not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+            return JSONResponse({'error': 'Cần một dòng hoặc danh sách "rows" không rỗng'}, status_code=400)
+        if len(rows) > PREDICT_MAX_BATCH:
+            return JSONResponse({'error': f'Tối đa {PREDICT_MAX_BATCH} dòng mỗi request'}, status_code=413)
+        try:
+            k = int(request.query_params.get('k', TOP_K))
+            readings = [{INPUT_KEYS[p]: float(row[INPUT_KEYS[p]]) for p in PARAMETERS} for row in rows]
+        except (KeyError, TypeError, ValueError) as e:
+            return JSONResponse({'error': f'Dữ liệu không hợp lệ: {e}'}, status_code=400)
+        results = crop_requirements.top_k(readings, k)
+        return {
+            'count': len(results),
+            'results': [
+                {'input': reading,
+                 'crops': [{**fit, 'crop_vi': CROP_TRANSLATIONS.get(fit['crop'], fit['crop'])} for fit in fits]}
+                for reading, fits in zip(readings, results)
+            ]
+        }
+    except Exception as e:
+        print(f"Error in /crop-fit: {str(e)}")
+        return JSONResponse({'error': str(e)}, status_code=500)
 # API: Thiết lập cảnh báo nhiệt độ
 @app.post("/set-temperature-alert")
 async def set_temperature_alert(request: Request):
@@ -1125,9 +1059,9 @@ async def set_temperature_alert(request: Request):
         threshold = float(data['threshold'])
         if threshold < 0 or threshold > 50:
             return JSONResponse({'success': False, 'error': 'Ngưỡng nhiệt độ phải nằm trong khoảng 0-50°C'}, status_code=400)
-        config = load_config()
+        config = await run_db(load_config)
         config['temperature_alert']['threshold'] = threshold
-        save_config(config)
+        await run_db(save_config, config)
         print(f"✅ Đã cập nhật ngưỡng cảnh báo nhiệt độ: {threshold}°C")
         return {'success': True, 'threshold': threshold}
     except Exception as e:
@@ -1176,15 +1110,54 @@ async def api_login(request: Request):
         print(f"Error in /api/login: {str(e)}")
         return JSONResponse({'error': str(e)}, status_code=500)
 # API /history & /forecast
-@app.get("/history") # trả toàn bộ dữ liệu cảm biến
-async def get_history():
+@app.get("/history") # trả dữ liệu cảm biến theo khoảng thời gian, phân trang bằng cursor
+async def get_history(start: Optional[str] = None, end: Optional[str] = None,
+                      limit: int = HISTORY_DEFAULT_LIMIT, cursor: Optional[str] = None):
     try:
-        current_time = datetime.now(vn_tz)
-        return get_history_from_db()
+        try:
+            start_dt = parse_history_bound(start)
+            end_dt = parse_history_bound(end, is_end=True)
+            cursor_key = decode_history_cursor(cursor) if cursor else None
+        except ValueError as e:
+            return JSONResponse({'error': f'Tham số không hợp lệ: {e}'}, status_code=400)
+        if limit < 1 or limit > HISTORY_MAX_LIMIT:
+            return JSONResponse({'error': f'limit phải nằm trong khoảng 1-{HISTORY_MAX_LIMIT}'}, status_code=400)
+        rows, next_cursor = await run_db(get_history_page, start_dt, end_dt, limit, cursor_key)
+        # Giữ body là list như cũ; cursor trang sau nằm trong header
+        headers = {'X-Next-Cursor': next_cursor} if next_cursor else None
+        return JSONResponse(rows, headers=headers)
     except Exception as e:
         print(f"Error in /history: {str(e)}")
         return JSONResponse({'error': str(e)}, status_code=500)
 
+@app.get("/history/aggregate") # dữ liệu đã gom nhóm cho biểu đồ dài hạn
+async def get_history_aggregate_api(bucket: str = 'hour', start: Optional[str] = None, end: Optional[str] = None,
+                                    mode: str = 'stats', points: int = 500):
+    try:
+        try:
+            start_dt = parse_history_bound(start)
+            end_dt = parse_history_bound(end, is_end=True)
+        except ValueError as e:
+            return JSONResponse({'error': f'Tham số không hợp lệ: {e}'}, status_code=400)
+        if mode == 'lttb':
+            if points < 3 or points > AGGREGATE_MAX_BUCKETS:
+                return JSONResponse({'error': f'points phải nằm trong khoảng 3-{AGGREGATE_MAX_BUCKETS}'}, status_code=400)
+            series = await run_db(get_history_lttb, points, start_dt, end_dt)
+            return {'mode': 'lttb', 'points': points, 'series': series}
+        if mode != 'stats':
+            return JSONResponse({'error': 'mode phải là stats hoặc lttb'}, status_code=400)
+        if bucket not in AGGREGATE_BUCKETS:
+            return JSONResponse({'error': f'bucket phải là một trong {", ".join(AGGREGATE_BUCKETS)}'}, status_code=400)
+        if bucket in ROLLUP_TABLES:
+            # hour/day đọc thẳng từ bảng rollup, không quét sensor_history
+            buckets = await run_db(get_rollups, bucket, start_dt, end_dt, AGGREGATE_MAX_BUCKETS)
+        else:
+            buckets = await run_db(get_history_aggregate, bucket, start_dt, end_dt)
+        return {'mode': 'stats', 'bucket': bucket, 'metrics': AGGREGATE_METRICS, 'buckets': buckets}
+    except Exception as e:
+        print(f"Error in /history/aggregate: {str(e)}")
+        return JSONResponse({'error': str(e)}, status_code=500)
+
 @app.get("/forecast") # dự báo mưa từ API khác
 async def get_forecast():
     try:
@@ -1196,11 +1169,18 @@ async def get_forecast():
 # WebSocket chính
 @app.websocket("/ws")
 # Nhận kết nối WebSocket:
+# /ws → giao thức 2 (snapshot rồi delta), /ws?since=<seq> chỉ lấy các dòng lịch sử sau seq khi kết nối lại,
+# /ws?protocol=1 → gói đầy đủ mỗi chu kỳ như cũ
 async def websocket_endpoint(websocket: WebSocket): 
-    await websocket.accept() # Gửi dữ liệu realtime cho từng client.
-    mqtt_client.active_websockets.add(websocket)
+    legacy = websocket.query_params.get('protocol') == str(WS_LEGACY_PROTOCOL)
+    since = websocket.query_params.get('since')
+    since = int(since) if since and since.isdigit() else None
+    await websocket.accept() # Dữ liệu định kỳ do ws_manager.broadcast_loop đưa vào hàng đợi gửi của từng client.
+    writer = ws_manager.connect(websocket, legacy)
     try:
-        await send_data(websocket, mqtt_client)
+        await ws_manager.send_snapshot(writer, since)
+        while True:
+            writer.received(await websocket.receive_text()) # pong (đo RTT) và phát hiện client ngắt kết nối
     except WebSocketDisconnect:
         print("WebSocket disconnected in websocket_endpoint")
     except Exception as e:
@@ -1208,7 +1188,7 @@ async def websocket_endpoint(websocket: WebSocket):
         import traceback
         print(traceback.format_exc())
     finally:
-        mqtt_client.active_websockets.discard(websocket)
+        await ws_manager.disconnect(websocket)
         print("WebSocket removed from active connections")
 # Bộ API Timer – hẹn giờ bật tắt thiết bị
 @app.post("/api/set-timer")
@@ -1216,6 +1196,11 @@ async def set_timer(request: Request):
     try:        # Set giờ bật/tắt:
         data = await request.json()
         device = data.get('device')
+        if device and data.get('slots') is not None:
+            # Nhiều khung giờ lặp lại: [{"on": "06:00", "off": "06:30", "days": ["mon", "wed"]},
+            #                          {"cron_on": "0 18 * * 1-5", "cron_off": "30 18 * * 1-5"}]
+            success = device_timer.set_schedule(device, data['slots'])
+            return {"success": success, "timer": device_timer.get_timer(device)}
         on_date = data.get('onDate')
         on_time = data.get('onTime')
         off_date = data.get('offDate')
@@ -1252,7 +1237,21 @@ async def clear_timer(request: Request):
 async def get_timer(device: str):
     try:
         timer = device_timer.get_timer(device)
-        return {"success": True, "timer": timer}
+        return {
+            "success": True,
+            "timer": timer,
+            "events": device_timer.events.get(device, []),
+            "next_runs": device_timer.preview(device, 4)
+        }
+    except Exception as e:
+        return {"success": False, "message": str(e)}
+# Xem trước N lần bật/tắt sắp tới của một thiết bị.
+@app.get("/api/timer/preview/{device}")
+async def preview_timer(device: str, count: int = 10):
+    try:
+        if count < 1 or count > 200:
+            return {"success": False, "message": "count phải nằm trong khoảng 1-200"}
+        return {"success": True, "device": device, "runs": device_timer.preview(device, count)}
     except Exception as e:
         return {"success": False, "message": str(e)}
 # Thêm timer rời rạc (loại khác).
@@ -1289,7 +1288,7 @@ async def update_timer(device: str, old_time: str, new_time: str, status: bool):
 @app.get("/api/timer/list")
 async def list_timers():
     try:
-        return {"status": "success", "timers": device_timer.timers}
+        return {"status": "success", "timers": device_timer.timers, "events": device_timer.events}
     except Exception as e:
         return {"status": "error", "message": str(e)}
 # API trả cấu hình MQTT 
@@ -1310,72 +1309,272 @@ async def get_mqtt_config():
             "success": False,
             "error": str(e)
         }
+
+@app.get("/api/mqtt-stats")
+async def get_mqtt_stats():
+    """Độ sâu hàng đợi MQTT, số message bị bỏ và trạng thái bộ đệm ghi DB"""
+    return {
+        "success": True,
+        "connected": bool(mqtt_client and mqtt_client.is_connected),
+        "queues": mqtt_bridge.stats(),
+        "ingest": ingest_buffer.stats()
+    }
+
+@app.get("/api/ws-stats")
+async def get_ws_stats():
+    """Từng client WebSocket: số gói đang chờ, độ trễ hàng đợi, RTT ping/pong, số gói đã gộp"""
+    return {"success": True, **ws_manager.stats()}
+
+@app.get("/api/inference-stats")
+async def get_inference_stats():
+    """Mức sử dụng pool dự đoán, số lời gọi bị từ chối/quá hạn và độ trễ mỗi lời gọi"""
+    return {"success": True, **inference.stats()}
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """Metric Prometheus: MQTT, WebSocket, DB, thời tiết, dự đoán và hẹn giờ"""
+    body, content_type = render_metrics()
+    return Response(body, media_type=content_type)
+
+@app.get("/api/models")
+async def get_models():
+    """Các phiên bản model đang giữ, phiên bản đang dùng và phiên bản đã tải"""
+    await asyncio.to_thread(model_registry.refresh)
+    return {"success": True, **model_registry.stats()}
 # WebSocketManager – broadcast cho nhiều client
+# Giao thức 2 (mặc định): lúc kết nối gửi 1 snapshot (latest, WS_HISTORY_ROWS dòng lịch sử mới nhất, dự báo),
+# sau đó mỗi 5 giây chỉ gửi delta: các dòng lịch sử có id > seq, các trường latest đã đổi,
+# dự báo khi cache dự báo đổi; chu kỳ không có gì mới thì không gửi gì.
+# Giao thức 1 (/ws?protocol=1): mỗi 5 giây gửi lại latest + toàn bộ lịch sử + dự báo như cũ.
+# Mỗi loại gói được serialize 1 lần rồi đưa vào hàng đợi của từng client (ClientWriter);
+# mỗi client có 1 task gửi riêng → client chậm chỉ bị gộp gói/ngắt, không làm chậm client khác
+# ---> Chi phí gọi API/DB không tăng theo số client
+WS_PROTOCOL_VERSION = 2
+WS_LEGACY_PROTOCOL = 1
+# Số dòng lịch sử tối đa trong snapshot/delta; delta chạm ngưỡng thì client thay toàn bộ lịch sử (reset)
+WS_HISTORY_ROWS = int(os.getenv("WS_HISTORY_ROWS", HISTORY_DEFAULT_LIMIT))
+
 class WebSocketManager:
-    def __init__(self):
-        self.active_connections = set()
+    def __init__(self, interval: float = 5, send_timeout: float = WS_SEND_TIMEOUT):
+        self.interval = interval
+        self.send_timeout = send_timeout
+        self.last_payload_text = None
+        self.clients = {}            # WebSocket -> ClientWriter
+        self.seq = None              # id dòng lịch sử mới nhất đã gửi cho client giao thức 2 (mỗi client có seq riêng)
+        self.latest_sent = {}        # latest mà client giao thức 2 đang có → delta chỉ chứa trường thay đổi
+        self.forecast_sent = None    # (today, forecast_5days) đã gửi
+        self.snapshot_text = None    # (seq, text) snapshot dùng chung cho client mới không kèm ?since=
+        self._snapshot_version = 0   # tăng mỗi lần cache snapshot bị hủy
+        self._task = None
+        WS_CLIENTS.set_function(lambda: len(self.clients))
+        WS_QUEUED_FRAMES.set_function(lambda: sum(writer.pending for writer in list(self.clients.values())))
+        WS_MAX_CLIENT_LAG.set_function(lambda: max((writer.lag() for writer in list(self.clients.values())), default=0.0))
+
+    def connect(self, websocket: WebSocket, legacy: bool = False) -> ClientWriter:
+        """Register a client; its writer starts once the snapshot is queued"""
+        writer = ClientWriter(websocket, legacy, max_rows=WS_HISTORY_ROWS, send_timeout=self.send_timeout,
+                              on_close=self._forget)
+        self.clients[websocket] = writer
+        return writer
+
+    def _forget(self, websocket: WebSocket):
+        self.clients.pop(websocket, None)
+
+    async def disconnect(self, websocket: WebSocket):
+        writer = self.clients.pop(websocket, None)
+        if writer:
+            await writer.stop()
+
+    def _split(self):
+        """(protocol 1 writers, protocol 2 writers)"""
+        legacy, current = [], []
+        for writer in list(self.clients.values()):
+            (legacy if writer.legacy else current).append(writer)
+        return legacy, current
+
+    def start(self):
+        """Start the shared broadcast producer"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.broadcast_loop())
+
+    async def stop(self):
+        """Stop the shared broadcast producer"""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def send_snapshot(self, writer: ClientWriter, since: Optional[int] = None): # Client mới nhận ngay dữ liệu, không chờ chu kỳ sau
+        if writer.legacy:
+            if self.last_payload_text is None:
+                self.last_payload_text = self._serialize(await build_dashboard_payload())
+            writer.send_first(self.last_payload_text, 'legacy')
+        elif since is None:
+            if self.snapshot_text is None:
+                version = self._snapshot_version
+                snapshot = await self.build_snapshot()
+                text = self._serialize(snapshot)
+                if version == self._snapshot_version: # Delta chạy trong lúc chờ đã hủy cache → không lưu bản cũ
+                    self.snapshot_text = (snapshot['seq'], text)
+                writer.seq = snapshot['seq']
+                writer.send_first(text)
+            else:
+                writer.seq, text = self.snapshot_text
+                writer.send_first(text)
+        else:
+            snapshot = await self.build_snapshot(since)
+            writer.seq = snapshot['seq']
+            writer.send_first(self._serialize(snapshot))
+        writer.start()
+
+    async def build_snapshot(self, since: Optional[int] = None) -> dict:
+        """Protocol 2 snapshot; with `since` only the history rows after that sequence number"""
+        latest = await build_latest_payload()
+        rows = await run_db(get_history_after, since, WS_HISTORY_ROWS)
+        forecast_data = await get_forecast_rainfall()
+        seq = rows[0]['id'] if rows else (since or 0)
+        # Client đầu tiên: trạng thái của các delta sau bắt đầu từ snapshot này
+        self.seq = max(self.seq or 0, seq)
+        if not self.latest_sent:
+            self.latest_sent = dict(latest)
+        if self.forecast_sent is None:
+            self.forecast_sent = (forecast_data['today'], forecast_data['forecast_5days'])
+        return {
+            'type': 'snapshot',
+            'v': WS_PROTOCOL_VERSION,
+            'seq': seq,
+            'reset': since is None or len(rows) >= WS_HISTORY_ROWS, # False → ghép các dòng mới vào lịch sử đang có
+            'latest': latest,
+            'history': rows,
+            'today': forecast_data['today'],
+            'forecast_5days': forecast_data['forecast_5days']
+        }
 
-    async def handle_websocket(self, websocket: WebSocket): # Nhận kết nối tới WebSocket riêng (cho broadcast).
-        await websocket.accept()
-        self.active_connections.add(websocket)
-        try:
-            while True:
-                await asyncio.sleep(1)  
-        except WebSocketDisconnect:
-            print("Client disconnected")
-        except Exception as e:
-            print(f"WebSocket error: {e}")
-        finally:
-            self.active_connections.discard(websocket)
+    def _latest_changes(self, latest: dict) -> dict:
+        changed = {key: value for key, value in latest.items()
+                   if key not in self.latest_sent or self.latest_sent[key] != value}
+        self.latest_sent.update(changed)
+        return changed
+
+    async def build_delta(self, writers) -> Tuple[dict, Optional[int], list]:
+        """Fetch what changed since the previous tick: (shared delta fields, history base seq, new rows).
+
+        Rows are fetched after the oldest seq among `writers`; broadcast_delta
+        gives each client only the rows it lacks. Shared state is updated only
+        after the last await, so a snapshot built meanwhile is never stale.
+        """
+        latest_payload = await build_latest_payload()
+        seqs = [writer.seq for writer in writers if writer.seq is not None]
+        base = min(seqs) if seqs else None
+        rows = await run_db(get_history_after, base, WS_HISTORY_ROWS) if base is not None else []
+        forecast_data = await get_forecast_rainfall()
+        # --- Không còn await từ đây tới khi đưa vào hàng đợi ---
+        delta = {'type': 'delta'}
+        latest = self._latest_changes(latest_payload)
+        if latest:
+            delta['latest'] = latest
+        forecast = (forecast_data['today'], forecast_data['forecast_5days'])
+        if forecast != self.forecast_sent:
+            self.forecast_sent = forecast
+            delta['today'], delta['forecast_5days'] = forecast
+        if rows and rows[0]['id'] > (self.seq or 0):
+            self.seq = rows[0]['id']
+        if len(delta) > 1 or rows:
+            # seq/latest_sent/forecast_sent vừa đổi: snapshot cache giữ giá trị cũ mà các delta sau không gửi lại
+            self._invalidate_snapshot()
+        return delta, base, rows
+
+    def broadcast_delta(self, writers, delta: dict, base: Optional[int], rows: list):
+        """Queue the delta, adding to each client the history rows after its own seq"""
+        groups = {}
+        for writer in writers:
+            groups.setdefault(writer.seq, []).append(writer)
+        for seq, group in groups.items():
+            frame = dict(delta)
+            # seq None: snapshot chưa vào hàng đợi; seq < base: snapshot cũ hơn lần đọc DB → chờ chu kỳ sau
+            if rows and seq is not None and base is not None and seq >= base:
+                new_rows = [row for row in rows if row['id'] > seq] # rows xếp id giảm dần
+                if new_rows:
+                    frame['seq'] = new_rows[0]['id']
+                    frame['history'] = new_rows
+                    if len(rows) >= WS_HISTORY_ROWS and len(new_rows) == len(rows):
+                        frame['reset'] = True # Có thể đã bỏ sót dòng (server tạm dừng lâu) → client thay toàn bộ
+                    for writer in group:
+                        writer.seq = frame['seq']
+            if len(frame) > 1:
+                self.broadcast_state(group, frame)
+
+    def _invalidate_snapshot(self):
+        self.snapshot_text = None
+        self._snapshot_version += 1
+
+    def _reset_delta_state(self): # Không còn client giao thức 2 → client sau bắt đầu lại từ snapshot
+        self.seq = None
+        self.latest_sent = {}
+        self.forecast_sent = None
+        self._invalidate_snapshot()
+
+    async def broadcast(self, message: dict): # Gửi 1 message sự kiện (device_status, mqtt_status...) cho mọi WebSocket
+        text = self._serialize(message)
+        with WS_BROADCAST_SECONDS.time():
+            for writer in list(self.clients.values()):
+                writer.send_event(text)
+
+    def broadcast_state(self, writers, message: dict):
+        """Queue one state frame for the writers, serialized once"""
+        if not writers:
+            return
+        text = self._serialize(message)
+        with WS_BROADCAST_SECONDS.time():
+            for writer in writers:
+                writer.send_state(message, text)
+
+    async def broadcast_latest(self, latest: dict): # Bản tin cảm biến mới từ MQTT
+        legacy, current = self._split()
+        self.broadcast_state(legacy, {"latest": latest})
+        if current:
+            self._invalidate_snapshot()
+            changed = self._latest_changes(latest)
+            if changed:
+                self.broadcast_state(current, {"type": "delta", "latest": changed})
+
+    def stats(self) -> dict:
+        writers = list(self.clients.values())
+        return {
+            'clients': len(writers),
+            'legacy_clients': sum(writer.legacy for writer in writers),
+            'seq': self.seq,
+            'per_client': [writer.stats() for writer in writers]
+        }
+
+    @staticmethod
+    def _serialize(message: dict) -> str:
+        return json.dumps(message, ensure_ascii=False, separators=(",", ":"))
 
-    async def broadcast(self, message: dict): # Gửi 1 message cho tất cả WebSocket đang hoạt động.
-        disconnected = []
-        for ws in list(self.active_connections):
-            try:
-                await ws.send_json(message)
-            except Exception:
-                disconnected.append(ws)
-        for ws in disconnected:
-            self.active_connections.discard(ws)
-# Mỗi 5 giây
-# Lấy sensor mới nhất
-# Lấy rainfall
-# Lấy lịch sử
-# Lấy forecast
-# Gửi cho tất cả WebSocket
-# ---> Hoạt động song song với WebSocket
     async def broadcast_loop(self):
         while True:
             try:
-                sensor_data = mqtt_client.latest_data.copy() if mqtt_client.latest_data else {}
-                if sensor_data:
-                    current_rainfall = await get_rainfall_data()
-                    sensor_data['rainfall'] = current_rainfall
-                    monthly_rainfall = get_last_month_rainfall()
-                    sensor_data['monthly_rainfall'] = monthly_rainfall
-                    mqtt_client.latest_data.update({
-                        'rainfall': current_rainfall,
-                        'monthly_rainfall': monthly_rainfall
-                    })
-                history_data = get_history_from_db()
-                forecast_data = await get_forecast_rainfall()
-                message = {
-                    'latest': sensor_data,
-                    'history': history_data,
-                    'today': forecast_data['today'],
-                    'forecast_5days': forecast_data['forecast_5days']
-                }
-                
-                for ws in list(self.active_connections):
-                    try:
-                        if ws.application_state == ws.State.CONNECTED:
-                            await ws.send_json(message)
-                        else:
-                            self.active_connections.discard(ws)
-                    except (WebSocketDisconnect, RuntimeError):
-                        self.active_connections.discard(ws)
-                        print("Removed disconnected WebSocket from broadcast_loop")
-                await asyncio.sleep(5) 
+                legacy, current = self._split()
+                if legacy:
+                    message = await build_dashboard_payload()
+                    self.last_payload_text = self._serialize(message)
+                    self.broadcast_state(legacy, message)
+                else:
+                    self.last_payload_text = None # Không có client → không gọi API/DB
+                if current:
+                    delta, base, rows = await self.build_delta(current)
+                    _, current = self._split() # Client kết nối trong lúc chờ DB/API cũng nhận delta
+                    self.broadcast_delta(current, delta, base, rows)
+                else:
+                    self._reset_delta_state()
+                await asyncio.sleep(self.interval)
+            except asyncio.CancelledError:
+                raise
             except Exception as e:
                 print(f"Error in broadcast_loop: {e}")
-                await asyncio.sleep(5)
\ No newline at end of file
+                await asyncio.sleep(self.interval)
+
+ws_manager = WebSocketManager()
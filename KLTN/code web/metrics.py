@@ -0,0 +1,86 @@
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+# Mọi metric Prometheus của server (GET /metrics).
+# Nhãn chỉ nhận tập giá trị cố định (nhóm topic, tên hàm DB, loại dữ liệu thời tiết...),
+# không bao giờ dùng topic đầy đủ, id client hay giá trị đo làm nhãn.
+
+# Bucket cho các đoạn xử lý rất ngắn (handler MQTT, gửi WebSocket)
+FAST_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+# Thời gian một gói nằm trong hàng đợi gửi của client WebSocket
+QUEUE_LAG_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Độ trễ bắn hẹn giờ: từ vài mili giây tới cả giờ (bù mốc bị lỡ khi khởi động)
+LAG_BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0, 60.0, 300.0, 900.0, 3600.0, 21600.0)
+
+# --- MQTT (mqtt_bridge) ---
+MQTT_MESSAGES = Counter(
+    'mqtt_messages_total', 'MQTT messages handed to the bridge', ['family'])
+MQTT_DROPPED = Counter(
+    'mqtt_messages_dropped_total', 'MQTT messages dropped because the family queue was full or stopped', ['family'])
+MQTT_HANDLER_ERRORS = Counter(
+    'mqtt_handler_errors_total', 'MQTT handler exceptions', ['family'])
+MQTT_HANDLER_SECONDS = Histogram(
+    'mqtt_handler_seconds', 'Time spent in the MQTT handler per message', ['family'], buckets=FAST_BUCKETS)
+MQTT_QUEUE_DEPTH = Gauge(
+    'mqtt_queue_depth', 'Messages waiting in each MQTT family queue', ['family'])
+
+# --- WebSocket (WebSocketManager, ClientWriter) ---
+# Độ trễ từng client xem ở /api/ws-stats; ở đây chỉ có tổng/giá trị lớn nhất
+WS_CLIENTS = Gauge(
+    'websocket_clients', 'Connected WebSocket clients')
+WS_SEND_SECONDS = Histogram(
+    'websocket_send_seconds', 'Time to send one frame to one client', buckets=FAST_BUCKETS)
+WS_BROADCAST_SECONDS = Histogram(
+    'websocket_broadcast_seconds', 'Time to queue one frame for every client')
+WS_DROPPED = Counter(
+    'websocket_dropped_total', 'WebSockets evicted (overflow, idle, timeout) or removed after a failed send', ['reason'])
+WS_QUEUE_LAG_SECONDS = Histogram(
+    'websocket_queue_lag_seconds', 'Time a frame waited in its client send queue', buckets=QUEUE_LAG_BUCKETS)
+WS_QUEUED_FRAMES = Gauge(
+    'websocket_queued_frames', 'Frames waiting in every client send queue')
+WS_MAX_CLIENT_LAG = Gauge(
+    'websocket_max_client_lag_seconds', 'Age of the oldest unsent frame over all clients')
+WS_COALESCED = Counter(
+    'websocket_coalesced_total', 'State frames merged into one still waiting to be sent', ['kind'])
+WS_PING_RTT_SECONDS = Histogram(
+    'websocket_ping_rtt_seconds', 'Application ping/pong round trip', buckets=FAST_BUCKETS + (5.0, 10.0))
+WS_SENT_BYTES = Counter(
+    'websocket_sent_bytes_total', 'Bytes sent to WebSocket clients by frame kind (snapshot, delta, legacy, event)', ['kind'])
+
+# --- PostgreSQL (db.py) ---
+DB_QUERY_SECONDS = Histogram(
+    'db_query_seconds', 'Duration of a DB helper, connection checkout included', ['query'])
+DB_QUERY_ERRORS = Counter(
+    'db_query_errors_total', 'DB helpers that raised', ['query'])
+DB_POOL_WAIT_SECONDS = Histogram(
+    'db_pool_wait_seconds', 'Time waiting for a pooled connection', buckets=FAST_BUCKETS)
+DB_EXECUTOR_WAIT_SECONDS = Histogram(
+    'db_executor_wait_seconds', 'Time a run_db call waited for a free DB thread', buckets=FAST_BUCKETS)
+
+# --- Thời tiết (weather.py) ---
+WEATHER_FETCH_SECONDS = Histogram(
+    'weather_upstream_seconds', 'Upstream weather API latency', ['kind'])
+WEATHER_FETCH_ERRORS = Counter(
+    'weather_upstream_errors_total', 'Failed upstream weather API calls', ['kind'])
+WEATHER_CACHE = Counter(
+    'weather_cache_total', 'Weather cache lookups by result (hit, miss, stale)', ['kind', 'result'])
+
+# --- Dự đoán (inference.py) ---
+INFERENCE_SECONDS = Histogram(
+    'inference_seconds', 'Inference call latency seen by the endpoint (queue + compute)', ['method'])
+INFERENCE_COMPUTE_SECONDS = Histogram(
+    'inference_compute_seconds', 'Model compute time inside the worker', ['method'])
+INFERENCE_FAILURES = Counter(
+    'inference_failures_total', 'Inference calls that did not return a result', ['reason'])
+INFERENCE_IN_FLIGHT = Gauge(
+    'inference_in_flight', 'Inference calls queued or running')
+
+# --- Hẹn giờ (device_timer.py) ---
+TIMER_FIRE_LAG_SECONDS = Histogram(
+    'timer_fire_lag_seconds', 'Actual minus scheduled time of a timer edge', ['kind'], buckets=LAG_BUCKETS)
+TIMER_COMMANDS = Counter(
+    'timer_commands_total', 'Device commands sent by timers', ['kind', 'result'])
+
+
+def render():
+    """(body, content type) of the current metrics in the Prometheus text format"""
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,238 @@
+import asyncio
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from crop_predictor import COMPILED_MODEL_FILE, MODEL_DIR, MODEL_FILES, MODEL_FORMAT, load_predictor
+
+# Quét lại thư mục models/ sau bấy nhiêu giây (0 = chỉ quét khi khởi động)
+MODEL_WATCH_INTERVAL = float(os.getenv("MODEL_WATCH_INTERVAL", 30))
+# Số phiên bản mới nhất được giữ (có thể chọn bằng ?model_version=) và giữ trong bộ nhớ
+MODEL_KEEP_VERSIONS = int(os.getenv("MODEL_KEEP_VERSIONS", 3))
+# Ghim một phiên bản cố định thay vì luôn dùng bản mới nhất
+MODEL_VERSION = os.getenv("MODEL_VERSION") or None
+
+# Các file .pkl/.npz nằm thẳng trong models/ là phiên bản "default"
+DEFAULT_VERSION = 'default'
+
+
+class ModelLoadError(Exception):
+    """A model version could not be loaded"""
+
+
+class ModelVersion(NamedTuple):
+    name: str
+    files: Dict[str, str]
+    compiled_file: str
+    signature: Tuple   # (tên file, mtime_ns, size) của mọi file model → đổi nội dung là đổi phiên bản
+
+    @property
+    def key(self):
+        return self.name, self.signature
+
+
+def _natural_key(name: str):
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', name)]
+
+
+def scan_version(name: str, directory: str) -> Optional[ModelVersion]:
+    """ModelVersion for a directory holding crop_model.npz and/or the three .pkl files"""
+    files = {key: os.path.join(directory, os.path.basename(path)) for key, path in MODEL_FILES.items()}
+    compiled_file = os.path.join(directory, os.path.basename(COMPILED_MODEL_FILE))
+    present = [path for path in (compiled_file, *files.values()) if os.path.isfile(path)]
+    has_compiled = compiled_file in present
+    has_pickles = all(path in present for path in files.values())
+    if MODEL_FORMAT == 'compiled' and not has_compiled or MODEL_FORMAT == 'pickle' and not has_pickles:
+        return None
+    if not (has_compiled or has_pickles):
+        return None
+    signature = []
+    for path in present:
+        stat = os.stat(path)
+        signature.append((os.path.basename(path), stat.st_mtime_ns, stat.st_size))
+    return ModelVersion(name, files, compiled_file, tuple(signature))
+
+
+def discover_versions(model_dir: str = MODEL_DIR) -> List[ModelVersion]:
+    """Every loadable version under model_dir, oldest first ("default" first, then subdirectories by name)"""
+    versions = []
+    if not os.path.isdir(model_dir):
+        return versions
+    default = scan_version(DEFAULT_VERSION, model_dir)
+    if default:
+        versions.append(default)
+    subdirs = [entry for entry in os.scandir(model_dir) if entry.is_dir() and not entry.name.startswith(('.', '_'))]
+    for entry in sorted(subdirs, key=lambda entry: _natural_key(entry.name)):
+        version = scan_version(entry.name, entry.path)
+        if version:
+            versions.append(version)
+    return versions
+
+
+class PredictorCache:
+    """Loaded predictors keyed by (version, signature), at most `keep`, loaded on first use"""
+
+    def __init__(self, keep: int = MODEL_KEEP_VERSIONS):
+        self.keep = max(1, keep)
+        self._loaded = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, version: ModelVersion):
+        with self._lock:
+            predictor = self._loaded.get(version.key)
+            if predictor is None:
+                predictor = load_predictor(version.files, version.compiled_file)
+                if predictor is None:
+                    raise ModelLoadError(f"Không tải được model phiên bản {version.name}")
+                self._loaded[version.key] = predictor
+                while len(self._loaded) > self.keep:
+                    self._loaded.popitem(last=False)
+            self._loaded.move_to_end(version.key)
+            return predictor
+
+    def peek(self, version: ModelVersion):
+        """The predictor if already loaded, without loading it"""
+        with self._lock:
+            return self._loaded.get(version.key)
+
+    def loaded(self) -> List[str]:
+        with self._lock:
+            return [name for name, _ in self._loaded]
+
+
+class ModelRegistry:
+    """Versions found under models/, the active one, and lazily loaded predictors.
+
+    Nothing is loaded at import: the first resolve() scans the directory if
+    nothing did yet, and get() loads a version on its first prediction.
+    After that only the watch() task (or an explicit refresh()) rescans, in
+    a thread, so requests never touch the filesystem; the newest version
+    becomes active by swapping one reference, so a request always uses the
+    single version it resolved. A version that fails to load is skipped
+    until its files change.
+    """
+
+    def __init__(self, model_dir: str = MODEL_DIR, keep: int = MODEL_KEEP_VERSIONS,
+                 pinned: Optional[str] = MODEL_VERSION, watch_interval: float = MODEL_WATCH_INTERVAL):
+        self.model_dir = model_dir
+        self.keep = max(1, keep)
+        self.pinned = pinned
+        self.watch_interval = watch_interval
+        self.cache = PredictorCache(self.keep)
+        self.versions: Dict[str, ModelVersion] = {}
+        self.active: Optional[ModelVersion] = None
+        self.failed: Dict = {}            # version.key -> lỗi
+        self.swaps = 0
+        self._scanned_at = None
+        self._lock = threading.Lock()
+        self._task = None
+
+    def refresh(self) -> bool:
+        """Rescan model_dir; returns True if the active version changed"""
+        found = discover_versions(self.model_dir)
+        usable = [version for version in found if version.key not in self.failed]
+        kept = usable[-self.keep:]
+        if self.pinned:
+            kept += [version for version in usable if version.name == self.pinned and version not in kept]
+        with self._lock:
+            self._scanned_at = time.monotonic()
+            self.versions = {version.name: version for version in kept}
+            if self.pinned:
+                active = self.versions.get(self.pinned)
+            else:
+                active = kept[-1] if kept else None
+            changed = active != self.active
+            if changed:
+                previous = self.active
+                self.active = active # đổi tham chiếu duy nhất → request mới dùng bản mới, request cũ giữ bản cũ
+                self.swaps += previous is not None
+        if changed:
+            if active:
+                print(f"🔁 Model đang dùng: {active.name}" + (f" (thay {previous.name})" if previous else ""))
+            else:
+                print(f"⚠️ Không có model nào trong {self.model_dir}")
+        return changed
+
+    def _ensure_scanned(self):
+        # Chỉ quét đồng bộ khi chưa quét lần nào; các lần sau do watch() quét trong thread riêng
+        if self._scanned_at is None:
+            self.refresh()
+
+    @property
+    def available(self) -> bool:
+        self._ensure_scanned()
+        return self.active is not None
+
+    def resolve(self, version: Optional[str] = None) -> ModelVersion:
+        """The requested kept version, or the active one; raises ModelLoadError if none"""
+        self._ensure_scanned()
+        with self._lock:
+            resolved = self.versions.get(version) if version else self.active
+        if resolved is None:
+            raise ModelLoadError(f"Không có model phiên bản {version}" if version else "Chưa có model nào")
+        return resolved
+
+    def mark_failed(self, version: ModelVersion, error):
+        """Stop using a version until its files change, and fall back to the previous one"""
+        print(f"❌ Model phiên bản {version.name} lỗi, bỏ qua: {error}")
+        self.failed[version.key] = str(error)
+        self.refresh()
+
+    def get(self, version: Optional[str] = None):
+        """(ModelVersion, predictor) loaded in this process; falls back if the newest version is broken"""
+        while True:
+            resolved = self.resolve(version)
+            try:
+                return resolved, self.cache.get(resolved)
+            except ModelLoadError as e:
+                if version:
+                    raise
+                self.mark_failed(resolved, e)
+
+    async def watch(self, on_change=None):
+        """Rescan every watch_interval seconds; await on_change(version) after each swap"""
+        while True:
+            await asyncio.sleep(self.watch_interval)
+            try:
+                if await asyncio.to_thread(self.refresh) and on_change and self.active:
+                    await on_change(self.active)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"❌ Lỗi khi quét thư mục model: {e}")
+
+    async def start(self, on_change=None):
+        """First scan off the event loop, then start the watch task"""
+        await asyncio.to_thread(self.refresh)
+        self.start_watching(on_change)
+
+    def start_watching(self, on_change=None):
+        if self.watch_interval > 0 and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self.watch(on_change))
+
+    async def stop_watching(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'active': self.active.name if self.active else None,
+                'pinned': self.pinned,
+                'versions': list(self.versions),
+                'loaded': self.cache.loaded(),
+                'failed': sorted({name for name, _ in self.failed}),
+                'swaps': self.swaps,
+                'watch_interval': self.watch_interval
+            }
+
+
+model_registry = ModelRegistry()
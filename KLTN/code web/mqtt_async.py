@@ -0,0 +1,208 @@
+import asyncio
+import os
+import ssl
+
+import paho.mqtt.client as mqtt
+
+# "thread" = paho loop_start() như cũ, "asyncio" = AsyncMQTTTransport chạy trên event loop
+MQTT_TRANSPORT = os.getenv("MQTT_TRANSPORT", "thread").lower()
+MQTT_MESSAGE_QUEUE_SIZE = int(os.getenv("MQTT_MESSAGE_QUEUE_SIZE", 1000))
+# Mặc định giống broker production (WebSocket + TLS); đặt tcp/false để test với mosquitto cục bộ
+MQTT_SOCKET_TRANSPORT = os.getenv("MQTT_SOCKET_TRANSPORT", "websockets")
+MQTT_USE_TLS = os.getenv("MQTT_USE_TLS", "true").lower() == "true"
+
+
+class AsyncMQTTTransport:
+    """paho-mqtt driven by the asyncio event loop instead of a loop_start() thread.
+
+    Socket readiness comes from loop.add_reader/add_writer and keepalive from a
+    loop_misc() task, so every paho callback runs on the event loop thread.
+    connect(), publish() and subscribe() are awaitable; incoming messages are
+    read with `async for topic, payload in transport.messages()`.
+    """
+
+    def __init__(self, client_id: str, transport: str = "websockets", use_tls: bool = True,
+                 tls_insecure: bool = False, username: str = None, password: str = None,
+                 keepalive: int = 60, queue_size: int = MQTT_MESSAGE_QUEUE_SIZE):
+        self.client = mqtt.Client(client_id=client_id, transport=transport)
+        if use_tls:
+            self.client.tls_set(tls_version=ssl.PROTOCOL_TLSv1_2)
+            self.client.tls_insecure_set(tls_insecure)
+        if username:
+            self.client.username_pw_set(username, password)
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.client.on_message = self._on_message
+        self.client.on_publish = self._on_publish
+        self.client.on_subscribe = self._on_subscribe
+        self.client.on_socket_open = self._on_socket_open
+        self.client.on_socket_close = self._on_socket_close
+        self.client.on_socket_register_write = self._on_socket_register_write
+        self.client.on_socket_unregister_write = self._on_socket_unregister_write
+        self.keepalive = keepalive
+        self.queue_size = queue_size
+        self.is_connected = False
+        self.on_connection_change = None # callback(connected: bool, rc: int)
+        self.dropped_messages = 0
+        self._loop = None
+        self._misc_task = None
+        self._connect_future = None
+        self._acks = {}        # mid -> Future chờ PUBACK/PUBCOMP
+        self._subacks = {}     # mid -> Future chờ SUBACK
+        self._messages = None
+        self._disconnected = None
+
+    # --- Kết nối ---
+    async def connect(self, host: str, port: int, timeout: float = 30):
+        """Open the connection and wait for CONNACK; raises ConnectionError on failure"""
+        self._loop = asyncio.get_running_loop()
+        if self._messages is None:
+            self._messages = asyncio.Queue(maxsize=self.queue_size)
+            self._disconnected = asyncio.Event()
+        self._connect_future = self._loop.create_future()
+        try:
+            # client.connect() mở TCP/TLS/WebSocket bằng socket blocking → chạy ở executor,
+            # các callback socket được chuyển về event loop qua call_soon_threadsafe
+            await asyncio.wait_for(
+                self._loop.run_in_executor(None, self.client.connect, host, port, self.keepalive),
+                timeout
+            )
+            await asyncio.wait_for(asyncio.shield(self._connect_future), timeout)
+        except asyncio.TimeoutError:
+            self.client.disconnect()
+            raise ConnectionError(f"MQTT broker {host}:{port} không phản hồi sau {timeout}s")
+        except OSError as e:
+            raise ConnectionError(f"Không thể kết nối MQTT broker {host}:{port}: {e}") from e
+
+    async def disconnect(self):
+        """Send DISCONNECT and wait until the socket is closed"""
+        if self.client.socket() is None:
+            return
+        self.client.disconnect()
+        try:
+            await asyncio.wait_for(self._disconnected.wait(), timeout=5)
+        except asyncio.TimeoutError:
+            self.client.loop_misc()
+
+    async def wait_disconnected(self):
+        """Return once the connection is lost (immediately if not connected)"""
+        if self.is_connected and self._disconnected is not None:
+            await self._disconnected.wait()
+
+    # --- Publish / subscribe ---
+    def publish_nowait(self, topic: str, payload, qos: int = 1, retain: bool = False):
+        """Queue a PUBLISH; returns a Future resolved with the mid on PUBACK (or on send for QoS 0)"""
+        info = self.client.publish(topic, payload, qos=qos, retain=retain)
+        future = self._loop.create_future()
+        if info.rc != mqtt.MQTT_ERR_SUCCESS:
+            future.set_exception(ConnectionError(f"MQTT publish lỗi: {mqtt.error_string(info.rc)}"))
+        elif info.is_published():
+            future.set_result(info.mid)
+        else:
+            self._acks[info.mid] = future
+        return future
+
+    async def publish(self, topic: str, payload, qos: int = 1, retain: bool = False, timeout: float = 10):
+        """Publish and wait for the broker acknowledgement"""
+        return await asyncio.wait_for(self.publish_nowait(topic, payload, qos, retain), timeout)
+
+    async def subscribe(self, topics, timeout: float = 10):
+        """Subscribe to [(topic, qos), ...] and wait for SUBACK; returns the granted QoS list"""
+        rc, mid = self.client.subscribe(topics)
+        if rc != mqtt.MQTT_ERR_SUCCESS:
+            raise ConnectionError(f"MQTT subscribe lỗi: {mqtt.error_string(rc)}")
+        future = self._loop.create_future()
+        self._subacks[mid] = future
+        return await asyncio.wait_for(future, timeout)
+
+    async def messages(self):
+        """Async iterator of (topic, payload_bytes) for every received message"""
+        while True:
+            yield await self._messages.get()
+
+    # --- Callback của paho (đều chạy trên event loop) ---
+    def _on_connect(self, client, userdata, flags, rc):
+        self.is_connected = rc == 0
+        future = self._connect_future
+        if future is not None and not future.done():
+            if rc == 0:
+                future.set_result(True)
+            else:
+                future.set_exception(ConnectionError(f"MQTT từ chối kết nối: {mqtt.connack_string(rc)}"))
+        if rc == 0:
+            self._disconnected.clear()
+        if self.on_connection_change:
+            self.on_connection_change(self.is_connected, rc)
+
+    def _on_disconnect(self, client, userdata, rc):
+        self.is_connected = False
+        self._disconnected.set()
+        error = ConnectionError(f"Mất kết nối MQTT: {mqtt.error_string(rc)}")
+        for pending in (self._acks, self._subacks):
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(error)
+            pending.clear()
+        if self.on_connection_change:
+            self.on_connection_change(False, rc)
+
+    def _on_message(self, client, userdata, msg):
+        if self._messages.full():
+            # Ưu tiên message mới nhất nếu bên đọc không theo kịp
+            self._messages.get_nowait()
+            self.dropped_messages += 1
+        self._messages.put_nowait((msg.topic, msg.payload))
+
+    def _on_publish(self, client, userdata, mid):
+        future = self._acks.pop(mid, None)
+        if future is not None and not future.done():
+            future.set_result(mid)
+
+    def _on_subscribe(self, client, userdata, mid, granted_qos):
+        future = self._subacks.pop(mid, None)
+        if future is not None and not future.done():
+            future.set_result(list(granted_qos))
+
+    def _threadsafe(self, func, *args):
+        # client.connect() chạy ở executor nên callback socket có thể đến từ thread khác
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop:
+            func(*args)
+        else:
+            self._loop.call_soon_threadsafe(func, *args)
+
+    def _on_socket_open(self, client, userdata, sock):
+        self._threadsafe(self._register_reader, sock)
+
+    def _on_socket_close(self, client, userdata, sock):
+        self._threadsafe(self._unregister, sock)
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self._threadsafe(self._loop.add_writer, sock, self.client.loop_write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self._threadsafe(self._loop.remove_writer, sock)
+
+    def _register_reader(self, sock):
+        self._loop.add_reader(sock, self._read, sock)
+        if self._misc_task is None or self._misc_task.done():
+            self._misc_task = self._loop.create_task(self._misc_loop())
+
+    def _unregister(self, sock):
+        self._loop.remove_reader(sock)
+        self._loop.remove_writer(sock)
+
+    def _read(self, sock):
+        self.client.loop_read()
+        # TLS/WebSocket có thể giữ sẵn dữ liệu đã giải mã mà fd không báo readable nữa
+        pending = getattr(sock, 'pending', None)
+        while pending and pending() > 0 and self.client.socket() is sock:
+            self.client.loop_read()
+
+    async def _misc_loop(self):
+        # Thay cho vòng lặp nền của loop_start(): gửi PINGREQ, phát hiện mất kết nối
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
@@ -0,0 +1,145 @@
+import asyncio
+import os
+import threading
+import time
+
+from metrics import MQTT_DROPPED, MQTT_HANDLER_ERRORS, MQTT_HANDLER_SECONDS, MQTT_MESSAGES, MQTT_QUEUE_DEPTH
+
+# Số message tối đa chờ xử lý cho mỗi nhóm topic; đầy thì bỏ message cũ nhất
+MQTT_QUEUE_SIZE = int(os.getenv("MQTT_QUEUE_SIZE", 1000))
+
+TOPIC_FAMILIES = ('sensor', 'status', 'control')
+
+
+def topic_family(topic: str):
+    """Map an MQTT topic to its dispatcher family (None = ignored)"""
+    if topic == "iot/sensor/data":
+        return 'sensor'
+    if topic.startswith("iot/device/status/"):
+        return 'status'
+    if topic.startswith("iot/device/control/"):
+        return 'control'
+    return None
+
+
+class MQTTBridge:
+    """Hand raw MQTT messages from the paho thread to per-family asyncio queues.
+
+    submit() only schedules a put_nowait on the event loop, so the network
+    thread never waits for handlers and QoS 1 acks are not delayed. One
+    dispatcher coroutine per family awaits the registered handler in order.
+    """
+
+    def __init__(self, queue_size: int = MQTT_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._handlers = {}
+        self._queues = {}
+        self._tasks = {}
+        self._loop = None
+        self._lock = threading.Lock()
+        self.ignored = 0
+        self.counters = {
+            family: {'received': 0, 'dropped': 0, 'processed': 0, 'errors': 0}
+            for family in TOPIC_FAMILIES
+        }
+        for family in TOPIC_FAMILIES:
+            MQTT_QUEUE_DEPTH.labels(family).set_function(lambda family=family: self._depth(family))
+
+    def _depth(self, family):
+        queue = self._queues.get(family)
+        return queue.qsize() if queue is not None else 0
+
+    def register(self, family: str, handler):
+        """Set the coroutine function handler(topic, payload_bytes) for a family"""
+        if family not in TOPIC_FAMILIES:
+            raise ValueError(f"Unknown topic family: {family}")
+        self._handlers[family] = handler
+
+    def start(self):
+        """Create the queues and dispatcher tasks on the running event loop"""
+        loop = asyncio.get_running_loop()
+        if self._loop is loop and all(not task.done() for task in self._tasks.values()):
+            return
+        self._loop = loop
+        for family in TOPIC_FAMILIES:
+            self._queues[family] = asyncio.Queue(maxsize=self.queue_size)
+            self._tasks[family] = loop.create_task(self._dispatch(family))
+
+    async def stop(self):
+        """Cancel the dispatchers; messages still queued are discarded"""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks.clear()
+        self._queues.clear()
+        self._loop = None
+
+    def submit(self, topic: str, payload: bytes):
+        """Queue one message; safe to call from the paho network thread"""
+        family = topic_family(topic)
+        loop = self._loop
+        if family is None:
+            self.ignored += 1
+            return False
+        if loop is None or loop.is_closed():
+            with self._lock:
+                self.counters[family]['dropped'] += 1
+            MQTT_DROPPED.labels(family).inc()
+            return False
+        with self._lock:
+            self.counters[family]['received'] += 1
+        MQTT_MESSAGES.labels(family).inc()
+        loop.call_soon_threadsafe(self._enqueue, family, topic, payload)
+        return True
+
+    def _enqueue(self, family, topic, payload):
+        queue = self._queues.get(family)
+        if queue is None:
+            return
+        if queue.full():
+            # Ưu tiên message mới nhất, bỏ message cũ nhất đang chờ
+            queue.get_nowait()
+            queue.task_done()
+            with self._lock:
+                self.counters[family]['dropped'] += 1
+            MQTT_DROPPED.labels(family).inc()
+        queue.put_nowait((topic, payload))
+
+    async def _dispatch(self, family):
+        queue = self._queues[family]
+        handler_seconds = MQTT_HANDLER_SECONDS.labels(family)
+        while True:
+            topic, payload = await queue.get()
+            started = time.perf_counter()
+            try:
+                handler = self._handlers.get(family)
+                if handler is not None:
+                    await handler(topic, payload)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                with self._lock:
+                    self.counters[family]['errors'] += 1
+                MQTT_HANDLER_ERRORS.labels(family).inc()
+                print(f"❌ Lỗi xử lý message {topic}: {e}")
+            finally:
+                handler_seconds.observe(time.perf_counter() - started)
+                with self._lock:
+                    self.counters[family]['processed'] += 1
+                queue.task_done()
+
+    def stats(self) -> dict:
+        with self._lock:
+            families = {
+                family: {
+                    'depth': self._queues[family].qsize() if family in self._queues else 0,
+                    'maxsize': self.queue_size,
+                    **counters
+                }
+                for family, counters in self.counters.items()
+            }
+        return {'running': bool(self._tasks), 'ignored': self.ignored, 'families': families}
+
+
+mqtt_bridge = MQTTBridge()
@@ -0,0 +1,162 @@
+import argparse
+from datetime import datetime
+
+import pytz
+
+from db import get_connection, timed_query
+
+vn_tz = pytz.timezone('Asia/Ho_Chi_Minh')
+
+# Bảng tổng hợp theo giờ / ngày, cập nhật cộng dồn mỗi lần ghi sensor_history
+ROLLUP_METRICS = ['temperature', 'humidity', 'nitrogen', 'phosphorus', 'potassium', 'ph', 'rainfall']
+ROLLUP_TABLES = {
+    'hour': 'sensor_rollup_hourly',
+    'day': 'sensor_rollup_daily'
+}
+
+
+def vn_wall_time(ts: datetime) -> datetime:
+    """Naive VN wall time, the form stored in sensor_history.timestamp"""
+    # Cột TIMESTAMP không có múi giờ: giá trị aware sẽ bị đổi theo TimeZone của phiên PostgreSQL,
+    # nên luôn ghi giờ VN dạng naive để backfill (date_trunc trong SQL) và apply_rollups ra cùng bucket
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(vn_tz).replace(tzinfo=None)
+    return ts
+
+
+def _truncate(ts: datetime, bucket: str) -> datetime:
+    """Truncate a timestamp to its bucket in naive VN time (same as the sensor_history column)"""
+    ts = vn_wall_time(ts)
+    if bucket == 'day':
+        return ts.replace(hour=0, minute=0, second=0, microsecond=0)
+    return ts.replace(minute=0, second=0, microsecond=0)
+
+
+def create_rollup_tables(cur):
+    """Create the rollup tables; backfill them once if sensor_history already has rows"""
+    metric_columns = ',\n'.join(
+        f'{m}_sum DOUBLE PRECISION DEFAULT 0, {m}_min REAL, {m}_max REAL' for m in ROLLUP_METRICS
+    )
+    for bucket, table in ROLLUP_TABLES.items():
+        cur.execute(f'''CREATE TABLE IF NOT EXISTS {table} (
+                        bucket TIMESTAMP PRIMARY KEY,
+                        count INTEGER NOT NULL DEFAULT 0,
+                        {metric_columns}
+                    )''')
+        cur.execute(f'SELECT EXISTS (SELECT 1 FROM {table})')
+        if not cur.fetchone()[0]:
+            _backfill_table(cur, bucket, table)
+
+
+def _upsert_sql(table: str) -> str:
+    columns = ['bucket', 'count']
+    updates = [f'count = {table}.count + EXCLUDED.count']
+    for m in ROLLUP_METRICS:
+        columns += [f'{m}_sum', f'{m}_min', f'{m}_max']
+        updates += [
+            f'{m}_sum = {table}.{m}_sum + EXCLUDED.{m}_sum',
+            f'{m}_min = LEAST({table}.{m}_min, EXCLUDED.{m}_min)',
+            f'{m}_max = GREATEST({table}.{m}_max, EXCLUDED.{m}_max)'
+        ]
+    placeholders = ', '.join(['%s'] * len(columns))
+    return (f'INSERT INTO {table} ({", ".join(columns)}) VALUES ({placeholders}) '
+            f'ON CONFLICT (bucket) DO UPDATE SET {", ".join(updates)}')
+
+
+def apply_rollups(cur, samples):
+    """Fold (timestamp, {metric: value}) samples into the rollup tables.
+
+    Samples are pre-aggregated per bucket so a batch costs one upsert per
+    touched bucket. Must run in the same transaction as the raw INSERT.
+    """
+    for bucket, table in ROLLUP_TABLES.items():
+        grouped = {}
+        for ts, values in samples:
+            key = _truncate(ts, bucket)
+            acc = grouped.get(key)
+            if acc is None:
+                acc = grouped[key] = {'count': 0}
+            acc['count'] += 1
+            for m in ROLLUP_METRICS:
+                value = values.get(m)
+                if value is None:
+                    continue
+                value = float(value)
+                acc[f'{m}_sum'] = acc.get(f'{m}_sum', 0.0) + value
+                acc[f'{m}_min'] = min(acc.get(f'{m}_min', value), value)
+                acc[f'{m}_max'] = max(acc.get(f'{m}_max', value), value)
+        rows = []
+        for key, acc in grouped.items():
+            row = [key, acc['count']]
+            for m in ROLLUP_METRICS:
+                row += [acc.get(f'{m}_sum', 0.0), acc.get(f'{m}_min'), acc.get(f'{m}_max')]
+            rows.append(row)
+        if rows:
+            cur.executemany(_upsert_sql(table), rows)
+
+
+def _backfill_table(cur, bucket: str, table: str):
+    aggregates = ', '.join(f'COALESCE(SUM({m}), 0), MIN({m}), MAX({m})' for m in ROLLUP_METRICS)
+    columns = ', '.join(f'{m}_sum, {m}_min, {m}_max' for m in ROLLUP_METRICS)
+    # TRUNCATE khóa bảng: các lần ghi đồng thời sẽ chờ và cộng dồn sau khi backfill commit
+    cur.execute(f'TRUNCATE {table}')
+    cur.execute(f'''INSERT INTO {table} (bucket, count, {columns})
+                    SELECT date_trunc(%s, timestamp), COUNT(*), {aggregates}
+                    FROM sensor_history
+                    WHERE timestamp IS NOT NULL
+                    GROUP BY 1''', [bucket])
+
+
+@timed_query
+def backfill_rollups():
+    """Rebuild every rollup table from sensor_history"""
+    with get_connection() as conn:
+        cur = conn.cursor()
+        create_rollup_tables(cur)
+        for bucket, table in ROLLUP_TABLES.items():
+            _backfill_table(cur, bucket, table)
+            cur.execute(f'SELECT COUNT(*) FROM {table}')
+            print(f"✅ Đã backfill {table}: {cur.fetchone()[0]} bucket")
+
+
+@timed_query
+def get_rollups(bucket: str, start=None, end=None, max_buckets: int = 2000):
+    """Return per-bucket count/min/max/mean from a rollup table, oldest first"""
+    table = ROLLUP_TABLES[bucket]
+    conditions, params = [], []
+    if start is not None:
+        conditions.append('bucket >= %s')
+        params.append(_truncate(start, bucket))
+    if end is not None:
+        conditions.append('bucket < %s')
+        params.append(end)
+    where = (' WHERE ' + ' AND '.join(conditions)) if conditions else ''
+    columns = ', '.join(f'{m}_sum, {m}_min, {m}_max' for m in ROLLUP_METRICS)
+    with get_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(f'''SELECT bucket, count, {columns} FROM {table}{where}
+                        ORDER BY bucket DESC LIMIT %s''', params + [max_buckets])
+        rows = cur.fetchall()
+    result = []
+    for row in reversed(rows):
+        count = row[1]
+        item = {'time': row[0].strftime('%Y-%m-%d %H:%M:%S'), 'count': count}
+        for i, m in enumerate(ROLLUP_METRICS):
+            total, low, high = row[2 + 3 * i: 5 + 3 * i]
+            item[m] = {
+                'min': low,
+                'max': high,
+                'mean': round(total / count, 2) if count else None
+            }
+        result.append(item)
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Quản lý bảng tổng hợp sensor_history theo giờ/ngày')
+    parser.add_argument('--backfill', action='store_true', help='Tính lại toàn bộ bảng rollup từ sensor_history')
+    args = parser.parse_args()
+    if args.backfill:
+        backfill_rollups()
+    else:
+        parser.print_help()
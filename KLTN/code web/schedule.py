@@ -0,0 +1,219 @@
+from datetime import datetime, time as dtime, timedelta
+from functools import lru_cache
+from typing import Iterable, Iterator, List, Optional
+
+import pytz
+
+vn_tz = pytz.timezone('Asia/Ho_Chi_Minh')
+
+DAY_NAMES = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+# Tên ngày trong cron: 0 (và 7) = Chủ nhật
+CRON_DAY_NAMES = {'sun': 0, 'mon': 1, 'tue': 2, 'wed': 3, 'thu': 4, 'fri': 5, 'sat': 6}
+CRON_MONTH_NAMES = {name: i + 1 for i, name in enumerate(
+    ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec'])}
+
+
+def _parse_field(field: str, low: int, high: int, names=None) -> List[int]:
+    """Parse one cron field ("*", "1-5", "*/15", "mon,wed", "8-18/2") into sorted values"""
+    values = set()
+    for part in field.lower().split(','):
+        step = 1
+        if '/' in part:
+            part, step_text = part.split('/', 1)
+            step = int(step_text)
+            if step < 1:
+                raise ValueError(f"Bước nhảy không hợp lệ: {field}")
+        if part in ('*', ''):
+            start, end = low, high
+        elif '-' in part:
+            start_text, end_text = part.split('-', 1)
+            start, end = _value(start_text, names), _value(end_text, names)
+        else:
+            start = _value(part, names)
+            end = high if step > 1 else start
+        if start < low or end > high or start > end:
+            raise ValueError(f"Giá trị ngoài khoảng {low}-{high}: {field}")
+        values.update(range(start, end + 1, step))
+    return sorted(values)
+
+
+def _value(text: str, names) -> int:
+    if names and text in names:
+        return names[text]
+    return int(text)
+
+
+class CronSchedule:
+    """Five-field cron expression (minute hour day-of-month month day-of-week).
+
+    next_after() jumps field by field (month → day → hour → minute) instead of
+    scanning minute by minute, so it costs a handful of steps per call.
+    Day-of-month and day-of-week follow Vixie cron semantics: a field
+    starting with "*" (including "*/n") counts as unrestricted and both
+    fields must match; if both are restricted, a day matches when either
+    does. Times are Asia/Ho_Chi_Minh.
+    """
+
+    def __init__(self, expression: str):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"Biểu thức cron cần 5 trường: {expression!r}")
+        self.expression = ' '.join(fields)
+        self.minutes = _parse_field(fields[0], 0, 59)
+        self.hours = _parse_field(fields[1], 0, 23)
+        self.days = _parse_field(fields[2], 1, 31)
+        self.months = _parse_field(fields[3], 1, 12, CRON_MONTH_NAMES)
+        weekdays = _parse_field(fields[4], 0, 7, CRON_DAY_NAMES)
+        # Quy về weekday() của Python: 0 = thứ Hai ... 6 = Chủ nhật
+        self.weekdays = sorted({(d - 1) % 7 for d in weekdays})
+        # Như Vixie cron: trường bắt đầu bằng "*" (kể cả "*/2") không tính là giới hạn
+        self._any_day = fields[2].startswith('*')
+        self._any_weekday = fields[4].startswith('*')
+
+    @classmethod
+    def at(cls, at: dtime, days: Optional[Iterable] = None) -> 'CronSchedule':
+        """Schedule firing at a wall-clock time, every day or on the given weekdays"""
+        return cron(f"{at.minute} {at.hour} * * {weekday_field(days)}")
+
+    def __repr__(self):
+        return f"CronSchedule({self.expression!r})"
+
+    def _day_matches(self, day: datetime) -> bool:
+        dom = day.day in self.days
+        dow = day.weekday() in self.weekdays
+        if self._any_day or self._any_weekday:
+            return dom and dow
+        return dom or dow
+
+    def next_after(self, after: datetime) -> datetime:
+        """First matching instant strictly after `after` (aware datetime in VN time)"""
+        local = after.astimezone(vn_tz).replace(tzinfo=None, second=0, microsecond=0) + timedelta(minutes=1)
+        limit = local.year + 5
+        while local.year <= limit:
+            if local.month not in self.months:
+                later = [m for m in self.months if m > local.month]
+                local = local.replace(day=1, hour=0, minute=0)
+                local = (local.replace(month=later[0]) if later
+                         else local.replace(year=local.year + 1, month=self.months[0]))
+                continue
+            if not self._day_matches(local):
+                local = (local + timedelta(days=1)).replace(hour=0, minute=0)
+                continue
+            if local.hour not in self.hours:
+                later = [h for h in self.hours if h > local.hour]
+                if not later:
+                    local = (local + timedelta(days=1)).replace(hour=0, minute=0)
+                    continue
+                local = local.replace(hour=later[0], minute=0)
+            if local.minute not in self.minutes:
+                later = [m for m in self.minutes if m > local.minute]
+                if not later:
+                    local = (local + timedelta(hours=1)).replace(minute=0)
+                    continue
+                local = local.replace(minute=later[0])
+            return vn_tz.localize(local)
+        raise ValueError(f"Không có lần chạy nào trong 5 năm tới: {self.expression}")
+
+    def last_at_or_before(self, moment: datetime) -> Optional[datetime]:
+        """Latest matching minute at or before `moment`, jumping backwards field by field"""
+        local = moment.astimezone(vn_tz).replace(tzinfo=None, second=0, microsecond=0)
+        limit = local.year - 5
+        while local.year >= limit:
+            if local.month not in self.months:
+                earlier = [m for m in self.months if m < local.month]
+                # Về phút cuối cùng của tháng hợp lệ gần nhất phía trước
+                first = (local.replace(day=1, month=earlier[-1]) if earlier
+                         else local.replace(day=1, year=local.year - 1, month=self.months[-1]))
+                local = (_add_month(first) - timedelta(minutes=1))
+                continue
+            if not self._day_matches(local):
+                local = local.replace(hour=0, minute=0) - timedelta(minutes=1)
+                continue
+            if local.hour not in self.hours:
+                earlier = [h for h in self.hours if h < local.hour]
+                if not earlier:
+                    local = local.replace(hour=0, minute=0) - timedelta(minutes=1)
+                    continue
+                local = local.replace(hour=earlier[-1], minute=59)
+            if local.minute not in self.minutes:
+                earlier = [m for m in self.minutes if m < local.minute]
+                if not earlier:
+                    local = local.replace(minute=0) - timedelta(minutes=1)
+                    continue
+                local = local.replace(minute=earlier[-1])
+            return vn_tz.localize(local)
+        return None
+
+    def iter_after(self, after: datetime) -> Iterator[datetime]:
+        current = after
+        while True:
+            current = self.next_after(current)
+            yield current
+
+
+@lru_cache(maxsize=4096)
+def cron(expression: str) -> CronSchedule:
+    """Parsed CronSchedule shared by every slot with the same expression (schedules are immutable)"""
+    return CronSchedule(expression)
+
+
+@lru_cache(maxsize=2048)
+def parse_hhmm(text: str) -> dtime:
+    """Parse "HH:MM" into a time; raises ValueError"""
+    return datetime.strptime(text, "%H:%M").time()
+
+
+def _add_month(moment: datetime) -> datetime:
+    """First day of the following month at 00:00"""
+    if moment.month == 12:
+        return moment.replace(year=moment.year + 1, month=1, day=1, hour=0, minute=0)
+    return moment.replace(month=moment.month + 1, day=1, hour=0, minute=0)
+
+
+def weekday_field(days: Optional[Iterable]) -> str:
+    """Convert a weekday mask (names "mon".."sun" or 0=Mon..6=Sun) to a cron day-of-week field"""
+    if not days:
+        return '*'
+    cron_days = set()
+    for day in days:
+        if isinstance(day, str):
+            key = day.strip().lower()[:3]
+            if key not in CRON_DAY_NAMES:
+                raise ValueError(f"Ngày không hợp lệ: {day}")
+            cron_days.add(CRON_DAY_NAMES[key])
+        else:
+            if not 0 <= int(day) <= 6:
+                raise ValueError(f"Ngày không hợp lệ: {day}")
+            cron_days.add((int(day) + 1) % 7)
+    return ','.join(str(d) for d in sorted(cron_days))
+
+
+def parse_slot(slot: dict):
+    """Validate one slot and return (on_schedule, off_schedule, normalized_slot).
+
+    A slot is either {"on": "HH:MM", "off": "HH:MM", "days": [...]} or
+    {"cron_on": "<cron>", "cron_off": "<cron>"}; "off"/"cron_off" is optional.
+    """
+    if 'cron_on' in slot:
+        on = cron(slot['cron_on'])
+        off = cron(slot['cron_off']) if slot.get('cron_off') else None
+        normalized = {'cron_on': on.expression}
+        if off:
+            normalized['cron_off'] = off.expression
+        return on, off, normalized
+    if 'on' not in slot:
+        raise ValueError("Slot cần 'on' (HH:MM) hoặc 'cron_on'")
+    days = slot.get('days') or []
+    on_time = parse_hhmm(slot['on'])
+    on = CronSchedule.at(on_time, days)
+    normalized = {'on': on_time.strftime("%H:%M"), 'days': [DAY_NAMES[w] for w in on.weekdays] if days else []}
+    off = None
+    if slot.get('off'):
+        off_time = parse_hhmm(slot['off'])
+        off_days = days
+        if days and off_time <= on_time:
+            # Khung giờ qua nửa đêm: giờ tắt rơi vào ngày hôm sau của mỗi ngày bật
+            off_days = [DAY_NAMES[(w + 1) % 7] for w in on.weekdays]
+        off = CronSchedule.at(off_time, off_days)
+        normalized['off'] = off_time.strftime("%H:%M")
+    return on, off, normalized
@@ -493,6 +493,9 @@ const formatTime = (timestamp) => {
 
 // Biến toàn cục để lưu trữ dữ liệu lịch sử
 let globalHistoryData = [];
+// Giao thức WebSocket 2: id dòng lịch sử mới nhất đã nhận (seq), số dòng giữ lại trên trình duyệt
+let historySeq = null;
+const HISTORY_KEEP_ROWS = 5000;
 
 // Biến để theo dõi trạng thái lọc thời gian
 let isTimeFiltered = false;
@@ -641,21 +644,36 @@ function resetCharts() {
     document.getElementById('endDate').value = '';
     updateCharts(globalHistoryData);
 }
+// Ghép gói lịch sử vào danh sách hiện có (mới nhất trước).
+// Giao thức 2: snapshot/delta có reset → thay toàn bộ, delta thường → thêm các dòng có id > seq.
+// Giao thức 1 (không có type): luôn là toàn bộ lịch sử.
+function applyHistoryFrame(rows, seq, frame) {
+    if (!frame.type || frame.reset || seq === null) {
+        return { rows: frame.history.slice(0, HISTORY_KEEP_ROWS), seq: frame.seq ?? null };
+    }
+    const fresh = frame.history.filter(row => row.id > seq);
+    return {
+        rows: fresh.concat(rows).slice(0, HISTORY_KEEP_ROWS),
+        seq: Math.max(seq, frame.seq ?? seq)
+    };
+}
 // Kiểm tra trạng thái lọc
 function handleWebSocketData(data) {
     console.log('WebSocket Data Received');
 
     try {
         const parsedData = typeof data === 'string' ? JSON.parse(data) : data;
-        // Xử lý dữ liệu cảm biến mới nhất
+        // Xử lý dữ liệu cảm biến mới nhất (delta chỉ chứa các trường đã thay đổi)
         if (parsedData.latest) {
-            lastSensorData = { ...parsedData.latest };
-            updateSensorDisplay(parsedData.latest);
-            updateNotifications(parsedData.latest);
+            lastSensorData = { ...lastSensorData, ...parsedData.latest };
+            updateSensorDisplay(lastSensorData);
+            updateNotifications(lastSensorData);
         }
         // Xử lý dữ liệu lịch sử
         if (parsedData.history && Array.isArray(parsedData.history)) {
-            globalHistoryData = parsedData.history;
+            const merged = applyHistoryFrame(globalHistoryData, historySeq, parsedData);
+            globalHistoryData = merged.rows;
+            historySeq = merged.seq;
             if (!window.chartsInitialized) {
                 initializeCharts();
                 window.chartsInitialized = true;
@@ -1029,6 +1047,11 @@ ws.onopen = () => console.log('Connected to WebSocket server');
 ws.onmessage = (event) => {
     try {
         const data = JSON.parse(event.data);
+        if (data.type === 'ping') {
+            // Trả lời để server không ngắt kết nối vì im lặng quá lâu
+            ws.send(JSON.stringify({ type: 'pong', ts: data.ts }));
+            return;
+        }
         handleWebSocketData(data);
     } catch (error) {
         console.error('Error parsing WebSocket data:', error);
@@ -1324,8 +1347,8 @@ function renderHistoryTable(data) {
         tableBody.appendChild(tr);
     });
 }
-// Hàm lọc dữ liệu lịch sử theo thời gian
-function filterHistoryData() {
+// Hàm lọc dữ liệu lịch sử theo thời gian (lọc phía server qua /history?start=&end=)
+async function filterHistoryData() {
     const start = document.getElementById('history-start-date').value;
     const end = document.getElementById('history-end-date').value;
     if (!start || !end) {
@@ -1338,11 +1361,19 @@ function filterHistoryData() {
         alert('Thời gian bắt đầu phải nhỏ hơn thời gian kết thúc!');
         return;
     }
-    // Lọc dữ liệu
-    const filtered = globalHistoryData.filter(row => {
-        const rowTime = new Date(row.timestamp).getTime();
-        return rowTime >= startTime && rowTime <= endTime;
-    });
+    let filtered;
+    try {
+        const params = new URLSearchParams({ start, end, limit: '5000' });
+        const response = await fetch(`/history?${params.toString()}`);
+        if (!response.ok) throw new Error(`HTTP ${response.status}`);
+        filtered = await response.json();
+    } catch (error) {
+        console.error('Lỗi khi lọc lịch sử trên server, lọc tạm trên trình duyệt:', error);
+        filtered = globalHistoryData.filter(row => {
+            const rowTime = new Date(row.timestamp).getTime();
+            return rowTime >= startTime && rowTime <= endTime;
+        });
+    }
     isHistoryTimeFiltered = true;
     renderHistoryTable(filtered);
 }
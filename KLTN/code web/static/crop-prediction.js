@@ -347,7 +347,7 @@ document.addEventListener('DOMContentLoaded', function() {
         };
 
         try {
-            const response = await fetch(`${getBaseUrl()}/predict`, {
+            const response = await fetch(`${getBaseUrl()}/predict?top_k=3`, {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json'
@@ -471,6 +471,17 @@ document.addEventListener('DOMContentLoaded', function() {
                     resultMessage += '</ul></div>';
                 }
 
+                if (result.top_crops && result.top_crops.length > 1) {
+                    resultMessage += '<div class="bg-green-50 border-l-4 border-green-500 text-green-800 p-4 mb-4">';
+                    resultMessage += '<p class="font-bold mb-2">🌿 Các cây phù hợp nhất theo mô hình:</p>';
+                    resultMessage += '<ul class="list-disc list-inside">';
+                    result.top_crops.forEach(item => {
+                        const outOfRange = item.warnings.length ? ` – ${item.warnings.length} thông số ngoài ngưỡng` : ' – mọi thông số trong ngưỡng';
+                        resultMessage += `<li>${item.crop_vi}: ${(item.probability * 100).toFixed(1)}%${outOfRange}</li>`;
+                    });
+                    resultMessage += '</ul></div>';
+                }
+
                 predictionText.innerHTML = resultMessage;
                 resultDiv.classList.remove('hidden');
                 errorDiv.classList.add('hidden');
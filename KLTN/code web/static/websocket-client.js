@@ -6,6 +6,9 @@ const wsMaxReconnectAttempts = 5;
 const wsReconnectDelay = 5000;
 let wsReconnectTimeout = null;
 let lastData = null;
+// Lịch sử nhận qua giao thức 2 và seq để kết nối lại bằng /ws?since=<seq>
+let wsHistory = [];
+let wsHistorySeq = null;
 
 function isDataEqual(data1, data2) {
     if (!data1 || !data2) return false;
@@ -43,7 +46,8 @@ function getWebSocketUrl() {
     const isLocal = window.location.hostname === 'localhost' || window.location.hostname === '127.0.0.1';
     const wsProtocol = window.location.protocol === 'https:' ? 'wss' : 'ws';
     const wsHost = window.location.host;
-    return isLocal ? `${wsProtocol}://localhost:8000/ws` : `${wsProtocol}://${wsHost}/ws`;
+    const url = isLocal ? `${wsProtocol}://localhost:8000/ws` : `${wsProtocol}://${wsHost}/ws`;
+    return wsHistorySeq === null ? url : `${url}?since=${wsHistorySeq}`;
 }
 
 function connectWebSocket() {
@@ -82,6 +86,11 @@ function connectWebSocket() {
         wsClient.onmessage = (event) => {
             try {
                 const data = JSON.parse(event.data);
+                if (data.type === 'ping') {
+                    // Trả lời để server không ngắt kết nối vì im lặng quá lâu
+                    wsClient.send(JSON.stringify({ type: 'pong', ts: data.ts }));
+                    return;
+                }
                 handleWebSocketMessage(data);
             } catch (error) {
                 console.error('Error processing WebSocket message:', error);
@@ -99,20 +108,25 @@ function connectWebSocket() {
 // Xử lý tin nhắn từ WebSocket
 function handleWebSocketMessage(data) {
     try {
-        if (data.latest && !isDataEqual(data.latest, lastData)) {
-            console.log('New sensor data:', data.latest);
-            lastData = {...data.latest};
+        // Delta chỉ chứa các trường đã thay đổi → ghép vào bản ghi trước
+        const latest = data.latest ? { ...lastData, ...data.latest } : null;
+        if (latest && !isDataEqual(latest, lastData)) {
+            console.log('New sensor data:', latest);
+            lastData = latest;
             if (typeof updateSensorDisplay === 'function') {
-                debouncedUpdateSensorDisplay(data.latest);
+                debouncedUpdateSensorDisplay(latest);
             }
             if (typeof updateNotifications === 'function') {
-                updateNotifications(data.latest);
+                updateNotifications(latest);
             }
         }
 
         if (data.history && Array.isArray(data.history)) {
+            const merged = applyHistoryFrame(wsHistory, wsHistorySeq, data);
+            wsHistory = merged.rows;
+            wsHistorySeq = merged.seq;
             if (typeof isHistoryTimeFiltered === 'undefined' || !isHistoryTimeFiltered) {
-                updateHistoryTable(data.history);
+                updateHistoryTable(wsHistory);
             }
         }
 
@@ -0,0 +1,112 @@
+import json
+import os
+import threading
+from typing import Dict
+
+# Luôn nằm cạnh module, không phụ thuộc thư mục chạy uvicorn
+TIMER_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'device_timers.json')
+# Gộp journal vào snapshot sau bấy nhiêu thay đổi
+TIMER_COMPACT_EVERY = int(os.getenv("TIMER_COMPACT_EVERY", 200))
+
+SECTIONS = ('timers', 'events')
+
+
+def _fsync_dir(path: str):
+    try:
+        fd = os.open(os.path.dirname(path) or '.', os.O_RDONLY)
+    except OSError:
+        return # Windows không mở được thư mục, os.replace vẫn nguyên tử
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class TimerStore:
+    """Snapshot file plus an append-only journal of per-device changes.
+
+    Each put/delete appends one fsync'ed JSON line instead of rewriting the
+    whole file; every TIMER_COMPACT_EVERY changes the state is written to a
+    temp file, fsync'ed and atomically renamed over the snapshot, then the
+    journal is truncated. A torn last journal line is ignored on load.
+    """
+
+    def __init__(self, path: str = TIMER_FILE, compact_every: int = TIMER_COMPACT_EVERY):
+        self.path = path
+        self.journal_path = path + '.journal'
+        self.compact_every = compact_every
+        self.state: Dict[str, Dict] = {section: {} for section in SECTIONS}
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def load(self) -> Dict[str, Dict]:
+        """Read the snapshot, replay the journal and compact; returns the state"""
+        state = {section: {} for section in SECTIONS}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if 'version' in data:
+                for section in SECTIONS:
+                    state[section] = data.get(section, {})
+            else:
+                state['timers'] = data # Định dạng cũ: {device: timer}
+        except FileNotFoundError:
+            pass
+        replayed = 0
+        try:
+            with open(self.journal_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break # Dòng cuối ghi dở khi mất điện
+                    section = state.setdefault(entry['section'], {})
+                    if entry['op'] == 'put':
+                        section[entry['name']] = entry['value']
+                    else:
+                        section.pop(entry['name'], None)
+                    replayed += 1
+        except FileNotFoundError:
+            pass
+        self.state = state
+        if replayed:
+            self.compact()
+        return self.state
+
+    def put(self, section: str, name: str, value):
+        self.state[section][name] = value
+        self._append({'op': 'put', 'section': section, 'name': name, 'value': value})
+
+    def delete(self, section: str, name: str):
+        if self.state[section].pop(name, None) is not None:
+            self._append({'op': 'delete', 'section': section, 'name': name})
+
+    def _append(self, entry):
+        line = json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + '\n'
+        with self._lock:
+            with open(self.journal_path, 'a', encoding='utf-8') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+            self._pending += 1
+            compact = self._pending >= self.compact_every
+        if compact:
+            self.compact()
+
+    def compact(self):
+        """Atomically write the full state to the snapshot and reset the journal"""
+        with self._lock:
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'version': 2, **self.state}, f, ensure_ascii=False)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+            _fsync_dir(self.path)
+            # Snapshot đã chứa mọi thay đổi → journal có thể xóa an toàn
+            with open(self.journal_path, 'w', encoding='utf-8') as f:
+                f.flush()
+                os.fsync(f.fileno())
+            self._pending = 0
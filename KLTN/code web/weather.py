@@ -0,0 +1,291 @@
+import asyncio
+import os
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import Future
+from datetime import datetime, timedelta
+
+import aiohttp
+import pytz
+import requests
+from dotenv import load_dotenv
+
+from metrics import WEATHER_CACHE, WEATHER_FETCH_ERRORS, WEATHER_FETCH_SECONDS
+
+load_dotenv()
+
+vn_tz = pytz.timezone('Asia/Ho_Chi_Minh')
+
+# Cho phép trỏ sang server giả lập khi test (VD: http://127.0.0.1:9000/v1/forecast)
+OPEN_METEO_URL = os.getenv("OPEN_METEO_URL", "https://api.open-meteo.com/v1/forecast")
+OPENWEATHER_URL = os.getenv("OPENWEATHER_URL", "https://api.openweathermap.org/data/2.5/forecast")
+API_KEY = os.getenv("API_KEY")
+CITY = os.getenv("CITY")
+HTTP_TIMEOUT = float(os.getenv("WEATHER_HTTP_TIMEOUT", 10))
+
+# TTL (giây) theo từng loại dữ liệu: (thời gian còn tươi, thời gian được dùng bản cũ khi API lỗi)
+CACHE_POLICIES = {
+    'rainfall_today': (int(os.getenv("WEATHER_TTL_RAINFALL", 900)), 6 * 3600),
+    'rainfall_last_month': (int(os.getenv("WEATHER_TTL_MONTHLY", 86400)), 31 * 86400),
+    'forecast': (int(os.getenv("WEATHER_TTL_FORECAST", 1800)), 12 * 3600),
+}
+# Sau khi API lỗi và đã trả bản cũ, chờ bao lâu mới thử gọi lại
+RETRY_AFTER_FAILURE = 60
+
+class WeatherCache:
+    """TTL cache with single-flight loading and stale fallback on upstream errors.
+
+    Works from the event loop (get) and from plain threads (get_sync), e.g. the
+    paho network thread or bot.py, because in-flight loads are shared through
+    concurrent.futures.Future.
+    """
+
+    def __init__(self):
+        self._entries = {}   # key -> [value, fresh_until, stale_until]
+        self._inflight = {}  # key -> Future
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale_served = 0
+
+    def _claim(self, kind, key):
+        """Return (fresh_value, future, is_owner, stale_entry)"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[1] > now:
+                self.hits += 1
+                WEATHER_CACHE.labels(kind, 'hit').inc()
+                return entry[0], None, False, entry
+            if entry and entry[2] <= now:
+                del self._entries[key]
+                entry = None
+            self.misses += 1
+            WEATHER_CACHE.labels(kind, 'miss').inc()
+            future = self._inflight.get(key)
+            if future is not None:
+                return None, future, False, entry
+            future = Future()
+            future.set_running_or_notify_cancel() # waiter bị hủy không được hủy luôn kết quả dùng chung
+            self._inflight[key] = future
+            return None, future, True, entry
+
+    def _store(self, key, kind, value):
+        ttl, stale_ttl = CACHE_POLICIES[kind]
+        now = time.monotonic()
+        with self._lock:
+            self._entries[key] = [value, now + ttl, now + ttl + stale_ttl]
+
+    def _fallback(self, kind, key, stale_entry, error):
+        WEATHER_FETCH_ERRORS.labels(kind).inc()
+        if stale_entry is None:
+            raise error
+        with self._lock:
+            self.stale_served += 1
+            WEATHER_CACHE.labels(kind, 'stale').inc()
+            # Giữ bản cũ thêm một lúc để không gọi dồn dập vào API đang lỗi
+            stale_entry[1] = time.monotonic() + RETRY_AFTER_FAILURE
+            self._entries[key] = stale_entry
+        print(f"⚠️ API thời tiết lỗi ({error}), dùng dữ liệu cũ cho {key}")
+        return stale_entry[0]
+
+    def _settle(self, key, future, value=None, error=None):
+        with self._lock:
+            self._inflight.pop(key, None)
+        if error is not None:
+            future.set_exception(error)
+            raise error
+        future.set_result(value)
+        return value
+
+    def get_sync(self, kind, key, loader):
+        """Return the cached value or load it with a blocking loader()"""
+        value, future, owner, stale_entry = self._claim(kind, key)
+        if future is None:
+            return value
+        if not owner:
+            return future.result()
+        try:
+            with WEATHER_FETCH_SECONDS.labels(kind).time():
+                value = loader()
+        except Exception as e:
+            try:
+                value = self._fallback(kind, key, stale_entry, e)
+            except Exception as error:
+                return self._settle(key, future, error=error)
+        else:
+            self._store(key, kind, value)
+        return self._settle(key, future, value)
+
+    async def get(self, kind, key, loader):
+        """Return the cached value or await the coroutine function loader()"""
+        value, future, owner, stale_entry = self._claim(kind, key)
+        if future is None:
+            return value
+        if not owner:
+            return await asyncio.wrap_future(future)
+        try:
+            with WEATHER_FETCH_SECONDS.labels(kind).time():
+                value = await loader()
+        except asyncio.CancelledError:
+            # Chỉ task gọi API bị hủy: các request đang chờ nhận bản cũ hoặc lỗi thường rồi fallback như khi API lỗi,
+            # không nhận CancelledError (sẽ dừng luôn task của chúng, VD broadcast_loop)
+            with self._lock:
+                self._inflight.pop(key, None)
+            if stale_entry is not None:
+                future.set_result(stale_entry[0])
+            else:
+                future.set_exception(RuntimeError(f"weather fetch cancelled: {key}"))
+            raise
+        except Exception as e:
+            try:
+                value = self._fallback(kind, key, stale_entry, e)
+            except Exception as error:
+                return self._settle(key, future, error=error)
+        else:
+            self._store(key, kind, value)
+        return self._settle(key, future, value)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+weather_cache = WeatherCache()
+
+
+def _open_meteo_url(latitude, longitude, start_date, end_date):
+    return (
+        f"{OPEN_METEO_URL}?latitude={latitude}&longitude={longitude}"
+        f"&start_date={start_date}&end_date={end_date}"
+        f"&daily=precipitation_sum&timezone=Asia/Ho_Chi_Minh"
+    )
+
+
+async def fetch_rainfall_today():
+    """Fetch today's precipitation sum from open-meteo (raises on failure)"""
+    latitude = 10.8471
+    longitude = 106.7872
+    start_date = end_date = datetime.now(vn_tz).strftime('%Y-%m-%d')
+    # API: open-meteo.com
+    # Lấy lượng mưa hằng ngày tại vị trí cố định
+    url = _open_meteo_url(latitude, longitude, start_date, end_date)
+    timeout = aiohttp.ClientTimeout(total=HTTP_TIMEOUT)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        async with session.get(url) as response:
+            if response.status != 200:
+                raise RuntimeError(f"open-meteo HTTP {response.status}: {await response.text()}")
+            data = await response.json()
+            rainfall_list = data.get("daily", {}).get("precipitation_sum", [])
+            return rainfall_list[0] if rainfall_list and rainfall_list[0] is not None else 0.0
+
+
+def _last_month_range():
+    today = datetime.now(vn_tz)
+    last_day_last_month = today.replace(day=1) - timedelta(days=1)
+    first_day_last_month = last_day_last_month.replace(day=1)
+    return first_day_last_month.strftime("%Y-%m-%d"), last_day_last_month.strftime("%Y-%m-%d")
+
+
+def fetch_last_month_rainfall():
+    """Fetch last month's total precipitation from open-meteo (raises on failure)"""
+    latitude = 10.8411
+    longitude = 106.8090
+    start_date, end_date = _last_month_range()
+    response = requests.get(_open_meteo_url(latitude, longitude, start_date, end_date), timeout=HTTP_TIMEOUT)
+    if response.status_code != 200:
+        raise RuntimeError(f"open-meteo HTTP {response.status_code}")
+    rainfall_data = response.json()["daily"]["precipitation_sum"]
+    total_rainfall = sum(x for x in rainfall_data if x is not None)
+    return round(total_rainfall, 2)
+
+
+def parse_forecast(data):
+    """Group an OpenWeather 5-day/3-hour payload into daily summaries"""
+    forecast_by_day = defaultdict(list)
+    # Gom dữ liệu theo ngày
+    # nhiệt độ trung bình
+    # độ ẩm trung bình
+    # tổng lượng mưa
+    # icon thời tiết
+    for entry in data['list']:
+        dt = datetime.fromtimestamp(entry['dt'])
+        date_str = dt.strftime('%Y-%m-%d')
+        weather_info = entry.get('weather', [{}])[0]
+        forecast_by_day[date_str].append({
+            'time': dt.strftime('%H:%M'),
+            'temp': entry['main']['temp'],
+            'humidity': entry['main']['humidity'],
+            'rain': entry.get('rain', {}).get('3h', 0),
+            'icon_code': weather_info.get('icon', ''),
+            'description': weather_info.get('description', '')
+        })
+    today_str = datetime.now().strftime('%Y-%m-%d')
+    forecast_5days = []
+    today_data = {'rainfall': 0, 'temperature': 0, 'humidity': 0}
+    for date, entries in sorted(forecast_by_day.items()):
+        avg_temp = sum(e['temp'] for e in entries) / len(entries)
+        avg_humidity = sum(e['humidity'] for e in entries) / len(entries)
+        total_rain = sum(e['rain'] for e in entries)
+        mid_day_entry = entries[len(entries)//2]
+        icon_code = mid_day_entry.get('icon_code', '')
+        description = mid_day_entry.get('description', '')
+        icon_url = f"https://openweathermap.org/img/wn/{icon_code}@2x.png" if icon_code else ''
+        forecast_5days.append({
+            'date': date,
+            'temperature': round(avg_temp, 2),
+            'humidity': round(avg_humidity, 2),
+            'rainfall': round(total_rain, 2),
+            'description': description,
+            'icon': icon_url
+        })
+        if date == today_str:
+            today_data = {
+                'rainfall': round(total_rain, 2),
+                'temperature': round(avg_temp, 2),
+                'humidity': round(avg_humidity, 2)
+            }
+        if len(forecast_5days) >= 5:
+            break
+    return {'today': today_data, 'forecast_5days': forecast_5days}
+
+
+async def fetch_forecast():
+    """Fetch and summarise the OpenWeather 5-day forecast (raises on failure)"""
+    url = f"{OPENWEATHER_URL}?q={CITY}&appid={API_KEY}&units=metric&lang=en"
+    timeout = aiohttp.ClientTimeout(total=HTTP_TIMEOUT)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        async with session.get(url) as response:
+            if response.status != 200:
+                raise RuntimeError(f"OpenWeather HTTP {response.status}")
+            return parse_forecast(await response.json())
+
+
+# Hàm lấy dữ liệu lượng mưa hôm nay (có cache)
+async def get_rainfall_data():
+    key = f"rainfall_today:{datetime.now(vn_tz).strftime('%Y-%m-%d')}"
+    try:
+        return await weather_cache.get('rainfall_today', key, fetch_rainfall_today)
+    except Exception as e:
+        print("Lỗi khi lấy dữ liệu lượng mưa:", e)
+        return 0.0
+
+
+# Thống kê lượng mưa tháng trước (có cache, chỉ đổi khi sang tháng mới)
+def get_last_month_rainfall():
+    key = f"rainfall_last_month:{_last_month_range()[0]}"
+    try:
+        return weather_cache.get_sync('rainfall_last_month', key, fetch_last_month_rainfall)
+    except Exception as e:
+        print(f"❌ Lỗi khi lấy lượng mưa tháng trước: {e}")
+        return 0
+
+
+# Dự báo 5 ngày từ OpenWeather (có cache)
+async def get_forecast_rainfall():
+    try:
+        return await weather_cache.get('forecast', f"forecast:{CITY}", fetch_forecast)
+    except Exception as e:
+        print(f"Error fetching forecast data: {e}")
+        return {'today': {'rainfall': 0, 'temperature': 0, 'humidity': 0}, 'forecast_5days': []}
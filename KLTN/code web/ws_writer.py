@@ -0,0 +1,268 @@
+import asyncio
+import json
+import os
+import time
+from collections import deque
+
+from starlette.websockets import WebSocketDisconnect, WebSocketState
+
+from metrics import (WS_COALESCED, WS_DROPPED, WS_PING_RTT_SECONDS, WS_QUEUE_LAG_SECONDS, WS_SEND_SECONDS,
+                     WS_SENT_BYTES)
+
+# Số gói sự kiện (device_status, mqtt_status, ping...) chờ gửi tối đa mỗi client; vượt quá thì ngắt client
+WS_QUEUE_SIZE = int(os.getenv("WS_QUEUE_SIZE", 100))
+WS_SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", 10))
+# Giao thức 2: server gửi {"type": "ping"} mỗi WS_PING_INTERVAL giây, client trả {"type": "pong"};
+# client không gửi gì trong WS_IDLE_TIMEOUT giây thì bị ngắt
+WS_PING_INTERVAL = float(os.getenv("WS_PING_INTERVAL", 20))
+WS_IDLE_TIMEOUT = float(os.getenv("WS_IDLE_TIMEOUT", 60))
+# Mã đóng kết nối khi server chủ động ngắt client (1013 = Try Again Later → client kết nối lại)
+WS_EVICT_CODE = 1013
+
+
+def merge_delta(pending: dict, frame: dict, max_rows: int) -> dict:
+    """Fold a newer protocol 2 delta into one still waiting to be sent"""
+    merged = dict(pending)
+    if 'latest' in frame:
+        merged['latest'] = {**pending.get('latest', {}), **frame['latest']}
+    if 'history' in frame:
+        if frame.get('reset'):
+            rows, reset = frame['history'], True
+        else:
+            rows, reset = frame['history'] + pending.get('history', []), pending.get('reset', False)
+        if len(rows) > max_rows:
+            rows, reset = rows[:max_rows], True # Client sẽ thay toàn bộ lịch sử thay vì thiếu dòng
+        merged['history'] = rows
+        merged['seq'] = frame['seq']
+        if reset:
+            merged['reset'] = True
+    for key in ('today', 'forecast_5days'):
+        if key in frame:
+            merged[key] = frame[key]
+    return merged
+
+
+def merge_legacy(pending: dict, frame: dict) -> dict:
+    """Fold a newer protocol 1 frame into one still waiting to be sent"""
+    if 'history' in frame:
+        return frame # Gói đầy đủ mới thay gói cũ
+    return {**pending, 'latest': frame['latest']}
+
+
+class ClientWriter:
+    """One WebSocket's sender: a single task drains a bounded, coalescing queue.
+
+    Broadcasts only enqueue, so a slow client never delays the others and
+    never builds up pending sends. State frames (latest readings, history
+    deltas, the protocol 1 payload) are merged into the one still waiting,
+    so at most one is queued; events (device_status, mqtt_status, ping) are
+    never dropped or merged, and a client with more than `queue_size` of
+    them waiting, a send slower than `send_timeout`, or (protocol 2) no
+    message for `idle_timeout` seconds is evicted.
+    """
+
+    def __init__(self, websocket, legacy: bool = False, max_rows: int = 500, queue_size: int = WS_QUEUE_SIZE,
+                 send_timeout: float = WS_SEND_TIMEOUT, ping_interval: float = WS_PING_INTERVAL,
+                 idle_timeout: float = WS_IDLE_TIMEOUT, on_close=None):
+        self.websocket = websocket
+        self.legacy = legacy
+        self.max_rows = max_rows
+        self.queue_size = queue_size
+        self.send_timeout = send_timeout
+        self.ping_interval = ping_interval
+        self.idle_timeout = idle_timeout
+        self.on_close = on_close
+        self.seq = None             # giao thức 2: id dòng lịch sử mới nhất đã đưa vào hàng đợi (None = chờ snapshot)
+        self._queue = deque()       # [kind, thời điểm vào hàng, frame dict | None, text | None]
+        self._state = None          # gói trạng thái đang chờ (phần tử của _queue) để gộp gói mới vào
+        self._events = 0
+        self._wakeup = asyncio.Event()
+        self._task = None
+        now = time.monotonic()
+        self.connected_at = now
+        self.last_seen = now
+        self._next_ping = now + ping_interval
+        self._ping_sent = None
+        self.rtt = None
+        self.sent = 0
+        self.sent_bytes = 0
+        self.coalesced = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.close_reason = None
+
+    @property
+    def closed(self) -> bool:
+        return self.close_reason is not None
+
+    @property
+    def pending(self) -> int:
+        return len(self._queue)
+
+    def lag(self) -> float:
+        """Seconds the oldest unsent frame has been waiting"""
+        return time.monotonic() - self._queue[0][1] if self._queue else 0.0
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.close_reason is None:
+            self.close_reason = 'disconnected'
+        if self._task and self._task is not asyncio.current_task():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    # --- Đưa gói vào hàng đợi (không chờ gửi) ---
+    def send_first(self, text: str, kind: str = 'snapshot'):
+        """Queue the connect-time snapshot ahead of anything broadcast meanwhile"""
+        self._queue.appendleft([kind, time.monotonic(), None, text])
+        self._wakeup.set()
+
+    def send_event(self, text: str, kind: str = 'event'):
+        if self.closed:
+            return
+        if self._events >= self.queue_size:
+            self.evict('overflow')
+            return
+        self._events += 1
+        self._queue.append([kind, time.monotonic(), None, text])
+        self._wakeup.set()
+
+    def send_state(self, frame: dict, text: str):
+        """Queue a state frame, merging it into the one still waiting if any"""
+        if self.closed:
+            return
+        if self._state is not None:
+            pending = self._state
+            pending[2] = merge_legacy(pending[2], frame) if self.legacy else merge_delta(pending[2], frame, self.max_rows)
+            pending[3] = None # Đã gộp → serialize lại riêng cho client này khi gửi
+            self.coalesced += 1
+            WS_COALESCED.labels(pending[0]).inc()
+            return
+        self._state = ['legacy' if self.legacy else 'delta', time.monotonic(), frame, text]
+        self._queue.append(self._state)
+        self._wakeup.set()
+
+    def received(self, text: str):
+        """Note a message from the client; pong replies give the round-trip time"""
+        self.last_seen = time.monotonic()
+        if self._ping_sent is not None and '"pong"' in text:
+            try:
+                message = json.loads(text)
+            except ValueError:
+                return
+            if isinstance(message, dict) and message.get('type') == 'pong':
+                self.rtt = self.last_seen - self._ping_sent
+                self._ping_sent = None
+                WS_PING_RTT_SECONDS.observe(self.rtt)
+
+    def evict(self, reason: str):
+        if self.closed:
+            return
+        self.close_reason = reason
+        WS_DROPPED.labels(reason).inc()
+        print(f"Removed WebSocket from broadcast: {reason}")
+        self._wakeup.set()
+        if self.on_close:
+            self.on_close(self.websocket)
+
+    # --- Task gửi ---
+    def _heartbeat(self) -> float:
+        """Send a ping / evict an idle client when due; returns seconds until the next check"""
+        if self.legacy:
+            return self.ping_interval # Giao thức 1 giữ nguyên như cũ: không ping, không ngắt khi im lặng
+        now = time.monotonic()
+        if now - self.last_seen > self.idle_timeout:
+            self.evict('idle')
+            return 0
+        if now >= self._next_ping:
+            self._next_ping = now + self.ping_interval
+            self._ping_sent = now
+            self.send_event(json.dumps({"type": "ping", "ts": int(time.time() * 1000)}), kind='ping')
+        return max(0.0, min(self._next_ping, self.last_seen + self.idle_timeout) - now)
+
+    async def run(self):
+        try:
+            while not self.closed:
+                wait = self._heartbeat()
+                if self.closed:
+                    break
+                if not self._queue:
+                    self._wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), wait)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                entry = self._queue.popleft()
+                if entry is self._state:
+                    self._state = None
+                elif entry[0] in ('event', 'ping'):
+                    self._events -= 1
+                await self._send(entry)
+        finally:
+            if self.close_reason not in (None, 'disconnected'):
+                await self._close()
+
+    async def _send(self, entry):
+        kind, queued_at, frame, text = entry
+        if text is None:
+            text = json.dumps(frame, ensure_ascii=False, separators=(",", ":"))
+        if self.websocket.application_state != WebSocketState.CONNECTED:
+            self.evict('disconnected')
+            return
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(self.websocket.send_text(text), timeout=self.send_timeout)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.evict(self._drop_reason(e))
+            return
+        WS_SEND_SECONDS.observe(time.perf_counter() - started)
+        self.last_lag = time.monotonic() - queued_at
+        self.max_lag = max(self.max_lag, self.last_lag)
+        WS_QUEUE_LAG_SECONDS.observe(self.last_lag)
+        size = len(text.encode())
+        WS_SENT_BYTES.labels(kind if kind != 'ping' else 'event').inc(size)
+        self.sent += 1
+        self.sent_bytes += size
+
+    async def _close(self):
+        try:
+            if self.websocket.application_state == WebSocketState.CONNECTED:
+                await asyncio.wait_for(self.websocket.close(code=WS_EVICT_CODE, reason=self.close_reason),
+                                       timeout=self.send_timeout)
+        except Exception:
+            pass
+
+    @staticmethod
+    def _drop_reason(error: BaseException) -> str:
+        if isinstance(error, asyncio.TimeoutError):
+            return 'timeout'
+        if isinstance(error, WebSocketDisconnect):
+            return 'disconnected'
+        return 'error'
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        client = getattr(self.websocket, 'client', None)
+        return {
+            'client': f"{client.host}:{client.port}" if client else None,
+            'protocol': 1 if self.legacy else 2,
+            'connected_s': round(now - self.connected_at, 1),
+            'idle_s': round(now - self.last_seen, 1),
+            'queued': self.pending,
+            'lag_ms': round(self.lag() * 1000, 1),
+            'last_lag_ms': round(self.last_lag * 1000, 1),
+            'max_lag_ms': round(self.max_lag * 1000, 1),
+            'rtt_ms': round(self.rtt * 1000, 1) if self.rtt is not None else None,
+            'sent': self.sent,
+            'sent_bytes': self.sent_bytes,
+            'coalesced': self.coalesced
+        }